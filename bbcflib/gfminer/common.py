@@ -1,8 +1,9 @@
-from bbcflib.track import FeatureStream
+from bbcflib.track import FeatureStream, ArrayFeatureStream
+from bbcflib.track import _column_array
 from functools import wraps
-import sys, re, itertools, operator, random, string
+import sys, re, itertools, operator, random, heapq, bisect
 from numpy import log as nlog
-from numpy import asarray,mean,median,exp,nonzero,prod,around,argsort,float_
+from numpy import asarray,mean,median,exp,nonzero,prod,around,argsort,float_,ndarray,fromiter,in1d,zeros
 
 ####################################################################
 def ordered(fn):
@@ -54,6 +55,43 @@ def copy(stream,n=2):
     if n==1: return stream
     return [FeatureStream(x,stream.fields) for x in itertools.tee(stream)]
 
+def _apply_column(fn, column):
+    """Applies *fn* to the whole numpy *column* of an ArrayFeatureStream chunk if it returns
+    a column of the same length, otherwise to each of its values."""
+    try:
+        result = fn(column)
+        if isinstance(result,ndarray) and result.shape == column.shape:
+            return result
+    except Exception:
+        pass
+    return _column_array([fn(x) for x in column.tolist()])
+
+def _test_column(column, val):
+    """Boolean mask of the values of *column* matching *val* in the sense of `select`."""
+    if isinstance(val,(list,tuple)):
+        if column.dtype.kind in 'biuf' and all(isinstance(v,(int,long,float)) for v in val):
+            return in1d(column,val)
+        return fromiter((x in val for x in column.tolist()),bool,len(column))
+    elif hasattr(val,'__call__'):
+        return _apply_column(val,column).astype(bool)
+    else:
+        return _apply_column(lambda x: x == val,column).astype(bool)
+
+def _project(stream, idxs, fields):
+    """Stream of the columns *idxs* of *stream*, named *fields*: the rows are built by an
+    `operator.itemgetter` (by blocks if *stream* has any), the chunks of an ArrayFeatureStream
+    are passed as they are."""
+    if isinstance(stream,ArrayFeatureStream):
+        return ArrayFeatureStream(stream.chunks, fields=fields)
+    if len(idxs) > 1:
+        getter = operator.itemgetter(*idxs)
+    else:
+        i = idxs[0]
+        getter = lambda x: (x[i],)
+    if getattr(stream,'_blocks',None) is not None:
+        return FeatureStream((map(getter,b) for b in stream.batches()), fields=fields, blocks=True)
+    return FeatureStream(itertools.imap(getter,stream), fields=fields)
+
 ####################################################################
 def add_name_field(stream):
     """
@@ -75,29 +113,46 @@ def select(stream, fields=None, selection={}):
     :param selection: (dict {*field*:*val*}) keep only lines s.t. *field* has a value
         equal to *val*, or is an element of *val*. E.g. `select(f,None,{'chr':['chr1','chr2']})`.
         *val* can also be a function returning True or False when applied to an element of the field;
-        if True, the element is kept.
+        if True, the element is kept. Elements must match all the fields of *selection*.
     :rtype: FeatureStream, or list of FeatureStream objects.
     """
-    def _select(stream,idxs):
-        if selection:
-            sel = dict([(stream.fields.index(f),val) for f,val in selection.iteritems()])
-            for x in stream:
-                for k,val in sel.iteritems():
-                    if isinstance(val,(list,tuple)):
-                        if not x[k] in val: continue
-                    elif hasattr(val,'__call__'):
-                        if not val(x[k]): continue
-                    else:
-                        if not x[k] == val: continue
-                    yield tuple([x[i] for i in idxs])
+    def _match(x,k,val):
+        if isinstance(val,(list,tuple)):
+            return x[k] in val
+        elif hasattr(val,'__call__'):
+            return val(x[k])
         else:
-            for x in stream:
-                yield tuple([x[i] for i in idxs])
+            return x[k] == val
+
+    def _select(stream,idxs):
+        sel = dict([(stream.fields.index(f),val) for f,val in selection.iteritems()])
+        if len(idxs) > 1: getter = operator.itemgetter(*idxs)
+        else: getter = lambda x: (x[idxs[0]],)
+        for x in stream:
+            if all(_match(x,k,val) for k,val in sel.iteritems()):
+                yield getter(x)
+
+    def _select_arrays(chunks):
+        for chunk in chunks:
+            keep = None
+            for f,val in selection.iteritems():
+                test = _test_column(chunk[f],val)
+                keep = test if keep is None else keep & test
+            if not keep.any(): continue
+            if not keep.all():
+                yield dict((f,chunk[f][keep]) for f in fields)
+                continue
+            yield dict((f,chunk[f]) for f in fields)
 
     if not fields: fields=stream.fields
     idxs = [stream.fields.index(f) for f in fields]
     assert all([x > -1 for x in idxs]), "Can only select amongst fields %s." % stream.fields
     assert hasattr(stream,'fields') and stream.fields, "Object %s has no attribute 'fields'." % stream
+    if not selection:
+        if idxs == range(len(stream.fields)): return stream
+        return _project(stream,idxs,fields)
+    if isinstance(stream,ArrayFeatureStream):
+        return ArrayFeatureStream(_select_arrays(stream.chunks), fields=fields)
     return FeatureStream(_select(stream,idxs), fields=fields)
 
 ####################################################################
@@ -113,14 +168,14 @@ def reorder(stream,fields,last=False):
         return stream
     if not(all([f in stream.fields for f in fields])):
         raise ValueError("Need %s fields in stream."%(", ".join(fields)))
-    if all(stream.fields[n] == f for n,f in enumerate(fields)):
-        return stream
     if last:
         _inds = [n for n,f in enumerate(stream.fields) if f not in fields]+[stream.fields.index(f) for f in fields]
     else:
         _inds = [stream.fields.index(f) for f in fields]+[n for n,f in enumerate(stream.fields) if f not in fields]
+    if _inds == range(len(stream.fields)):
+        return stream
     _flds = [stream.fields[n] for n in _inds]
-    return FeatureStream((tuple(x[n] for n in _inds) for x in stream), fields=_flds)
+    return _project(stream,_inds,_flds)
 
 ####################################################################
 def apply(stream,fields,functions):
@@ -130,6 +185,8 @@ def apply(stream,fields,functions):
     :param stream: FeatureStream object.
     :param fields: (list of str) list of fields to transform in the output.
     :param functions: list of functions to apply to the respective *fields*.
+        On an ArrayFeatureStream, a function is applied to a whole column at once if it
+        accepts a numpy array (e.g. `lambda x: 2*x`), otherwise to each value.
     :rtype: FeatureStream, or list of FeatureStream objects
     """
     def _apply(stream,fields,functions):
@@ -140,9 +197,18 @@ def apply(stream,fields,functions):
         for x in stream:
             yield tuple([fct[i](x[i]) for i in range(nf)])
 
+    def _apply_arrays(chunks,fields,functions):
+        for chunk in chunks:
+            chunk = dict(chunk)
+            for f,fn in zip(fields,functions):
+                chunk[f] = _apply_column(fn,chunk[f])
+            yield chunk
+
     if isinstance(fields,str): fields = [fields]
     if hasattr(functions,'__call__'): functions = [functions]
     assert len(fields) == len(functions),"The number of fields does not equal the number of functions."
+    if isinstance(stream,ArrayFeatureStream):
+        return ArrayFeatureStream(_apply_arrays(stream.chunks,fields,functions),fields=stream.fields)
     return FeatureStream(_apply(stream,fields,functions),fields=stream.fields)
 
 ####################################################################
@@ -304,26 +370,28 @@ def score_threshold( stream, threshold=0.0, lower=False, strict=False, fields='s
         for x in stream:
             if all([gt(lower*x[k],lower*th) for k in fidx]):
                 yield x
+    def _threshold_arrays(stream,th,lower,fields):
+        gt = operator.gt if strict else operator.ge
+        lower = -1 if lower else 1
+        for chunk in stream.chunks:
+            keep = True
+            for f in fields:
+                keep = keep & gt(lower*chunk[f],lower*th)
+            if keep is True or keep.all(): yield chunk
+            elif keep.any(): yield dict((f,x[keep]) for f,x in chunk.iteritems())
+    def _stream(s):
+        if isinstance(s,ArrayFeatureStream):
+            return ArrayFeatureStream(_threshold_arrays(s,threshold,lower,fields), fields=s.fields)
+        return FeatureStream(_threshold(s,threshold,lower,fields), fields=s.fields)
     if isinstance(stream,(list,tuple)):
-        return [FeatureStream(_threshold(s,threshold,lower,fields), fields=s.fields) for s in stream]
+        return [_stream(s) for s in stream]
     else:
-        return FeatureStream(_threshold(stream,threshold,lower,fields), fields=stream.fields)
+        return _stream(stream)
 
 ####################################################################
-def unroll( stream, regions, fields=['score'] ):
-    """Creates a stream of *end*-*start* items with appropriate *fields* values at every base position.
-    For example, ``unroll([(10,12,0.5,'a'), (14,15,1.2,'b')], regions=(9,16))`` returns::
-
-        FeatureStream([(0,),(0.5,'a'),(0.5,'a'),(0,),(0,),(1.2,'b'),(0,)])
-                        9      10        11      12   13     14      15
-
-    :param stream: FeatureStream object.
-    :param regions: either a pair (start,end) or an ordered list of such pairs or a FeatureStream
-        interpreted as bounds of the region(s) to return.
-    :param fields: list of field names **in addition to 'start','end'**. [['score']]
-    :rtype: FeatureStream
-    """
-    if not(isinstance(fields,(list,tuple))): fields = [fields]
+def _unroll_regions( stream, regions, fields ):
+    """Returns the stream reordered for `unroll`, an iterator over *regions*,
+    whether regions have a chromosome, and the number of fields before *fields*."""
     with_chrom = False
     if isinstance(regions,(list,tuple)):
         if not isinstance(regions[0],(list,tuple)): regions = [regions]
@@ -342,6 +410,60 @@ def unroll( stream, regions, fields=['score'] ):
     else:
         s = reorder(stream,['start','end']+fields)
         nf = 2
+    return s, regions, with_chrom, nf
+
+def _unrolled_runs( s, regions, with_chrom, nf ):
+    """Yields a tuple (offset,length,values) for every stretch of bases covered by a feature,
+    *offset* being the position in the concatenation of *regions*."""
+    offset = 0
+    for reg in regions:
+        if with_chrom:
+            chrom,pos,end = reg[:3]
+        else:
+            chrom = None
+            pos,end = reg[:2]
+        start = pos
+        for x in s:
+            if chrom and not(x[2] == chrom): continue
+            if x[1] <= pos: continue
+            pos = max(pos,min(x[0],end))
+            stop = min(x[1],end)
+            if stop > pos:
+                yield (offset+pos-start,stop-pos,x[nf:])
+                pos = stop
+            if pos >= end: break
+        offset += max(end-start,0)
+
+def unroll( stream, regions, fields=['score'], as_array=False, dtype=float ):
+    """Creates a stream of *end*-*start* items with appropriate *fields* values at every base position.
+    For example, ``unroll([(10,12,0.5,'a'), (14,15,1.2,'b')], regions=(9,16))`` returns::
+
+        FeatureStream([(0,),(0.5,'a'),(0.5,'a'),(0,),(0,),(1.2,'b'),(0,)])
+                        9      10        11      12   13     14      15
+
+    With *as_array*, the (numeric) *fields* values are written instead in a numpy array,
+    with one column per field if there are several of them, e.g. ``array([0,0.5,0.5,0,0,1.2,0])``
+    for ``fields=['score']`` above.
+
+    :param stream: FeatureStream object.
+    :param regions: either a pair (start,end) or an ordered list of such pairs or a FeatureStream
+        interpreted as bounds of the region(s) to return.
+    :param fields: list of field names **in addition to 'start','end'**. [['score']]
+    :param as_array: (bool) return a numpy array instead of a FeatureStream. [False]
+    :param dtype: (numpy dtype) type of the array, e.g. 'float32' to halve its size. [float]
+    :rtype: FeatureStream or numpy.ndarray
+    """
+    if not(isinstance(fields,(list,tuple))): fields = [fields]
+    if as_array:
+        s, regions, with_chrom, nf = _unroll_regions(stream,regions,fields)
+        regions = list(regions)
+        size = sum(max(r[int(with_chrom)+1]-r[int(with_chrom)],0) for r in regions)
+        width = len(fields)
+        vector = zeros((size,) if width == 1 else (size,width),dtype=dtype)
+        for offset,length,values in _unrolled_runs(s,regions,with_chrom,nf):
+            vector[offset:offset+length] = values[0] if width == 1 else values[:width]
+        return vector
+    s, regions, with_chrom, nf = _unroll_regions(stream,regions,fields)
     item0 = (0,)+(None,)*(len(fields)-1)
     def _unr(s):
         for reg in regions:
@@ -365,6 +487,33 @@ def unroll( stream, regions, fields=['score'] ):
                 pos+=1
     return FeatureStream(_unr(s),fields=s.fields[nf:])
 
+def unroll_runs( stream, regions, fields=['score'], dtype=float ):
+    """Run-length representation of `unroll`: returns numpy arrays *starts*, *lengths* and *values*
+    such that the bases ``starts[k]`` to ``starts[k]+lengths[k]-1`` of the unrolled regions have
+    values ``values[k]`` (one column per field if there are several of them), all other bases being 0.
+    For example, ``unroll_runs([(10,12,0.5,'a'), (14,15,1.2,'b')], regions=(9,16))`` returns::
+
+        (array([1,5]), array([2,1]), array([0.5,1.2]))
+
+    :param stream: FeatureStream object.
+    :param regions: either a pair (start,end) or an ordered list of such pairs or a FeatureStream
+        interpreted as bounds of the region(s) to return.
+    :param fields: list of (numeric) field names **in addition to 'start','end'**. [['score']]
+    :param dtype: (numpy dtype) type of the *values* array. [float]
+    :rtype: tuple of 3 numpy arrays
+    """
+    if not(isinstance(fields,(list,tuple))): fields = [fields]
+    s, regions, with_chrom, nf = _unroll_regions(stream,regions,fields)
+    runs = list(_unrolled_runs(s,regions,with_chrom,nf))
+    width = len(fields)
+    starts = fromiter((r[0] for r in runs),dtype=int,count=len(runs))
+    lengths = fromiter((r[1] for r in runs),dtype=int,count=len(runs))
+    if width == 1:
+        values = fromiter((r[2][0] for r in runs),dtype=dtype,count=len(runs))
+    else:
+        values = asarray([r[2][:width] for r in runs],dtype=dtype).reshape(len(runs),width)
+    return starts, lengths, values
+
 ####################################################################
 def sorted_stream(stream,chrnames=[],fields=['chr','start','end'],reverse=False):
     """Sorts a stream according to *fields* values. Will load the entire stream in memory.
@@ -441,6 +590,30 @@ def generic_merge(x):
 
 aggreg_functions = {'strand': strand_merge, 'chr': no_merge}
 
+def _generic_column(x):
+    if isinstance(x[0],(int, long, float, complex)):
+        return sum(x)
+    if isinstance(x[0],basestring):
+        return "|".join(x)
+    if isinstance(x[0],tuple):
+        return tuple(itertools.chain.from_iterable(x))
+
+def _column_merge(fn):
+    """Function merging a whole list of values at once, with the same result as applying
+    the pairwise merge function *fn* successively from left to right."""
+    if fn is generic_merge: return _generic_column
+    if fn is no_merge: return operator.itemgetter(0)
+    if fn is strand_merge:
+        return lambda x: x[0] if x.count(x[0]) == len(x) else type(x[0])(0)
+    return lambda x: reduce(lambda a,b: fn((a,b)), x)
+
+def _fused(x,parts):
+    """Feature *x* with its columns collected in *parts* ({index: values}) joined, as
+    `generic_merge` would successively: strings with '|', tuples one after the other."""
+    for i,v in parts.iteritems():
+        x[i] = "|".join(v) if isinstance(v[0],basestring) else tuple(itertools.chain.from_iterable(v))
+    return tuple(x)
+
 @ordered
 def fusion(stream,aggregate={},stranded=False):
     """Fuses overlapping features in *stream* and applies *aggregate[f]* function to each field *f*.
@@ -463,24 +636,26 @@ def fusion(stream,aggregate={},stranded=False):
     aggreg.update(aggregate)
 
     def _fuse(s,stranded):
-        try:
-            x = list(s.next())
-        except StopIteration:
-            return
-        has_chr = 'chr' in s.fields
-        if has_chr: chridx = s.fields.index('chr')
-        if stranded: stridx = s.fields.index('strand')
+        merges = [(i,aggreg.get(f,generic_merge)) for i,f in enumerate(s.fields) if i > 1]
+        joined = [i for i,fn in merges if fn is generic_merge]
+        chridx = s.fields.index('chr') if 'chr' in s.fields else None
+        stridx = s.fields.index('strand') if stranded else None
+        x = None # feature being fused, merged with each new row
         for y in s:
-            new_chr = has_chr and (x[chridx] != y[chridx])
-            new_str = stranded and (x[stridx] != y[stridx])
-            if y[0] < x[1] and not (new_chr or new_str):
-                x[1] = max(x[1], y[1])
-                x[2:] = [aggreg.get(f,generic_merge)((x[n+2],y[n+2]))
-                         for n,f in enumerate(s.fields[2:])]
-            else:
-                yield tuple(x)
-                x = list(y)
-        yield tuple(x)
+            if x is not None and y[0] < x[1] \
+                    and (chridx is None or y[chridx] == x[chridx]) \
+                    and (stridx is None or y[stridx] == x[stridx]):
+                if y[1] > x[1]: x[1] = y[1]
+                if parts is None: # strings and tuples are joined once the feature is complete
+                    parts = dict((i,[x[i]]) for i in joined if isinstance(x[i],(basestring,tuple)))
+                for i,fn in merges:
+                    if i in parts: parts[i].append(y[i])
+                    else: x[i] = fn((x[i],y[i]))
+                continue
+            if x is not None: yield _fused(x,parts) if parts else tuple(x)
+            x = list(y)
+            parts = None
+        if x is not None: yield _fused(x,parts) if parts else tuple(x)
 
     stream = reorder(stream,['start','end'])
     return FeatureStream( _fuse(stream,stranded), fields=stream.fields)
@@ -505,6 +680,10 @@ def cobble(stream,aggregate={},stranded=False,scored=False):
     This is to avoid having overlapping coordinates of features from both DNA strands,
     which some genome browsers cannot handle for quantitative tracks.
 
+    The fragments are made by a sweep over the boundaries of the features, with a heap of
+    the ends of the features covering the current position; the fields of the features
+    covering a fragment are merged in the order of the stream.
+
     :param stream: FeatureStream object.
     :param stranded: (bool) if True, only features of the same strand are cobbled. [False]
     :param scored: (bool) if True, each fragment will be attributed a fraction of the
@@ -514,112 +693,86 @@ def cobble(stream,aggregate={},stranded=False,scored=False):
     aggreg = dict(aggreg_functions)
     aggreg.update(aggregate)
 
-    def _intersect(A,B,fields):
-        """Return *z*, the part that must replace A in *toyield*, and
-        *rest*, that must reenter the loop instead of B."""
-        rest = None
-        a = tuple(A[2:])
-        b = tuple(B[2:])
-        ab = tuple([aggreg.get(f,generic_merge)((A[k+2],B[k+2])) for k,f in enumerate(fields[2:])])
-        if B[0] < A[1]:           # has an intersection
-            if B[1] < A[1]:
-                if B[0] == A[0]:  # same left border, A is bigger
-                    z = [(B[0],B[1])+ab, (B[1],A[1])+a]
-                elif B[0] < A[0]: # B shifted to the left wrt A
-                    z = [(B[0],A[0])+b, (A[0],B[1])+ab, (B[1],A[1])+a]
-                else:             # B embedded in A
-                    z = [(A[0],B[0])+a, (B[0],B[1])+ab, (B[1],A[1])+a]
-            elif B[1] == A[1]:
-                if B[0] == A[0]:  # identical
-                    z = [(A[0],A[1])+ab]
-                elif B[0] < A[0]: # same right border, B is bigger
-                    z = [(B[0],A[0])+b, (A[0],B[1])+ab]
-                else:             # same right border, A is bigger
-                    z = [(A[0],B[0])+a, (B[0],B[1])+ab]
-            else:
-                if B[0] == A[0]:  # same left border, B is bigger
-                    z = [(A[0],A[1])+ab]
-                    rest = (A[1],B[1])+b
-                elif B[0] < A[0]: # B contains A
-                    z = [(B[0],A[0])+b, (A[0],A[1])+ab]
-                    rest = (A[1],B[1])+b
-                else:             # B shifted to the right wrt A
-                    z = [(A[0],B[0])+a, (B[0],A[1])+ab]
-                    rest = (A[1],B[1])+b
-        else: z = None            # no intersection
-        return z, rest
-
-    def _fuse(stream):
-        try:
-            K = 0 # feature ID
-            X = stream.next() + (str(K),)
-        except StopIteration:
-            return
-        if stranded: istrand = stream.fields.index('strand')
-        toyield = [X]
-        L = {str(K):X[1]-X[0]} # feature lengths
-        while 1:
-            try:
-                X = stream.next()
-                K+=1
-                L[str(K)] = X[1]-X[0]
-                x = X + (str(K),)
-                intersected = False
-                for y in toyield:
-                    if stranded and x[istrand] != y[istrand]:
-                        continue
-                    replace, rest = _intersect(y,x,stream.fields)
-                    if replace:
-                        intersected = True
-                        iy = toyield.index(y)
-                        y = toyield.pop(iy)
-                        for k in range(len(replace)):
-                            toyield.insert(iy+k, replace[k])
-                        x = rest
-                        if not x: break
-                if not intersected:
-                    if scored:
-                        _partial_scores(toyield,L)
-                    while toyield:
-                        y = toyield.pop(0)
-                        yield tuple(y)[:-1]
-                    toyield = [x]
-                    L = {str(x[-1]):L[x[-1]]}
-                elif x:
-                    toyield.append(x)
-            except StopIteration:
-                if scored: _partial_scores(toyield,L)
-                while toyield:
-                    y = toyield.pop(0)
-                    yield tuple(y)[:-1]
-                break
-
-    def _partial_scores(toyield,L):
-        for j,y in enumerate(toyield):
-            if not isinstance(y[2],tuple):
-                scores = (y[2],)
-            else:
-                scores = y[2]
-            LL = [L[k] for k in y[-1].split('|')]
-            s = sum( scores[i] * (y[1]-y[0]) / LL[i] for i in range(len(scores)) )
-            toyield[j] = y[:2]+(s,)+y[3:]
-        return toyield
-
-    _f = ['start','end']
-    if scored and 'score' in stream.fields:
-        def _score_merge(x):
-            if isinstance(x[0],tuple):
-                x0 = x[0]
-                for y in x[1:]: x0 += (y,)
-                return x0
-            else: return x
-        _f += ['score']
-        aggreg['score'] = aggreg.get('score',_score_merge)
-    stream = reorder(stream,_f)
-    # Add a field for the track ID in last position; make sure its name is unused yet
-    id_field = "".join([random.choice(string.letters + string.digits) for x in range(10)])
-    stream.fields += [id_field]
-    return FeatureStream( _fuse(stream), fields=stream.fields[:-1])
+    def _fragment(pile,start,end):
+        ids,rows,columns,ends = pile[:4]
+        if len(rows) == 1:
+            x = (start,end)+rows[0][2:]
+        else:
+            x = (start,end)+tuple([m(c) for m,c in itertools.izip(merges,columns)])
+        if scored: # sum of score*(end-start)/length, from the running sum of score/length
+            if len(rows) == 1: score = rows[0][2]*(end-start)/float(rows[0][1]-rows[0][0])
+            else: score = pile[5]*(end-start)
+            x = x[:2]+(score,)+x[3:]
+        return x
+
+    def _density(x):
+        """Score of feature *x* per bp."""
+        return x[2]/float(x[1]-x[0]) if x[1] > x[0] else 0.
+
+    def _advance(pile,pos,fragments):
+        """Closes the fragments of *pile* ending at or before *pos*."""
+        ids,rows,columns,ends = pile[:4]
+        while ends and ends[0][0] <= pos:
+            end = ends[0][0]
+            if end > pile[4]:
+                fragments.append(_fragment(pile,pile[4],end))
+            pile[4] = end
+            while ends and ends[0][0] == end:
+                k = bisect.bisect_left(ids,heapq.heappop(ends)[1])
+                del ids[k]
+                if scored: pile[5] = pile[5]-_density(rows[k]) if ids else 0.
+                del rows[k]
+                for c in columns: del c[k]
+
+    def _cobble(stream):
+        ichr = stream.fields.index('chr') if 'chr' in stream.fields else None
+        istrand = stream.fields.index('strand') if stranded else None
+        nf = len(stream.fields)
+        piles = {}   # {strand: [ids, rows, columns, heap of (end,id), fragment start, score per bp]}
+        closed = []  # heap of (start,end,n,fragment) of the fragments not yielded yet
+        fragments = []
+        chrom = None
+        n = 0
+        for k,x in enumerate(stream):
+            if ichr is not None and x[ichr] != chrom:
+                for pile in piles.itervalues(): _advance(pile,sys.maxint,fragments)
+                for y in fragments: heapq.heappush(closed,(y[0],y[1],n,y)); n += 1
+                while closed: yield heapq.heappop(closed)[3]
+                fragments = []
+                piles = {}
+                chrom = x[ichr]
+            strand = x[istrand] if stranded else None
+            pile = piles.get(strand)
+            if pile is None:
+                pile = piles[strand] = [[],[],[[] for i in xrange(2,nf)],[],x[0],0.]
+            start = x[0]
+            _advance(pile,start,fragments)
+            if pile[1] and start > pile[4]:
+                fragments.append(_fragment(pile,pile[4],start))
+            pile[4] = start
+            pile[0].append(k)
+            pile[1].append(x)
+            if scored: pile[5] += _density(x)
+            for i,c in enumerate(pile[2]): c.append(x[i+2])
+            heapq.heappush(pile[3],(x[1],k))
+            if fragments:
+                for y in fragments: heapq.heappush(closed,(y[0],y[1],n,y)); n += 1
+                fragments = []
+            # the next fragments start after the current feature and the open fragments
+            first = min([start]+[p[4] for p in piles.itervalues() if p[1]])
+            while closed and closed[0][0] < first: yield heapq.heappop(closed)[3]
+        for pile in piles.itervalues(): _advance(pile,sys.maxint,fragments)
+        for y in fragments: heapq.heappush(closed,(y[0],y[1],n,y)); n += 1
+        while closed: yield heapq.heappop(closed)[3]
+
+    scored = scored and 'score' in stream.fields
+    if scored:
+        stream = reorder(stream,['start','end','score'])
+    else:
+        stream = reorder(stream,['start','end'])
+    merges = [_column_merge(aggreg.get(f,generic_merge)) for f in stream.fields[2:]]
+    if scored: merges[0] = lambda x: None # computed from the lengths
+    return FeatureStream( _cobble(stream), fields=stream.fields)
 
 ####################################################################
 def normalize(M,method):
@@ -1,21 +1,30 @@
-from bbcflib.gfminer.common import unroll
+from bbcflib.gfminer.common import unroll, unroll_runs
 from bbcflib.track import FeatureStream
-from numpy.fft import fft, ifft
-from numpy import conjugate,array,asarray,mean,sqrt,real,hstack
+from numpy.fft import fft, ifft, rfft, irfft
+from numpy import conjugate,array,asarray,mean,sqrt,real,hstack,zeros,bincount,searchsorted,clip
 from numpy import concatenate as ncat
-from math import log
+from math import log, ceil
+from itertools import izip
+
+def _named_scores(stream,fields):
+    """Dictionary {name: tuple of the *fields* values} of the rows of *stream*, built by batches."""
+    nidx = stream.fields.index('name')
+    sidx = [stream.fields.index(f) for f in fields]
+    dico = {}
+    for batch in stream.batches():
+        columns = zip(*batch)
+        dico.update(izip(columns[nidx],zip(*[columns[i] for i in sidx])))
+    return dico
 
 def score_array(trackList,fields=['score']):
     """Returns a numeric array with the *fields* columns from each input track
     and a vector of row labels, taken from the *name* field which must match in all tracks."""
     if not(isinstance(trackList,(list,tuple))): trackList=[trackList]
-    sidx = [[t.fields.index(f) for f in fields] for t in trackList]
-    nidx = [t.fields.index('name') for t in trackList]
-    dico = dict((k[nidx[0]],[k[i] for i in sidx[0]]) for k in trackList[0])
+    dico = _named_scores(trackList[0],fields)
     nums = asarray(dico.values())
     labs = asarray(dico.keys())
-    for n,tn in enumerate(trackList[1:]):
-        dico = dict((k[nidx[n+1]],[k[i] for i in sidx[n+1]]) for k in tn)
+    for tn in trackList[1:]:
+        dico = _named_scores(tn,fields)
         nums = hstack((nums,[dico[k] for k in labs]))
     return (nums,labs)
 
@@ -29,7 +38,62 @@ def vec_reduce(x):
     else:
         return x-x[0]
 
-def correlation(trackList, regions, limits=(-1000,1000), with_acf=False):
+def _regions_length(regions,fields=None):
+    """Total length of *regions*, a pair (start,end), a list of such pairs (possibly preceded
+    by a chromosome name), or a list of rows with the given *fields*."""
+    if fields is not None:
+        i,j = fields.index('start'),fields.index('end')
+    else:
+        if not isinstance(regions[0],(list,tuple)): regions = [regions]
+        i,j = (1,2) if len(regions[0]) > 2 else (0,1)
+    return sum(max(r[j]-r[i],0) for r in regions)
+
+def _reduced_runs(runs,n):
+    """Mean and inverse standard deviation of the vector of length *n* given by *runs* (see `unroll_runs`),
+    as `vec_reduce` computes them on the unrolled vector."""
+    starts,lengths,values = runs
+    first = values[0] if len(starts) and starts[0] == 0 else 0
+    if lengths.sum() < n: values = ncat((values,[0]))
+    if not any(abs(values-first)>1e-6):
+        return first, 1.0
+    mu = (lengths*runs[2]).sum()/float(n)
+    return mu, 1.0/sqrt((lengths*runs[2]*runs[2]).sum()/float(n)-mu*mu)
+
+def _reduced_chunk(runs,start,end,n,mu,isigma,dtype='float32'):
+    """Bases *start* to *end*-1 of the reduced vector given by *runs*, 0 outside of [0,*n*)."""
+    starts,lengths,values = runs
+    a,b = max(start,0),min(end,n)
+    chunk = zeros(end-start,dtype=dtype)
+    if b <= a: return chunk
+    i = searchsorted(starts+lengths,a,'right')
+    j = searchsorted(starts,b)
+    bounds = clip(ncat((starts[i:j],starts[i:j]+lengths[i:j])),a,b)-a
+    steps = bincount(bounds,weights=ncat((values[i:j],-values[i:j])),minlength=b-a+1)
+    chunk[a-start:b-start] = (steps[:-1].cumsum()-mu)*isigma
+    return chunk
+
+def _chunked_correlation(runs,n,limits,pairs,chunk_size):
+    """Cross-correlations of the *pairs* of vectors given by *runs*, by overlap-save over blocks
+    of at least *chunk_size* bp: each block of the first vector is correlated with the
+    block of the second one extended by the range of lags, with a single FFT of both."""
+    span = limits[1]-limits[0]
+    N = 2**int(ceil(log(max(chunk_size,1)+span,2)))
+    size = N-span
+    moments = [_reduced_runs(r,n) for r in runs]
+    corr = dict((pair,zeros(span+1)) for pair in pairs)
+    for start in xrange(0,n,size):
+        left = {}
+        right = {}
+        for k in set(p[0] for p in pairs):
+            left[k] = conjugate(rfft(_reduced_chunk(runs[k],start,start+size,n,*moments[k]),N))
+        for k in set(p[1] for p in pairs):
+            right[k] = rfft(_reduced_chunk(runs[k],start+limits[0],start+size+limits[1],n,*moments[k]),N)
+        for k1,k2 in pairs:
+            corr[k1,k2] += irfft(left[k1]*right[k2],N)[:span+1]
+    for c in corr.itervalues(): c /= n
+    return corr
+
+def correlation(trackList, regions, limits=(-1000,1000), with_acf=False, chunk_size=None):
     """
     Calculates the cross-correlation between two streams and
     returns a vector containing the correlation at each lag in this order
@@ -63,17 +127,40 @@ def correlation(trackList, regions, limits=(-1000,1000), with_acf=False):
         In the latter case, all regions will be concatenated.
     :param limits: (tuple (int,int)) maximum lag to consider. [-1000,1000]
     :param with_acf: (bool) include auto-correlations. [False]
+    :param chunk_size: (int) if set, the tracks are kept as run-length encodings (see `unroll_runs`)
+        and correlated by blocks of at least *chunk_size* bp in float32 buffers, so that memory does
+        not grow with the length of the regions. The whole regions are then correlated, while
+        without *chunk_size* they may be cut to a power of 2. [None]
     :rtype: list of floats, or list of lists of floats.
     """
+    if chunk_size:
+        if isinstance(regions,FeatureStream):
+            _reg = list(regions)
+            n = _regions_length(_reg,regions.fields)
+            runs = [unroll_runs(t,FeatureStream(_reg,fields=regions.fields)) for t in trackList]
+        else:
+            n = _regions_length(regions)
+            runs = [unroll_runs(t,regions) for t in trackList]
+        if limits[1]-limits[0] > 2*n:
+            limits = (-n+1,n-1)
+        if with_acf:
+            pairs = [(k1,k2) for k1 in xrange(len(runs)) for k2 in xrange(k1,len(runs))]
+        else:
+            pairs = [(k1,k2) for k1 in xrange(len(runs)) for k2 in xrange(k1+1,len(runs))]
+        corr = _chunked_correlation(runs,n,limits,pairs,chunk_size)
+        if len(trackList) == 2 and not with_acf:
+            return corr[0,1]
+        return [[corr[k1,k2] for k2 in xrange(len(runs)) if (k1,k2) in corr] for k1 in xrange(len(runs))
+                if any(p[0] == k1 for p in pairs)]
     ##### One could profit from numpy to reduce the memory space used for
     ##### storing these - long - arrays ('dtype' is float64 by default).
     if isinstance(regions,FeatureStream):
         _reg = list(regions)
-        x = [array([s[0] for s in unroll(t,FeatureStream(_reg,fields=regions.fields))])
+        x = [unroll(t,FeatureStream(_reg,fields=regions.fields),as_array=True)
              for t in trackList]
         _reg = []
     else:
-        x = [array([s[0] for s in unroll(t,regions)]) for t in trackList]
+        x = [unroll(t,regions,as_array=True) for t in trackList]
     if limits[1]-limits[0] > 2*len(x[0]):
         limits = (-len(x[0])+1,len(x[0])-1)
     N0 = len(x[0])+limits[1]-limits[0]-1
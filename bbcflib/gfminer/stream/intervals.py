@@ -1,4 +1,5 @@
-import sys
+import sys, heapq
+from collections import deque
 from bbcflib.gfminer import common
 from bbcflib.track import FeatureStream
 
@@ -8,6 +9,9 @@ from bbcflib.track import FeatureStream
 def concatenate(trackList, fields=None, remove_duplicates=False, group_by=None, aggregate={}):
     """
     Returns one stream containing all features from a list of tracks, ordered by *fields*.
+    The tracks are merged chromosome by chromosome (in the order of the first track that
+    reaches each of them), then by start and end; features with the same start and end
+    come in the order of *trackList*.
 
     :param trackList: list of FeatureStream objects.
     :param fields: (list of str) list of fields to keep in the output (at least ['start','end']).
@@ -21,54 +25,65 @@ def concatenate(trackList, fields=None, remove_duplicates=False, group_by=None,
         E.g. ``{'score': lambda x: sum(x)}`` will return the sum of all scores in the output.
     :rtype: FeatureStream
     """
-    def _find_min(feat_tuple):
-        """Return the index of the 'smallest' element amongst a tuple of features from
-        different tracks. Priority is given to the first field; if the first field items
-        are equal amongst several elements, it looks at the second field, a.s.o."""
-        nmin = 0
-        xmin = feat_tuple[0]
-        for n,x in enumerate(feat_tuple[1:]):
-            if x[0] == sys.maxint: continue
-            for k in range(len(x)):
-                if cmp(hash(x[k]),hash(xmin[k]))<0:
-                    xmin = x
-                    nmin = n+1
+    def _merge(_t,ci):
+        """Generator yielding all features of the tracks *_t* by a k-way merge on a heap
+        of the current feature of each track, keyed on (start, end, track index).
+        *ci* is the index of the 'chr' field, or None."""
+        si = 0 if ci is None else ci+1
+        ei = si+1
+        waiting = {} # current features on another chromosome than the one being merged
+        for n,t in enumerate(_t):
+            for x in t:
+                waiting[n] = x
+                break
+        heap = []
+        while waiting:
+            chrom = None if ci is None else waiting[min(waiting)][ci]
+            for n in [n for n,x in waiting.iteritems() if ci is None or x[ci] == chrom]:
+                x = waiting.pop(n)
+                heap.append((x[si],x[ei],n,x))
+            heapq.heapify(heap)
+            while heap:
+                n = heap[0][2]
+                yield heap[0][3]
+                for x in _t[n]:
+                    if ci is None or x[ci] == chrom:
+                        heapq.heapreplace(heap,(x[si],x[ei],n,x))
+                    else:
+                        waiting[n] = x
+                        heapq.heappop(heap)
                     break
-                elif cmp(hash(x[k]),hash(xmin[k]))>0:
-                    break
-        return nmin
-
-    def _weave(_t,N):
-        """Generator yielding all features represented in a list of tracks *_t*,
-        sorted w.r.t the *N* first fields."""
-        current = [x.next()[:N] for x in _t] # init
-        allfields = [t.fields for t in _t]
-        n = _find_min(current)
-        last = current[n]
-        current[n] = _t[n].next()[:N]
-        if not group_by: yield last
-        while 1:
-            # Remove duplicates
-            if remove_duplicates:
-                while not all([current.count(x)==1 for x in current]):
-                    for k in range(len(current)):
-                        if current.count(current[k]) > 1:
-                            current[k] = _t[k].next()[:N]
-            n = _find_min(current)
-            if current[n][0] == sys.maxint: break
-            if group_by:
-                idx = [allfields[n].index(f) for f in group_by]
-                if all(current[n][i] == last[i] for i in idx):
-                    last = tuple(current[n][i] if i in idx \
-                            else aggregate.get(allfields[n][i],common.generic_merge)((last[i],current[n][i])) \
-                            for i in range(len(allfields[n]))) # merge last and current
                 else:
-                    yield last
-                    last = current[n]
+                    heapq.heappop(heap)
+
+    def _unique(stream,si):
+        """Skips the features already yielded at the same position."""
+        pos = None
+        seen = set()
+        for x in stream:
+            if x[:si+2] != pos:
+                pos = x[:si+2]
+                seen.clear()
+            elif x in seen:
+                continue
+            seen.add(x)
+            yield x
+
+    def _group(stream,allfields):
+        """Merges consecutive features with the same *group_by* values."""
+        idx = [allfields.index(f) for f in group_by]
+        last = None
+        for x in stream:
+            if last is None:
+                last = x
+            elif all(x[i] == last[i] for i in idx):
+                last = tuple(x[i] if i in idx \
+                        else aggregate.get(allfields[i],common.generic_merge)((last[i],x[i])) \
+                        for i in range(len(allfields))) # merge last and current
             else:
-                yield current[n]
-            current[n] = _t[n].next()[:N]
-        if group_by: yield last
+                yield last
+                last = x
+        if last is not None: yield last
 
     if len(trackList) == 1: return trackList[0]
     if fields is None:
@@ -78,9 +93,12 @@ def concatenate(trackList, fields=None, remove_duplicates=False, group_by=None,
     if 'chr' in fields: _of = ['chr']+_of
     if 'name' in fields: _of += ['name']
     _of += [f for f in fields if not(f in _of)]
-    tl = [common.reorder(t,_of) for t in trackList]
-    tl = [FeatureStream(common.sentinelize(x,(sys.maxint,)*len(x.fields)),x.fields) for x in tl]
-    return FeatureStream(_weave(tl,len(_of)),fields=_of)
+    tl = [iter(common.select(t,_of)) for t in trackList]
+    ci = 0 if 'chr' in _of else None
+    stream = _merge(tl,ci)
+    if remove_duplicates: stream = _unique(stream,_of.index('start'))
+    if group_by: stream = _group(stream,_of)
+    return FeatureStream(stream,fields=_of)
 
 ###############################################################################
 def selection(trackList,selection):
@@ -146,24 +164,56 @@ def overlap(trackList,trackFeatures,strict=False,annotate=False,flatten=common.c
     :rtype: FeatureStream
     """
     def _overlap(tl,tf,stranded,strict):
-        if strict: olap = lambda x,y: x[0] <= y[0] and y[1] <= x[1]
-        else: olap = lambda x,y: x[0] < y[1]
-        if stranded:
-            tl_strand_idx = tl.fields.index('strand')
-            tf_strand_idx = tf.fields.index('strand')
-            same_strand = lambda x,y:x[tl_strand_idx]==y[tf_strand_idx]
-        else: same_strand = lambda x,y:True
-        x = tl.next()
-        for y in tf:
-            try:
-                if not same_strand(x,y): x = tl.next()
-                while x[1] <= y[0]: x = tl.next()
-                while olap(x,y):
-                    yield x
-                    x = tl.next()
-            except StopIteration: break
-
-    if isinstance(trackFeatures,(list,tuple)): trackList = concatenate(trackFeatures)
+        """Sweep line over the features *tf* sorted by start, separately for each strand.
+        Features of *tf* read ahead wait in a deque. In the default mode, these started
+        before the current feature of *tl* only matter by the largest of their ends, the
+        farthest position they cover. In the *strict* mode, the waiting ones starting before
+        the current feature are dropped and the deque is kept with increasing ends, so that
+        its first element ends first."""
+        sx = tl.fields.index('strand') if stranded else None
+        sy = tf.fields.index('strand') if stranded else None
+        sweep = {} # {strand: [deque of features of tf, largest end of the features started]}
+        tf = iter(tf)
+        ahead = None # start of the last feature read from tf
+        for x in tl:
+            xstart = x[0]
+            strand = x[sx] if stranded else None
+            state = sweep.get(strand)
+            if state is None: state = sweep[strand] = [deque(),-sys.maxint]
+            wait = state[0]
+            if strict:
+                while wait and wait[0][0] < xstart: wait.popleft()
+                found = bool(wait) and wait[0][1] <= x[1]
+            else:
+                while wait and wait[0][0] <= xstart:
+                    yend = wait.popleft()[1]
+                    if yend > state[1]: state[1] = yend
+                found = state[1] > xstart or (bool(wait) and wait[0][0] < x[1])
+            while not found and (ahead is None or ahead < x[1]):
+                for y in tf: break
+                else: break
+                ystart,yend = y[0],y[1]
+                ahead = ystart
+                # the next features of tl start after xstart
+                if strict and ystart < xstart: continue
+                if not strict and yend <= xstart: continue
+                ystrand = y[sy] if stranded else None
+                ystate = sweep.get(ystrand)
+                if ystate is None: ystate = sweep[ystrand] = [deque(),-sys.maxint]
+                if strict:
+                    yw = ystate[0]
+                    while yw and yw[-1][1] >= yend: yw.pop()
+                    yw.append((ystart,yend))
+                    found = ystrand == strand and yend <= x[1]
+                elif ystart <= xstart:
+                    if yend > ystate[1]: ystate[1] = yend
+                    found = ystrand == strand
+                else:
+                    ystate[0].append((ystart,yend))
+                    found = ystrand == strand and ystart < x[1]
+            if found: yield x
+
+    if isinstance(trackList,(list,tuple)): trackList = concatenate(trackList)
     if isinstance(trackFeatures,(list,tuple)): trackFeatures = concatenate(trackFeatures)
     stranded = 'strand' in (set(trackList.fields) & set(trackFeatures.fields))
     if flatten is None: _tf = trackFeatures
@@ -267,25 +317,35 @@ def neighborhood(trackList, before_start=None, after_end=None,
                                    fields=tl.fields)
 
 ###############################################################################
-def _combine(trackList,fn,win_size,aggregate):
+def _combine(trackList,fn,aggregate):
     """Generator - see function `combine` below."""
-    N = len(trackList)
     fields = trackList[0].fields
-    trackList = [common.sentinelize(t, [sys.maxint]*len(t.fields)) for t in trackList]
-    init = [trackList[i].next() for i in range(N)] # the first element of each track
+    N = len(trackList)
+    trackList = [iter(t) for t in trackList]
+    init = [next(t,None) for t in trackList] # the first element of each track
+    # A heap of the next start (pos,track index,meta info) and end (pos,track index) events
+    # of every track, popped in the order of a sort of all the events.
+    # The next feature of a track is pushed when the end of the previous one is popped.
+    # Empty tracks have no events, and stay inactive.
+    current = [(x[0],i)+x[2:] for i,x in enumerate(init) if x is not None] \
+             +[(x[1],i) for i,x in enumerate(init) if x is not None]
+    if not current: return
     activity = [False]*N # a vector of boolean values for the N tracks at a given position
     z = [None]*N
-    # If there are empty tracks, remove them, and their index from init
-    for i in xrange(N-1,-1,-1):
-        if init[i][0] == sys.maxint:
-            N-=1
-            trackList.pop(i)
-            init.pop(i)
-    if N == 0: return
-    available_tracks = range(N-1,-1,-1)
-    # Sort starts and ends of all init elements indifferently; record the origin track index.
-    current = [(init[i][0],i)+init[i][2:] for i in range(N)]+[(init[i][1],i) for i in range(N)]
-    current.sort()
+    heapq.heapify(current)
+
+    def _toggle():
+        """Pops the next event, reverses the activity of its track and records its meta info."""
+        e = heapq.heappop(current)
+        i = e[1]                        # track index
+        activity[i] = not(activity[i])  # reverse activity
+        zi = e[2:]                      # record meta info
+        z[i] = zi if activity[i] else None
+        if len(e) == 2:
+            x = next(trackList[i],None)
+            if x is not None:
+                heapq.heappush(current,(x[0],i)+x[2:])
+                heapq.heappush(current,(x[1],i))
 
     # Init step: set all tracks beginning at the starting point as 'active'
     is_chr = 'chr' in fields
@@ -294,49 +354,22 @@ def _combine(trackList,fn,win_size,aggregate):
     else:
         empty = ('0',)*len(fields[2:])
     start = current[0][0]
-    while current[0][0] == start:
-        i = current[0][1]          # track index
-        activity[i] = True         # set this track to 'active'
-        z[i] = current.pop(0)[2:]  # z records all meta info
-
-    k=1
-    while available_tracks or current:
-        # Load all elements within *win_size* bp in *current*
-        to_remove = []
-        limit = k * win_size
-        while current[0][0] >= limit:
-            k+=1
-            limit = k * win_size
-        for i in available_tracks:
-            a = [0,0]
-            while a[1] < limit:
-                a = trackList[i].next()
-                if a[0] == sys.maxint:  # track i is completely read:
-                    to_remove.append(i) # remove it from the tracks list
-                else:
-                    current.append((a[0],i)+a[2:])
-                    current.append((a[1],i))
-        for i in to_remove:
-            available_tracks.remove(i)
-        if not current: continue
-        current.sort()
-        # Calculate boolean values for this window
-        while current and current[0][0] < limit:
-            next = current[0][0]
-            if fn(activity):
-                feat_aggreg = [None]*len(fields[2:])
-                for n,f in enumerate(fields[2:]):
-                    feats = tuple(zi[n] for zi in z if zi)
-                    try: feat_aggreg[n] = aggregate.get(f,common.generic_merge)(feats)
-                    except IndexError: feat_aggreg = empty
-                yield (start,next) + tuple(feat_aggreg)
-            while current and current[0][0] == next:
-                i = current[0][1]               # track index
-                activity[i] = not(activity[i])  # reverse activity
-                zi = current.pop(0)[2:]         # record meta info
-                z[i] = zi if activity[i] else None
-            start = next
-        k+=1
+    while current and current[0][0] == start:
+        _toggle()
+
+    merges = [aggregate.get(f,common.generic_merge) for f in fields[2:]]
+    while current:
+        next_pos = current[0][0]
+        if fn(activity):
+            active = [zi for zi in z if zi]
+            feat_aggreg = [None]*len(merges)
+            for n,merge in enumerate(merges):
+                try: feat_aggreg[n] = merge(tuple(zi[n] for zi in active))
+                except IndexError: feat_aggreg = empty
+            yield (start,next_pos) + tuple(feat_aggreg)
+        while current and current[0][0] == next_pos:
+            _toggle()
+        start = next_pos
 
 @common.ordered
 def combine(trackList, fn, win_size=1000, aggregate={}):
@@ -351,7 +384,8 @@ def combine(trackList, fn, win_size=1000, aggregate={}):
 
     :param trackList: list of FeatureStream objects.
     :param fn: boolean function to apply, such as bbcflib.gfminer.stream.union.
-    :param win_size: (int) window size, in bp.
+    :param win_size: (int) ignored, the tracks are read by a sweep over the starts and ends
+        of their features (kept for compatibility). [1000]
     :param aggregate: (dict) for each field name given as a key, its value is the function
         to apply to the vector containing all trackList's values for this field in order
         to merge them. E.g. ``{'score': lambda x: sum(x)/len(x)}`` will return the average of
@@ -365,7 +399,7 @@ def combine(trackList, fn, win_size=1000, aggregate={}):
         _f += ['chr']
     if isinstance(fn,str): fn = eval(fn) # can type "combine(...,fn='intersection')"
     trackList = [common.cobble(common.reorder(t,fields=_f)) for t in trackList]
-    return common.fusion(FeatureStream(_combine(trackList,fn,win_size,aggregate),
+    return common.fusion(FeatureStream(_combine(trackList,fn,aggregate),
                                        fields=trackList[0].fields))
 
 def exclude(x,indexList):
@@ -1,10 +1,14 @@
 # coding: utf-8
 
-import sys
+import sys, itertools, bisect
+from collections import deque
+from itertools import izip
 from bbcflib.gfminer import common
 from bbcflib.gfminer.stream import concatenate
-from bbcflib.track import FeatureStream
-from numpy import asarray, zeros
+from bbcflib.track import FeatureStream, array_stream
+from numpy import asarray, zeros, empty, unique, concatenate as nconcatenate, searchsorted
+from numpy import minimum, maximum
+from numpy import where, sort, arange, add, multiply, power, nonzero, bincount, inf, nan
 
 def _sum(scores,denom=None):
     return sum(scores)
@@ -40,6 +44,162 @@ def _median(scores,denom=None):
 _score_functions = {'arithmetic':_arithmetic_mean, 'geometric':_geometric_mean, 'sum':_sum,
                     'mean': _arithmetic_mean, 'min':_min, 'max':_max, 'median':_median}
 
+def _median_columns(values,count,denom=None):
+    values = sort(values,axis=0) # missing values (nan) last
+    cols = arange(values.shape[1])
+    lower = values[(count-1)//2,cols]
+    upper = values[count//2,cols]
+    return where(count % 2, lower, (lower+upper)*.5)
+
+def _reduce_rows(fn, values):
+    """Reduces the rows of *values* one after the other, in the same order as `reduce`
+    (numpy may otherwise change the order of the operations, hence the rounding)."""
+    result = values[0].copy()
+    for row in values[1:]: fn(result,row,out=result)
+    return result
+
+# Same as _score_functions, on each column of a tracks x segments matrix of scores,
+# where missing scores are replaced by the given value.
+_score_columns = {'arithmetic': (0., lambda x,n,denom: _reduce_rows(add,x)*denom),
+                  'geometric': (1., lambda x,n,denom: power(_reduce_rows(multiply,x),denom)),
+                  'sum': (0., lambda x,n,denom: _reduce_rows(add,x)),
+                  'min': (inf, lambda x,n,denom: x.min(0)),
+                  'max': (-inf, lambda x,n,denom: x.max(0)),
+                  'median': (nan, _median_columns)}
+_score_columns['mean'] = _score_columns['arithmetic']
+
+_max_cells = 2**22 # maximum size of the tracks x segments matrix of merge_scores
+
+def _join_fields(values):
+    if values and all([x == values[0] for x in values]):
+        return values[0]
+    return "|".join(values)
+
+def _sweep_scores(tracks, nfields, mean_fn, denom):
+    """Merges the scores of *tracks*, iterators over (start, end, score, ...) rows,
+    one segment after the other."""
+    tracks = [common.sentinelize(FeatureStream(t,range(nfields)),[sys.maxint]*nfields) for t in tracks]
+    elements = [list(x.next()) for x in tracks]
+    for i in xrange(len(tracks)-1, -1, -1):
+        if elements[i][0] == sys.maxint:
+            tracks.pop(i)
+            elements.pop(i)
+    while tracks:
+        start = min([x[0] for x in elements])
+        end = min([x[0] for x in elements if x[0]>start]+[x[1] for x in elements])
+        scores = [x[2] for x in elements if x[1]>start and x[0]<end]
+        if nfields > 3:
+            rest = []
+            for i in range(nfields-3):
+                r = [str(x[3+i]) for x in elements if not(x[3+i] is None) and x[1]>start and x[0]<end]
+                rest.append(_join_fields(r))
+            yield (start, end, mean_fn(scores,denom)) + tuple(rest)
+        else:
+            yield (start, end, mean_fn(scores,denom))
+        for i in xrange(len(tracks)-1, -1, -1):
+            if elements[i][0] < end:
+                elements[i][0] = end
+            if elements[i][1] <= end:
+                elements[i] = list(tracks[i].next())
+            if elements[i][0] == sys.maxint:
+                tracks.pop(i)
+                elements.pop(i)
+
+def _chunk_rows(chunk, fields):
+    return izip(*[chunk[f].tolist() for f in fields])
+
+def _merge_window(window, fields, method, denom):
+    """Merges the scores of *window*, a list of dicts of columns (one per track),
+    all segments at once in a tracks x segments matrix."""
+    fill, reduce_fn = _score_columns.get(method,_score_columns['arithmetic'])
+    bounds = unique(nconcatenate([w['start'] for w in window]+[w['end'] for w in window]))
+    starts = bounds[:-1]
+    values = empty((len(window),len(starts)))
+    values.fill(fill)
+    covering = [] # index of the feature of each track covering each segment, or -1
+    for n,w in enumerate(window):
+        nw = len(w['start'])
+        if nw == 0:
+            covering.append(None)
+            continue
+        k = searchsorted(w['end'],starts,side='right')
+        kk = minimum(k,nw-1)
+        present = (k < nw) & (w['start'][kk] <= starts)
+        values[n,present] = w['score'][k[present]]
+        covering.append(where(present,k,-1))
+    count = zeros(len(starts),dtype=int) # number of tracks covering each segment
+    for k in covering:
+        if k is not None: count += k >= 0
+    present = count > 0
+    if not present.all():
+        values = values[:,present]
+        count = count[present]
+        covering = [k if k is None else k[present] for k in covering]
+    columns = [starts[present].tolist(), bounds[1:][present].tolist(),
+               reduce_fn(values,count,denom).tolist()]
+    for f in fields[3:]:
+        values = [w[f] for w in window if len(w[f])]
+        first = values[0][:1].tolist()[0]
+        if first is not None and all([(x == first).all() for x in values]):
+            columns.append([str(first)]*len(columns[0]))
+            continue
+        tracks = [(w[f].tolist(),k) for w,k in zip(window,covering) if k is not None]
+        columns.append([_join_fields([str(x[i]) for x,i in ((x,k[j]) for x,k in tracks)
+                                      if i >= 0 and x[i] is not None])
+                        for j in xrange(len(columns[0]))])
+    return izip(*columns)
+
+def _merge_windows(tracks, method, denom):
+    """Merges the scores of *tracks* window by window, each window ending at the end
+    of a feature, so that no segment is split. Falls back to the sweep over the
+    features if they overlap or are empty."""
+    fields = tracks[0].fields
+    ntracks = len(tracks)
+    size = max(1, _max_cells // (2*ntracks*ntracks)) # maximum number of features per track and window
+    mean_fn = _score_functions.get(method,_arithmetic_mean)
+    chunks = [array_stream(t,size).chunks for t in tracks]
+    buffers = [None]*ntracks # features not merged yet, as dicts of columns
+    last = [-sys.maxint]*ntracks # end of the last feature of each track
+    while True:
+        for n in xrange(ntracks):
+            while chunks[n] is not None and (buffers[n] is None or len(buffers[n]['start']) == 0):
+                chunk = next(chunks[n],None)
+                if chunk is None:
+                    chunks[n] = buffers[n] = None
+                    break
+                start, end = chunk['start'], chunk['end']
+                if len(start) == 0: continue
+                if not ((start < end).all() and (start[1:] >= end[:-1]).all() and start[0] >= last[n]):
+                    rest = [itertools.chain(_chunk_rows(b,fields) if b is not None else (),
+                                            _chunk_rows(chunk,fields) if m == n else (),
+                                            itertools.chain.from_iterable(_chunk_rows(c,fields) for c in cs)
+                                            if cs is not None else ())
+                            for m,(b,cs) in enumerate(zip(buffers,chunks))]
+                    for x in _sweep_scores(rest,len(fields),mean_fn,denom): yield x
+                    return
+                buffers[n] = chunk
+                last[n] = end[-1]
+        active = [b for b in buffers if b is not None]
+        if not active: return
+        wend = min([b['end'][min(len(b['end']),size)-1] for b in active])
+        window = []
+        for n,b in enumerate(buffers):
+            if b is None: continue
+            k = searchsorted(b['end'],wend,side='right') # features ending in the window
+            m = searchsorted(b['start'],wend) # features starting in the window
+            w = dict((f,b[f][:m]) for f in fields)
+            w['end'] = minimum(w['end'],wend)
+            window.append(w)
+            buffers[n] = dict((f,b[f][k:]) for f in fields)
+            if k < m:
+                buffers[n]['start'] = buffers[n]['start'].copy()
+                buffers[n]['start'][0] = wend
+        if ntracks*2*sum(len(w['start']) for w in window) > _max_cells:
+            rows = [_chunk_rows(w,fields) for w in window]
+            for x in _sweep_scores(rows,len(fields),mean_fn,denom): yield x
+        else:
+            for x in _merge_window(window,fields,method,denom): yield x
+
 @common.ordered
 def merge_scores(trackList, method='arithmetic'):
     """
@@ -49,51 +209,22 @@ def merge_scores(trackList, method='arithmetic'):
         X2: _____2222222222__________
         R:  _____11111444443333______
 
+    Unless *method* is a function, the scores are merged by windows of consecutive
+    segments, with numpy. The features of each track must not overlap.
+
     :param trackList: list of FeatureStream objects.
-    :param method: (str) type of average: one of 'arithmetic','geometric', or 'sum' (no average).
+    :param method: (str or function) type of average: one of 'arithmetic','geometric',
+        'sum' (no average), 'min', 'max', 'median', or a function of the list of scores.
     :rtype: FeatureStream
     """
-    tracks = [FeatureStream(common.sentinelize(x,[sys.maxint]*len(x.fields)), x.fields)
-              for x in trackList]
-    tracks = [common.reorder(t,['start','end','score']) for t in tracks]
+    tracks = [common.reorder(t,['start','end','score']) for t in trackList]
     fields = [f for f in tracks[0].fields if all([f in t.fields for t in tracks])] # common fields
-    elements = [list(x.next()) for x in tracks]
+    tracks = [common.select(t,fields) for t in tracks]
     track_denom = 1.0/len(trackList)
-
     if hasattr(method,'__call__'):
         mean_fn = lambda scores,denom:method(scores)
-    else:
-        mean_fn = _score_functions.get(method,_arithmetic_mean)
-    for i in xrange(len(tracks)-1, -1, -1):
-        if elements[i][0] == sys.maxint:
-            tracks.pop(i)
-            elements.pop(i)
-
-    def _stream(tracks):
-        while tracks:
-            start = min([x[0] for x in elements])
-            end = min([x[0] for x in elements if x[0]>start]+[x[1] for x in elements])
-            scores = [x[2] for x in elements if x[1]>start and x[0]<end]
-            if len(fields) > 3:
-                rest = []
-                for i in range(len(fields[3:])):
-                    r = [str(x[3+i]) for x in elements if not(x[3+i] is None) and x[1]>start and x[0]<end]
-                    if all([x == r[0] for x in r]):
-                        rest.append(r[0])
-                    else:
-                        rest.append( "|".join(r) )
-                yield (start, end, mean_fn(scores,track_denom)) + tuple(rest)
-            else:
-                yield (start, end, mean_fn(scores,track_denom))
-            for i in xrange(len(tracks)-1, -1, -1):
-                if elements[i][0] < end:
-                    elements[i][0] = end
-                if elements[i][1] <= end:
-                    elements[i] = list(tracks[i].next())
-                if elements[i][0] == sys.maxint:
-                    tracks.pop(i)
-                    elements.pop(i)
-    return FeatureStream(_stream(tracks),fields)
+        return FeatureStream(_sweep_scores(tracks,len(fields),mean_fn,track_denom),fields)
+    return FeatureStream(_merge_windows(tracks,method,track_denom),fields)
 
 ###############################################################################
 def filter_scores(trackScores,trackFeatures,method='sum',strict=False,annotate=False,flatten=common.cobble):
@@ -173,6 +304,100 @@ def filter_scores(trackScores,trackFeatures,method='sum',strict=False,annotate=F
     return FeatureStream(_stream(_ts,_tf), _ts.fields+_info_fields)
 
 ###############################################################################
+def _weighted_sum(scores,lengths,denom=None):
+    return sum([x*n for x,n in izip(scores,lengths)])
+
+def _weighted_mean(scores,lengths,denom):
+    return _weighted_sum(scores,lengths)*denom
+
+def _weighted_geometric_mean(scores,lengths,denom):
+    return (reduce(lambda x, y: x*y, [x**n for x,n in izip(scores,lengths)]))**denom
+
+def _weighted_median(scores,lengths,denom=None):
+    """Median of the scores, each repeated as many times as its length."""
+    order = sorted(xrange(len(scores)), key=scores.__getitem__)
+    cumlengths = []
+    total = 0
+    for k in order:
+        total += lengths[k]
+        cumlengths.append(total)
+    def _nth(n): return scores[order[bisect.bisect_right(cumlengths,n)]]
+    if total % 2:
+        return _nth((total-1)/2)
+    else:
+        return (_nth(total/2-1)+_nth(total/2))*.5
+
+# Same as _score_functions, on the scores of segments of the given lengths
+_weighted_functions = {'arithmetic':_weighted_mean, 'geometric':_weighted_geometric_mean,
+                       'sum':_weighted_sum, 'mean':_weighted_mean, 'median':_weighted_median,
+                       'min':lambda x,n,denom:_min(x), 'max':lambda x,n,denom:_max(x)}
+
+def _feature_sums(segments, starts, ends):
+    """Sums of the scores of *segments* (dict of 'start','end','score' columns, sorted
+    and not overlapping) on each region [*starts*,*ends*), weighted by the overlap lengths."""
+    if len(segments['start']) == 0:
+        return zeros(len(starts))
+    sstart, send, score = segments['start'], segments['end'], segments['score']
+    cumsums = nconcatenate(([0.],(score*(send-sstart)).cumsum()))
+    first = searchsorted(send,starts,side='right') # first segment ending after the start
+    last = searchsorted(sstart,ends) # first segment starting after the end
+    inside = first < last
+    k = minimum(first,len(sstart)-1)
+    left = where(inside, score[k]*maximum(starts-sstart[k],0), 0) # part of the first segment before the start
+    k = maximum(last-1,0)
+    right = where(inside, score[k]*maximum(send[k]-ends,0), 0) # part of the last segment after the end
+    return (cumsums[last]-cumsums[first])-left-right
+
+_feature_batch = 10000 # number of features per batch in score_by_feature
+
+def _sum_by_feature(ts, tf, mean, fallback):
+    """Sums (means if *mean*) of the scores of the tracks *ts* in each feature of *tf*,
+    by batches of features: each score track is kept in memory only on the region of
+    the current batch, where prefix sums give the sum for all features at once.
+    Calls *fallback* on the remaining rows if the features or the scores are not sorted."""
+    _f = ['start','end','score']
+    chunks = [array_stream(common.select(t,_f)).chunks for t in ts]
+    segments = [dict((f,zeros(0,dtype=float if f == 'score' else int)) for f in _f) for t in ts]
+    last = [-sys.maxint]*len(ts) # end of the last segment of each track
+    lastfeature = -sys.maxint
+    features = array_stream(tf,_feature_batch).chunks
+    for chunk in features:
+        starts, ends = chunk['start'], chunk['end']
+        if len(starts) == 0: continue
+        valid = (starts < ends).all() and (starts[1:] >= starts[:-1]).all() and starts[0] >= lastfeature
+        lastfeature = starts[-1]
+        end = ends.max()
+        for n in xrange(len(ts)):
+            # drop the segments before the batch, load the segments until its end
+            k = searchsorted(segments[n]['end'],starts[0],side='right')
+            segments[n] = dict((f,x[k:]) for f,x in segments[n].iteritems())
+            while valid and chunks[n] is not None and \
+                    (len(segments[n]['start']) == 0 or segments[n]['start'][-1] < end):
+                x = next(chunks[n],None)
+                if x is None:
+                    chunks[n] = None
+                    break
+                if len(x['start']) == 0: continue
+                if not ((x['start'][1:] >= x['end'][:-1]).all() and x['start'][0] >= last[n]):
+                    valid = False
+                last[n] = x['end'][-1]
+                segments[n] = dict((f,nconcatenate((segments[n][f],x[f]))) for f in _f)
+        if not valid:
+            rows = [itertools.chain(_chunk_rows(segments[n],_f),
+                                    itertools.chain.from_iterable(_chunk_rows(c,_f) for c in chunks[n])
+                                    if chunks[n] is not None else ())
+                    for n in xrange(len(ts))]
+            features = itertools.chain(_chunk_rows(chunk,tf.fields),
+                                       itertools.chain.from_iterable(_chunk_rows(c,tf.fields) for c in features))
+            for x in fallback([FeatureStream(r,_f) for r in rows],FeatureStream(features,tf.fields)): yield x
+            return
+        scores = [_feature_sums(x,starts,ends) for x in segments]
+        if mean:
+            denom = 1.0/(ends-starts)
+            scores = [x*denom for x in scores]
+        for x in izip(_chunk_rows(chunk,tf.fields),*[x.tolist() for x in scores]):
+            yield x[0]+x[1:]
+
 def score_by_feature(trackScores,trackFeatures,method='mean'):
     """
     For every feature from *trackFeatures*, get the list of all scores it contains
@@ -194,6 +419,9 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
         Y2: ___222222_____________________333_____________
         R : ______[  30,6  ]______________[  60,9  ]______
 
+    Unless *method* is a custom function, the scores are not expanded base by base: each
+    score segment is weighted by its length, and sums and means are computed with numpy.
+
     :param trackScores: (list of) one or several -sorted- score track(s) (FeatureStream).
     :param trackFeatures: (FeatureStream) one -sorted- feature track.
     :param method: (str of function): operation applied to the list of scores from one feature.
@@ -206,9 +434,10 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
         start_idx = tf.fields.index('start')
         end_idx = tf.fields.index('end')
         if hasattr(method,'__call__'):
-            mean_fn = lambda scores,denom:method(scores)
+            mean_fn = lambda scores,lengths,denom:method(list(itertools.chain.from_iterable(
+                                                       [x]*n for x,n in izip(scores,lengths))))
         else:
-            mean_fn = _score_functions.get(method,_arithmetic_mean)
+            mean_fn = _weighted_functions.get(method,_weighted_mean)
         for y in tf:
             ystart = y[start_idx]
             yend = y[end_idx]
@@ -223,14 +452,17 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
                 while S[i][n][1] <= ystart: n+=1
                 S[i] = S[i][n:]
                 scores_y = []
+                lengths_y = []
                 for s in S[i]:
                     if yend <= s[0]:   continue
                     if s[0] <  ystart: start = ystart
                     else:              start = s[0]
                     if yend <  s[1]:   end   = yend
                     else:              end   = s[1]
-                    scores_y.extend([s[2]]*(end-start))
-                scores += (mean_fn(scores_y,1.0/(yend-ystart)),)
+                    if end > start:
+                        scores_y.append(s[2])
+                        lengths_y.append(end-start)
+                scores += (mean_fn(scores_y,lengths_y,1.0/(yend-ystart)),)
             yield tuple(y)+scores
 
     if not(isinstance(trackScores,(list,tuple))): trackScores = [trackScores]
@@ -241,12 +473,15 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
     else:
         _fields = ["score"]
     _ts = [common.reorder(t,['start','end','score']) for t in trackScores]
+    if method in ['sum','mean','arithmetic']:
+        return FeatureStream(_sum_by_feature(_ts,trackFeatures,method != 'sum',_stream),
+                             trackFeatures.fields+_fields)
     return FeatureStream(_stream(_ts,trackFeatures), trackFeatures.fields+_fields)
 
 ###############################################################################
 @common.ordered
 def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
-                      featurewise=False ):
+                      featurewise=False, chunk_size=None ):
     """
     Given a (list of) signal track(s) *trackList*, a *window_size* L (in base pairs by default,
     or in number of features if *featurewise* is True),  and a *step_size*,
@@ -261,6 +496,10 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
     :param step_size: (int) step length (one score returned per *step_size* positions). [1]
     :param stop_val: (int) sequence length. [sys.maxint]
     :param featurewise: (bool) bp (False), or number of features (True). [False]
+    :param chunk_size: (int) if set (and not *featurewise*), the scores are expanded
+        base by base on chunks of *chunk_size* bp, and the means of all windows of a chunk
+        are differences of cumulative sums; consecutive windows with the same content
+        are merged. [None]
     :rtype: FeatureStream
 
     Example of windows, window_size=9, step_size=3:
@@ -269,8 +508,7 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
     """
     def _stepping_mean(track,score,denom):
         score = 0.0
-        F = []
-        score = 0.0
+        F = deque()
         nmid = window_size/2
         for x in track:
             F.append(x)
@@ -278,18 +516,27 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
             if len(F) < window_size: continue
             yield (F[nmid][0],F[nmid][1],round(score*denom+1e-7,6))+F[nmid][3:]
             for shift in xrange(step_size):
-                score -= F.pop(0)[2]
+                if F: score -= F.popleft()[2]
+
+    def _clipped(start,end,score):
+        """The windows from *start* to *end* with the same *score*, restricted to [0, stop_val)."""
+        if score <= 1e-11: return None
+        if start < 0: start += -(start//step_size)*step_size
+        if end > stop_val: end = start+((stop_val-start)//step_size)*step_size
+        if end <= start: return None
+        return (start,end,score)
 
     def _running_mean(track,win_start,denom):
         score = 0.0
-        F = []
+        F = deque()
         for x in track:
             F.append(x)
             fstart = F[0][0]
             fend = F[0][1]
-            chrom = F[0][3]
+            chrom = F[0][3:4]
             win_start = max(win_start,fstart-window_size)
             win_end = win_start+window_size
+            if (win_start+win_end)/2+step_size > stop_val: break # no more windows to yield
             lstart = F[-1][0]
             lend = F[-1][1]
             while win_end < lend:
@@ -308,22 +555,22 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
                     score += delta*sst
                     for step in xrange(sst,nsteps,step_size):
                         if score>1e-11 and win_center+step>=0 and win_center+step+step_size<=stop_val:
-                            yield (win_center+step,win_center+step+step_size,score,chrom)
+                            yield (win_center+step,win_center+step+step_size,score)+chrom
                         score += delta*step_size
                     score -= delta*sen
                 else:
-                    if score>1e-11 and win_center+sst>=0 and win_center+sen+nsteps<=stop_val:
-                        yield (win_center+sst,win_center+sen+nsteps,score,chrom)
+                    clipped = _clipped(win_center+sst,win_center+sen+nsteps,score)
+                    if clipped: yield clipped+chrom
                 win_start += nsteps
                 win_end += nsteps
                 if fend <= win_start:
-                    F.pop(0)
+                    F.popleft()
                     if F:
                         fstart = F[0][0]
                         fend = F[0][1]
                         win_start = max(win_start,fstart-window_size)
                         win_end = win_start+window_size
-                        if win_end > stop_val: break
+                        if (win_start+win_end)/2+step_size > stop_val: break # no more windows to yield
         while F:
             delta = 0
             steps = [fend-win_start]
@@ -338,35 +585,96 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
                 score += delta*sst
                 for step in xrange(sst,nsteps,step_size):
                     if score>1e-11 and win_center+step>=0 and win_center+step+step_size<=stop_val:
-                        yield (win_center+step,win_center+step+step_size,score,chrom)
+                        yield (win_center+step,win_center+step+step_size,score)+chrom
                     score += delta*step_size
                 score -= delta*sen
             else:
-                if score>1e-11 and win_center+sst>=0 and win_center+sen+nsteps<=stop_val:
-                    yield (win_center+sst,win_center+sen+nsteps,score,chrom)
+                clipped = _clipped(win_center+sst,win_center+sen+nsteps,score)
+                if clipped: yield clipped+chrom
             win_start += nsteps
             win_end += nsteps
             if fend <= win_start:
-                F.pop(0)
+                F.popleft()
                 if F:
                     fstart = F[0][0]
                     fend = F[0][1]
                     win_start = max(win_start,fstart-window_size)
                     win_end = win_start+window_size
-                    if win_end > stop_val: break
+                    if (win_start+win_end)/2+step_size > stop_val: break # no more windows to yield
+
+    def _chunked_mean(track,win_start,denom):
+        L = window_size
+        size = -(-max(chunk_size,1)//step_size)*step_size # chunk of window starts
+        _c = track.fields[3:4]
+        pending = [dict((f,zeros(0,dtype=float if f == 'score' else int)) for f in _f)] # features not behind
+        def _load(end):
+            """Loads the features starting before *end*, at least one if there are any left."""
+            while chunks and (len(pending[0]['start']) == 0 or pending[0]['start'][-1] < end):
+                x = next(chunks[0],None)
+                if x is None:
+                    chunks.pop()
+                    return
+                if len(x['start']) == 0: continue
+                if not chrom: chrom.append(tuple(x[_c[0]][:1].tolist()) if _c else ())
+                pending[0] = dict((f,nconcatenate((pending[0][f],x[f]))) for f in _f)
+        chunks = [array_stream(common.select(track,_f+_c)).chunks]
+        chrom = []
+        start = -sys.maxint # first window start of the chunk
+        row = None # [start, end, score] of the last windows, not yielded yet
+        while True:
+            _load(-sys.maxint)
+            if len(pending[0]['start']) == 0: break
+            # skip the windows without features
+            start = max(start,((pending[0]['start'][0]-L)//step_size)*step_size)
+            if start+L/2 > stop_val: break
+            # the bp grid covers the windows [start-step_size, start+size), the first one
+            # being only compared with the next to merge windows with the same content
+            grid_start = start-step_size
+            grid_end = start+size+L
+            _load(grid_end)
+            keep = pending[0]['end'] > grid_start
+            pending[0] = dict((f,x[keep]) for f,x in pending[0].iteritems())
+            features = pending[0]
+            n = searchsorted(features['start'],grid_end)
+            fstart = maximum(features['start'][:n],grid_start)-grid_start
+            lengths = maximum(minimum(features['end'][:n],grid_end)-grid_start-fstart,0)
+            offsets = lengths.cumsum()-lengths
+            positions = arange(lengths.sum())+(fstart-offsets).repeat(lengths)
+            scores = bincount(positions,weights=features['score'][:n].repeat(lengths),
+                              minlength=grid_end-grid_start)
+            sums = nconcatenate(([0.],scores.cumsum()))
+            idx = arange(0,size+step_size,step_size)
+            means = ((sums[idx+L]-sums[idx])*denom)[1:].tolist()
+            centers = (idx[1:]+grid_start+L/2).tolist()
+            changes = (scores[:size] != scores[L:size+L]) # the bp entering and leaving differ
+            for k in nonzero(add.reduceat(changes,idx[:-1]))[0].tolist(): # window != previous one
+                if row is not None:
+                    if k > 0: row[1] = centers[k-1]+step_size
+                    clipped = _clipped(*row)
+                    if clipped: yield clipped+chrom[0]
+                row = [centers[k],centers[k]+step_size,means[k]]
+            if row is not None: row[1] = centers[-1]+step_size
+            start += size
+        if row is not None:
+            clipped = _clipped(*row)
+            if clipped: yield clipped+chrom[0]
 
     denom = 1.0/window_size
     win_start = -window_size
     _f = ['start','end','score']
     if featurewise:
         call = _stepping_mean
+    elif chunk_size:
+        call = _chunked_mean
     else:
         call = _running_mean
+    def _smoothed(t):
+        t = common.reorder(t,_f)
+        return FeatureStream(call(t,win_start,denom),fields=t.fields if featurewise else _f+t.fields[3:4])
     if isinstance(trackList,(list,tuple)):
-        return [FeatureStream(call(common.reorder(t,_f),win_start,denom),fields=_f)
-                for n,t in enumerate(trackList)]
+        return [_smoothed(t) for t in trackList]
     else:
-        return FeatureStream(call(common.reorder(trackList,_f),win_start,denom),fields=_f)
+        return _smoothed(trackList)
 
 ###############################################################################
 def normalize(trackList,method='total',field='score'):
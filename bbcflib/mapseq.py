@@ -1183,6 +1183,7 @@ def parallel_density_sql( ex, bamfile, chromosomes,
     touch(ex,output)
     trackargs = {'fields': ['start','end','score'],
                  'chrmeta': chromosomes,
+                 'bulk': True,
                  'info': {'datatype':'quantitative',
                           'nreads': nreads,
                           'read_extension': read_extension}}
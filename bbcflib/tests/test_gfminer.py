@@ -1,16 +1,17 @@
 # Built-in modules #
-import math
+import math, os, sys, time, itertools
 
 # Internal modules #
 from bbcflib import genrep
-from bbcflib.track import track, FeatureStream as fstream
-from bbcflib.gfminer.common import sentinelize, copy, select, reorder, unroll, sorted_stream
+from bbcflib.track import track, FeatureStream as fstream, ArrayFeatureStream, array_stream
+from bbcflib.gfminer.common import sentinelize, copy, select, reorder, unroll, unroll_runs, sorted_stream
 from bbcflib.gfminer.common import shuffled, fusion, cobble, ordered, apply, duplicate
 from bbcflib.gfminer.common import concat_fields, split_field, map_chromosomes, score_threshold
+from bbcflib.gfminer.common import generic_merge, strand_merge
 from bbcflib.gfminer.stream import getNearestFeature, concatenate, neighborhood, segment_features, intersect
 from bbcflib.gfminer.stream import selection, exclude, require, disjunction, intersection, union, combine
 from bbcflib.gfminer.stream import overlap, merge_scores, score_by_feature, window_smoothing, filter_scores, normalize
-from bbcflib.gfminer.numeric import feature_matrix, summed_feature_matrix, vec_reduce, correlation
+from bbcflib.gfminer.numeric import feature_matrix, summed_feature_matrix, vec_reduce, correlation, score_array
 
 # Other modules #
 import numpy
@@ -306,9 +307,47 @@ class Test_Intervals(unittest.TestCase):
         stream1 = fstream(s1, fields=['chr','start','end','score','name'])
         stream2 = fstream(s2, fields=['chr','start','end','score','name'])
         res = list(concatenate([stream1,stream2], fields=['chr','start','score','name'], group_by=group_by, aggregate=aggregate))
-        expected = [('chr',1,4,0.8,'m-n'),('chr',5,9,0.5,'n'),('chr',8,11,0.4,'m'),('chr',11,15,1.2,'n'),('chrX',11,15,0.1,'m')]
+        expected = [('chr',1,4,0.8,'n-m'),('chr',5,9,0.5,'n'),('chr',8,11,0.4,'m'),('chr',11,15,1.2,'n'),('chrX',11,15,0.1,'m')]
         self.assertListEqual(sorted(res),sorted(expected))
 
+    def test_concatenate_order(self):
+        import random
+        random.seed(4)
+        # Ties on (start,end) come in the order of the tracks
+        s1 = fstream([(1,4,'a'),(1,4,'z'),(6,8,'b')], fields=['start','end','name'])
+        s2 = fstream([(1,4,'c'),(1,5,'d'),(6,8,'b')], fields=['start','end','name'])
+        s3 = fstream([(0,4,'e'),(1,4,'a')], fields=['start','end','name'])
+        res = list(concatenate([s1,s2,s3]))
+        expected = [(0,4,'e'),(1,4,'a'),(1,4,'z'),(1,4,'c'),(1,4,'a'),(1,5,'d'),(6,8,'b'),(6,8,'b')]
+        self.assertListEqual(res,expected)
+        s1 = fstream([(1,4,'a'),(1,4,'z'),(6,8,'b')], fields=['start','end','name'])
+        s2 = fstream([(1,4,'c'),(1,5,'d'),(6,8,'b')], fields=['start','end','name'])
+        s3 = fstream([(0,4,'e'),(1,4,'a')], fields=['start','end','name'])
+        res = list(concatenate([s1,s2,s3],remove_duplicates=True))
+        expected = [(0,4,'e'),(1,4,'a'),(1,4,'z'),(1,4,'c'),(1,5,'d'),(6,8,'b')]
+        self.assertListEqual(res,expected)
+
+        # Chromosomes in the order of the tracks, even if some are missing
+        chroms = ['chr1','chr2','chr10']
+        s1 = fstream([('chr1',5,6),('chr2',1,2),('chr10',3,4)], fields=['chr','start','end'])
+        s2 = fstream([('chr2',0,2),('chr10',1,2)], fields=['chr','start','end'])
+        s3 = fstream([('chr1',1,9)], fields=['chr','start','end'])
+        res = list(concatenate([s1,s2,s3]))
+        expected = [('chr1',1,9),('chr1',5,6),('chr2',0,2),('chr2',1,2),('chr10',1,2),('chr10',3,4)]
+        self.assertListEqual(res,expected)
+
+        # Same as sorting all features by (chr,start,end,track index)
+        tracks = []
+        for n in xrange(20):
+            rows = sorted((chroms.index(c),x,x+random.randint(0,5),random.random())
+                          for c in chroms for x in random.sample(range(50),random.randint(0,10)))
+            tracks.append([(chroms[c],x,y,v) for c,x,y,v in rows])
+        expected = sorted((chroms.index(x[0]),x[1],x[2],n,k,x) for n,rows in enumerate(tracks)
+                          for k,x in enumerate(rows))
+        expected = [x[-1] for x in expected]
+        res = list(concatenate([fstream(rows,fields=['chr','start','end','score']) for rows in tracks]))
+        self.assertListEqual(res,expected)
+
     def test_selection(self):
         s = [('chr1',1,3,0.2,'a'), ('chr2',5,9,0.5,'b'), ('chr2',11,15,1.2,'c')]
 
@@ -341,6 +380,37 @@ class Test_Intervals(unittest.TestCase):
         expected = [('chr',0,3,'+'),('chr',7,12,'+')]
         self.assertListEqual(list(res),expected)
 
+    def test_overlap_sweep(self):
+        import random
+        random.seed(6)
+        # A long feature does not hide the short ones after it
+        s1 = [(0,100,'long'),(10,20,'short'),(55,58,'inside')]
+        s2 = [(50,60,'f')]
+        res = list(overlap(fstream(s1,fields=['start','end','name']),fstream(s2,fields=['start','end','name'])))
+        self.assertListEqual(res, [(0,100,'long'),(55,58,'inside')])
+        res = list(overlap(fstream(s1,fields=['start','end','name']),fstream(s2,fields=['start','end','name']),
+                           strict=True))
+        self.assertListEqual(res, [(0,100,'long')])
+
+        # Same as comparing all pairs
+        def _random(n,length):
+            starts = sorted(random.randint(0,1000) for k in xrange(n))
+            return [(x,x+random.randint(1,length),random.choice('+-')) for x in starts]
+        fields = ['start','end','strand']
+        for n1,l1,n2,l2 in [(200,10,20,200),(20,200,200,10),(100,50,100,50)]:
+            s1 = _random(n1,l1)
+            s2 = _random(n2,l2)
+            for strict in [False,True]:
+                if strict: olap = lambda x,y: x[0] <= y[0] and y[1] <= x[1]
+                else: olap = lambda x,y: x[0] < y[1] and y[0] < x[1]
+                expected = [x for x in s1 if any(olap(x,y) for y in s2)]
+                res = overlap(fstream([x[:2] for x in s1],fields=fields[:2]),
+                              fstream([y[:2] for y in s2],fields=fields[:2]),strict=strict)
+                self.assertListEqual(list(res), [x[:2] for x in expected])
+                expected = [x for x in s1 if any(olap(x,y) and x[2]==y[2] for y in s2)]
+                res = overlap(fstream(s1,fields=fields),fstream(s2,fields=fields),strict=strict)
+                self.assertListEqual(list(res), expected)
+
     def test_neighborhood(self):
         s = [(10,16,0.5,-1), (24,36,1.2,1)]
 
@@ -441,6 +511,37 @@ class Test_Intervals(unittest.TestCase):
         expected = [('chr',20,40,'0','0','0')]
         self.assertListEqual(res,expected)
 
+    def test_combine_sweep(self):
+        # Same as evaluating *fn* between every two consecutive boundaries
+        import random
+        random.seed(19)
+        fields = ['chr','start','end','name','score']
+        def _random(n):
+            rows = []
+            x = random.randint(0,100)
+            for k in xrange(n):
+                length = random.randint(1,random.choice([5,50,500]))
+                rows.append(('chr1',x,x+length,'n%i'%x,float(random.randint(1,9))))
+                x += length+random.choice([0,1,10,100])
+            return rows
+        fns = [union, intersection, lambda x:exclude(x,[1]), lambda x:require(x,[0]),
+               lambda x:disjunction(x,[0,2]), lambda x:not any(x)]
+        for trial in xrange(20):
+            tracks = [_random(random.choice([0,5,30])) for n in xrange(random.randint(3,6))]
+            bounds = sorted(set(y for t in tracks for x in t for y in x[1:3]))
+            for fn in fns:
+                expected = []
+                for a,b in zip(bounds[:-1],bounds[1:]):
+                    active = [[x for x in t if x[1] < b and a < x[2]] for t in tracks]
+                    if not fn([bool(x) for x in active]): continue
+                    active = [x[0] for x in active if x]
+                    if not active: expected.append(('chr1',a,b,'0','0'))
+                    elif len(active) == 1: expected.append(('chr1',a,b)+active[0][3:])
+                    else: expected.append(('chr1',a,b,'|'.join(x[3] for x in active),sum(x[4] for x in active)))
+                for win_size in [1,1000]:
+                    res = list(combine([fstream(t,fields=fields) for t in tracks],fn,win_size=win_size))
+                    self.assertListEqual(res,expected)
+
 
 class Test_Scores(unittest.TestCase):
     def setUp(self):
@@ -466,6 +567,42 @@ class Test_Scores(unittest.TestCase):
         expected = [(5,10,2.),(10,15,8.),(15,20,6.)]
         self.assertListEqual(res,expected)
 
+    def test_merge_scores_windows(self):
+        # Compare with the sweep over the features, used for custom functions
+        import random
+        from bbcflib.gfminer.stream import scores
+        random.seed(9)
+        def _random(overlapping=False):
+            rows = []
+            x = random.randint(0,10)
+            for k in xrange(random.randint(0,30)):
+                length = random.randint(1,8)
+                rows.append(('chr1',x,x+length,random.choice([0.,1.5,-2.,10*random.random()]),
+                             random.choice('ab')))
+                x = max(x+length+random.choice([0,0,1,5]+[-3]*overlapping),x)
+            return rows
+        max_cells = scores._max_cells
+        try:
+            for trial in xrange(40):
+                overlapping = trial%8 == 0
+                tracks = [_random(overlapping and n == 0) for n in xrange(random.randint(1,5))]
+                fields = random.choice([['chr','start','end','score','name'],['start','end','score']])
+                methods = ['arithmetic','sum','min','max']+['median','geometric']*(not overlapping)
+                for method in methods:
+                    if method == 'geometric':
+                        tracks = [[x[:3]+(abs(x[3]),)+x[4:] for x in t] for t in tracks]
+                    fn = lambda x,f=scores._score_functions[method],d=1./len(tracks): f(x,d)
+                    def _streams(arrays):
+                        s = [fstream([x if len(fields) == 5 else x[1:4] for x in t],fields=fields) for t in tracks]
+                        if arrays: return [array_stream(x,7) for x in s]
+                        return s
+                    expected = list(merge_scores(_streams(False),fn))
+                    for scores._max_cells in [max_cells,100,10]:
+                        self.assertListEqual(list(merge_scores(_streams(False),method)),expected)
+                        self.assertListEqual(list(merge_scores(_streams(True),method)),expected)
+        finally:
+            scores._max_cells = max_cells
+
     def test_filter_scores(self):
         features = fstream([(5,15,'gene1'),(30,40,'gene2')], fields=['start','end','name'])
         scores = fstream([(10,20,6.),(30,40,6.)], fields=['start','end','score'])
@@ -511,12 +648,155 @@ class Test_Scores(unittest.TestCase):
         expected = [('chr',5,15,'gene1',30.,6.),('chr',30,40,'gene2',60.,9.)]
         self.assertListEqual(res,expected)
 
+    def test_score_by_feature_weighted(self):
+        # Compare with custom functions, which get the scores base by base
+        import random
+        from bbcflib.gfminer.stream import scores
+        random.seed(11)
+        def _random(overlapping=False):
+            rows = []
+            x = 0
+            while x < 300:
+                length = random.randint(1,8)
+                rows.append((x,x+length,random.choice([0.,1.5,-2.,10*random.random()])))
+                x = max(x+length+random.choice([0]+[-3]*overlapping),x)
+            return rows
+        feature_batch = scores._feature_batch
+        try:
+            for trial in xrange(30):
+                tracks = [_random(trial%5 == 0 and n == 0) for n in xrange(random.randint(1,3))]
+                features = sorted((x,x+random.randint(1,random.choice([3,20,100])),'n%i'%x)
+                                  for x in random.sample(xrange(200),random.randint(0,20)))
+                def _streams(arrays):
+                    s = [fstream(t,fields=['start','end','score']) for t in tracks]
+                    f = fstream(features,fields=['start','end','name'])
+                    if arrays: return [array_stream(x,7) for x in s], array_stream(f,5)
+                    return s, f
+                for method in ['sum','mean','median','min','max']:
+                    fn = scores._score_functions['sum' if method == 'mean' else method]
+                    expected = list(score_by_feature(*_streams(False),method=lambda x:fn(x,None)))
+                    if method == 'mean':
+                        expected = [x[:3]+tuple([y/(x[1]-x[0]) for y in x[3:]]) for x in expected]
+                    for scores._feature_batch in [feature_batch,3]:
+                        for arrays in [False,True]:
+                            res = list(score_by_feature(*_streams(arrays),method=method))
+                            self.assertListEqual([x[:3] for x in res],[x[:3] for x in expected])
+                            assert_almost_equal([x[3:] for x in res],[x[3:] for x in expected])
+        finally:
+            scores._feature_batch = feature_batch
+
     def test_window_smoothing(self):
         stream = fstream([('chr1',4,5,10.)], fields=['chr','start','end','score'])
         res = list(window_smoothing(stream, window_size=2, step_size=1))
         expected = [('chr1',4,5,5.),('chr1',5,6,5.)]
         self.assertListEqual(res,expected)
 
+    def test_window_smoothing_chunks(self):
+        # The windows of the chunked path have the same means, base by base
+        import random
+        random.seed(13)
+        fields = ['chr','start','end','score']
+        def _expand(rows):
+            return dict((p,x[3]) for x in rows for p in xrange(x[1],x[2]))
+        # Windows overlapping position 0, or *stop_val*, are kept if their center is in range
+        rows = [('chr1',0,2,5.),('chr1',16,22,4.),('chr1',40,45,1.)]
+        for window_size,step_size,expected in [(5,1,{2:2.}),(20,7,dict((p,.5) for p in xrange(3,10)))]:
+            for chunk_size in [None,1000]:
+                res = _expand(window_smoothing(fstream(rows,fields=fields),window_size,step_size,chunk_size=chunk_size))
+                assert_almost_equal([res.get(p) for p in sorted(expected)],[expected[p] for p in sorted(expected)])
+        for trial in xrange(40):
+            rows = []
+            x = random.randint(0,50) if trial%2 else random.randint(0,3)
+            while x < 500:
+                length = random.randint(1,10)
+                rows.append(('chr1',x,x+length,random.choice([1.,2.5,10*random.random()])))
+                x += length+random.choice([0,0,3,60])
+            window_size = random.randint(1,40)
+            step_size = random.choice([1,3,window_size+5])
+            stop_val = random.choice([sys.maxint,250,503])
+            expected = _expand(window_smoothing(fstream(rows,fields=fields),window_size,step_size,stop_val))
+            for chunk_size in [7,1000]:
+                res = list(window_smoothing(array_stream(fstream(rows,fields=fields),5),
+                                            window_size,step_size,stop_val,chunk_size=chunk_size))
+                self.assertTrue(all(x[0] == 'chr1' for x in res))
+                res = _expand(res)
+                self.assertListEqual(sorted(res),sorted(expected))
+                assert_almost_equal([res[p] for p in sorted(res)],[expected[p] for p in sorted(expected)])
+
+class Test_Arrays(unittest.TestCase):
+    """Operations on an ArrayFeatureStream give the same features as on a FeatureStream."""
+    def setUp(self):
+        import random
+        random.seed(3)
+        self.fields = ['chr','start','end','score','name']
+        self.rows = [('chr%i'%(k%3),k,k+random.randint(1,20),random.randint(-5,5)/2.,'n%i'%k)
+                     for k in xrange(50)]
+
+    def _compare(self, fn):
+        expected = list(fn(fstream(self.rows,fields=self.fields)))
+        for size in [7,100]:
+            stream = fn(array_stream(fstream(self.rows,fields=self.fields),size=size))
+            self.assertIsInstance(stream,ArrayFeatureStream)
+            res = list(stream)
+            self.assertListEqual(res,expected)
+            self.assertListEqual(map(lambda x:map(type,x),res), map(lambda x:map(type,x),expected))
+
+    def test_array_stream(self):
+        stream = array_stream(fstream(self.rows,fields=self.fields),size=7)
+        self.assertIs(array_stream(stream),stream)
+        chunk = stream.chunks.next()
+        self.assertListEqual(chunk['start'].tolist(), range(7))
+        self.assertEqual(chunk['score'].dtype.kind, 'f')
+        self.assertEqual(chunk['chr'].dtype.kind, 'O')
+        self.assertListEqual(list(stream), self.rows[7:])
+
+    def test_select(self):
+        self._compare(lambda s: select(s,['name','start']))
+        self._compare(lambda s: select(s,['start','end'],{'chr':['chr0','chr2']}))
+        self._compare(lambda s: select(s,None,{'chr':'chr1','start':lambda x:x>20}))
+        self._compare(lambda s: select(s,None,{'chr':'chr1','score':[0.,1.5]}))
+        self._compare(lambda s: select(s,['name'],{'name':lambda x:x.endswith('5')}))
+        self._compare(lambda s: select(s,None,{'chr':'chrX'}))
+
+    def test_reorder(self):
+        self._compare(lambda s: reorder(s,['name','score']))
+        self._compare(lambda s: reorder(s,['chr','end'],last=True))
+        self._compare(lambda s: reorder(s,['chr','start']))
+        stream = fstream(self.rows,fields=self.fields)
+        self.assertIs(reorder(stream,['chr','start']),stream)
+        self.assertIs(reorder(stream,['score','name'],last=True),stream)
+        self.assertIs(select(stream,self.fields),stream)
+        self.assertListEqual(list(select(stream,['score'])), [(x[3],) for x in self.rows])
+        # Blocks are kept
+        stream = fstream(iter([self.rows[:20],self.rows[20:]]),fields=self.fields,blocks=True)
+        stream = reorder(stream,['end','start'])
+        self.assertListEqual(stream.fields, ['end','start','chr','score','name'])
+        self.assertListEqual(map(len,stream.batches()), [20,30])
+
+    def test_apply(self):
+        self._compare(lambda s: apply(s,'score',lambda x:2*x))
+        self._compare(lambda s: apply(s,['start','name'],[lambda x:x+1,str.upper]))
+        self._compare(lambda s: apply(s,'score',lambda x:round(x+.3)))
+        self._compare(lambda s: apply(s,'chr',lambda x:x.replace('chr','')))
+
+    def test_score_threshold(self):
+        self._compare(lambda s: score_threshold(s))
+        self._compare(lambda s: score_threshold(s,threshold=1.,lower=True,strict=True))
+        self._compare(lambda s: score_threshold(s,threshold=30,fields=['start','end']))
+
+    def test_scores(self):
+        # Operations not vectorized yet read the arrays as tuples
+        def _streams(arrays):
+            s1 = fstream([('chr',10,20,6.),('chr',30,40,6.)], fields=['chr','start','end','score'])
+            s2 = fstream([('chr',5,15,2.),('chr',32,38,1.)], fields=['chr','start','end','score'])
+            if arrays: return [array_stream(s1),array_stream(s2)]
+            return [s1,s2]
+        self.assertListEqual(list(merge_scores(_streams(True))), list(merge_scores(_streams(False))))
+        features = [('chr',5,15,'gene1'),('chr',30,40,'gene2')]
+        res = [list(score_by_feature(_streams(arrays),fstream(features,fields=['chr','start','end','name'])))
+               for arrays in [True,False]]
+        self.assertListEqual(res[0],res[1])
+
 
 ################### NUMERIC ######################
 
@@ -595,6 +875,48 @@ class Test_Signal(unittest.TestCase):
         expected = [32.,128.,8.]
         self.assertListEqual(scores,expected)
 
+    def test_score_array(self):
+        s1 = fstream([('a',1.,2.),('b',3.,4.)], fields=['name','score','other'])
+        s2 = fstream([('b',5.),('a',6.)], fields=['name','score'])
+        nums,labs = score_array([s1,s2])
+        self.assertListEqual(labs.tolist(), ['a','b'])
+        self.assertListEqual(nums.tolist(), [[1.,6.],[3.,5.]])
+
+    def test_unroll_array(self):
+        # A synthetic chromosome unrolled as an array, a run-length encoding and tuples
+        import random
+        random.seed(15)
+        rows = []
+        x = 0
+        for chrom in ['chr1','chr2']:
+            x = random.randint(0,10)
+            while x < 5000:
+                length = random.randint(1,50)
+                rows.append((chrom,x,x+length,random.random(),float(length)))
+                x += length+random.choice([0,0,30,-10])
+        rows.sort()
+        fields = ['chr','start','end','score','length']
+        for regions in [(-20,5100),[(100,900),(850,2000),(4990,5200)],[('chr1',10,600),('chr2',0,3000)]]:
+            for _fields in [['score'],['score','length']]:
+                def _regions():
+                    if isinstance(regions[0],tuple) and len(regions[0]) == 3: return fstream(regions,fields=['chr','start','end'])
+                    return regions
+                item0 = (0,)+(None,)*(len(_fields)-1)
+                expected = [(0,)*len(_fields) if x == item0 else x[:len(_fields)]
+                            for x in unroll(fstream(rows,fields=fields),_regions(),_fields)]
+                expected = numpy.array(expected).reshape(len(expected),len(_fields)).squeeze()
+                res = unroll(fstream(rows,fields=fields),_regions(),_fields,as_array=True)
+                self.assertEqual(res.shape,expected.shape)
+                self.assertTrue((res == expected).all())
+                res = unroll(fstream(rows,fields=fields),_regions(),_fields,as_array=True,dtype='float32')
+                self.assertEqual(res.dtype,numpy.float32)
+                assert_almost_equal(res,expected,decimal=6)
+                starts,lengths,values = unroll_runs(fstream(rows,fields=fields),_regions(),_fields)
+                res = numpy.zeros(expected.shape)
+                for start,length,value in zip(starts,lengths,values): res[start:start+length] = value
+                self.assertTrue((res == expected).all())
+                self.assertTrue((lengths > 0).all())
+
     def test__normalize(self):
         x = [1,2,3,4,5] # mean=15/5=3, var=(1/5)*(4+1+0+1+4)=2
         assert_almost_equal(vec_reduce(x), numpy.array([-2,-1,0,1,2])*(1/math.sqrt(2)))
@@ -660,6 +982,37 @@ class Test_Signal(unittest.TestCase):
 
 
 # From old rnaseq.fusion
+    def test_correlation_chunks(self):
+        # Same correlations by blocks, on regions short enough not to be cut to a power of 2
+        import random
+        random.seed(17)
+        def _random(length):
+            rows = []
+            x = random.randint(0,30)
+            while x < length:
+                size = random.randint(1,30)
+                rows.append(('chr1',x,x+size,random.choice([1.,5*random.random()])))
+                x += size+random.choice([0,3,40])
+            return rows
+        for regions,limits in [((0,700),(-20,20)),([(10,200),(300,700)],(-100,50)),((0,300),(0,30)),
+                               (fstream([('chr1',5,300),('chr1',400,600)],fields=['chr','start','end']),(-5,-1))]:
+            tracks = [_random(1000) for n in xrange(3)]
+            if isinstance(regions,fstream): regions = list(regions)
+            def _regions():
+                if isinstance(regions,list) and len(regions[0]) == 3:
+                    return fstream(regions,fields=['chr','start','end'])
+                return regions
+            for ntracks,with_acf in [(2,False),(3,False),(3,True)]:
+                def _tracks(): return [fstream(t,fields=['chr','start','end','score']) for t in tracks[:ntracks]]
+                expected = correlation(_tracks(),_regions(),limits,with_acf)
+                for chunk_size in [1,64,5000]:
+                    res = correlation(_tracks(),_regions(),limits,with_acf,chunk_size=chunk_size)
+                    if ntracks == 2 and not with_acf:
+                        assert_almost_equal(res,expected,decimal=5)
+                    else:
+                        self.assertListEqual(map(len,res),map(len,expected))
+                        for r,e in zip(res,expected): assert_almost_equal(r,e,decimal=5)
+
 class Test_Cobble(unittest.TestCase):
     def commonTest(self,X,R):
         T = list(cobble(fstream(X,fields=['chr','start','end','score'])))
@@ -761,3 +1114,246 @@ class Test_Cobble(unittest.TestCase):
         X = [(c,5,10,8.),(c,5,25,5.),(c,20,30,4.),(c,35,40,3.),(c,35,45,2.)]
         R = [(c,5,10,13.),(c,10,20,5.),(c,20,25,9.),(c,25,30,4.),(c,35,40,5.),(c,40,45,2.)]
         self.commonTest(X,R)
+
+    def test_cobble_sweep(self):
+        # Compare with the fragments between all boundaries, merging the fields pairwise
+        import random
+        random.seed(8)
+        fields = ['chr','start','end','score','name','strand']
+        merges = [generic_merge,generic_merge,strand_merge]
+        def _reference(X,stranded,scored):
+            res = []
+            for c,strand in set((x[0],x[5] if stranded else None) for x in X):
+                group = [x for x in X if x[0] == c and (strand is None or x[5] == strand)]
+                bounds = sorted(set([x[1] for x in group]+[x[2] for x in group]))
+                for b0,b1 in zip(bounds[:-1],bounds[1:]):
+                    cover = [x for x in group if x[1] <= b0 and x[2] >= b1]
+                    if not cover: continue
+                    y = [reduce(lambda a,b: m((a,b)), [x[k+3] for x in cover])
+                         for k,m in enumerate(merges)]
+                    if scored:
+                        y[0] = sum(x[3]*(b1-b0)/(x[2]-x[1]) for x in cover)
+                    res.append((c,b0,b1)+tuple(y))
+            return sorted(res)
+        for trial in xrange(300):
+            X = sorted((random.choice(['chr1','chr2']),x,x+random.randint(1,15),
+                        random.choice([1.,2.5,4.]),'n%i'%x,random.choice([1,-1]))
+                       for x in random.sample(xrange(60),random.randint(0,15)))
+            for stranded in [False,True]:
+                for scored in [False,True]:
+                    res = list(cobble(fstream(X,fields=fields),stranded=stranded,scored=scored))
+                    self.assertListEqual([x[:3] for x in res],sorted(x[:3] for x in res))
+                    expected = _reference(X,stranded,scored)
+                    # scores from a running sum: equal up to rounding
+                    self.assertListEqual([x[:3]+x[4:] for x in sorted(res)],[x[:3]+x[4:] for x in expected])
+                    for x,y in zip(sorted(res),expected): self.assertAlmostEqual(x[3],y[3])
+
+    def test_fusion(self):
+        X = [('chr1',10,15,'A',1),('chr1',13,18,'B',-1),('chr1',14,16,'C',1),('chr1',18,25,'D',-1),
+             ('chr2',20,22,'E',1),('chr2',21,30,'F',1)]
+        res = list(fusion(fstream(X,fields=['chr','start','end','name','strand'])))
+        self.assertListEqual(res,[('chr1',10,18,'A|B|C',0),('chr1',18,25,'D',-1),('chr2',20,30,'E|F',1)])
+
+
+###########################################################################
+
+
+@unittest.skipUnless(os.environ.get('BBCF_BENCHMARK'), "Set BBCF_BENCHMARK=1 to run benchmarks.")
+class Test_Benchmark(unittest.TestCase):
+    def test_reorder(self):
+        nrows = 10000000
+        fields = ['chr','start','end','score','name']
+        row = ('chr1',10,20,1.,'n')
+        def _stream():
+            return fstream(itertools.repeat(row,nrows),fields=fields)
+        _inds = [2,1,0,3,4]
+        t1 = time.time()
+        n1 = sum(1 for x in (tuple(x[n] for n in _inds) for x in _stream())) # former reorder
+        t2 = time.time()
+        n2 = sum(1 for x in reorder(_stream(),['end','start']))
+        t3 = time.time()
+        n3 = sum(1 for x in reorder(_stream(),['chr','start']))
+        t4 = time.time()
+        self.assertEqual(n1,n2)
+        print "\nreorder of %i rows: %.1fs before, %.1fs with itemgetter, %.1fs if already ordered" \
+              % (nrows,t2-t1,t3-t2,t4-t3)
+        self.assertLess(t3-t2,t2-t1)
+
+    def test_concatenate(self):
+        import random
+        random.seed(5)
+        nrows = 1000000
+        fields = ['chr','start','end','score']
+        times = []
+        for ntracks in [5,50]:
+            tracks = [[('chr1',x,x+random.randint(1,100),1.)
+                       for x in sorted(random.randint(0,10**8) for k in xrange(nrows//ntracks))]
+                      for n in xrange(ntracks)]
+            t1 = time.time()
+            n = sum(1 for x in concatenate([fstream(t,fields=fields) for t in tracks]))
+            times.append(time.time()-t1)
+            self.assertEqual(n,nrows)
+        print "\nconcatenate %i rows: %.1fs from 5 tracks, %.1fs from 50 tracks" % (nrows,times[0],times[1])
+        self.assertLess(times[1],3*times[0])
+
+    def test_overlap(self):
+        import random
+        random.seed(7)
+        fields = ['start','end']
+        short = sorted(random.randint(0,10**8) for k in xrange(1000000))
+        short = [(x,x+random.randint(20,100)) for x in short]
+        long = sorted(random.randint(0,10**8) for k in xrange(20000))
+        long = [(x,x+random.randint(1000,50000)) for x in long]
+        def _expected(s1,s2):
+            """Features of s1 overlapping the union of s2, with numpy."""
+            starts = numpy.array([y[0] for y in s2])
+            ends = numpy.maximum.accumulate([y[1] for y in s2])
+            x = numpy.array(s1)
+            n = numpy.searchsorted(ends,x[:,0],side='right') # first feature of s2 ending after x
+            n = numpy.minimum(n,len(s2)-1)
+            keep = (ends[n] > x[:,0]) & (starts[n] < x[:,1])
+            return [s1[k] for k in numpy.nonzero(keep)[0]]
+        times = []
+        for s1,s2 in [(short,long),(long,short)]:
+            t1 = time.time()
+            res = list(overlap(fstream(s1,fields=fields),fstream(s2,fields=fields)))
+            times.append(time.time()-t1)
+            self.assertListEqual(res,_expected(s1,s2))
+        print "\noverlap of 1M short features with 20k long ones: %.1fs, and of the long ones " \
+              "with the short ones: %.1fs" % tuple(times)
+
+    def test_cobble(self):
+        n = 10000
+        fields = ['chr','start','end','score']
+        nested = [('chr1',k,2*n-k,1.) for k in xrange(n)]
+        staggered = [('chr1',k,k+n,1.) for k in xrange(n)]
+        times = []
+        for X in [nested,staggered]:
+            t1 = time.time()
+            res = list(cobble(fstream(X,fields=fields)))
+            times.append(time.time()-t1)
+            self.assertEqual(len(res),2*n-1)
+            self.assertEqual(res[n-1],('chr1',n-1,n+1,float(n)) if X is nested else ('chr1',n-1,n,float(n)))
+        t1 = time.time()
+        res = list(cobble(fstream(nested,fields=fields),scored=True))
+        times.append(time.time()-t1)
+        self.assertAlmostEqual(res[n-1][3],sum(2./(2*n-2*k) for k in xrange(n)))
+        print "\ncobble of %i nested features: %.1fs (scored: %.1fs), of %i staggered features: %.1fs" \
+              % (n,times[0],times[2],n,times[1])
+
+    def test_merge_scores(self):
+        import random
+        random.seed(10)
+        fields = ['start','end','score']
+        def _random(n):
+            rows = []
+            x = 0
+            for k in xrange(n):
+                length = random.randint(1,50)
+                rows.append((x,x+length,random.random()))
+                x += length+random.randint(0,20)
+            return rows
+        tracks = [_random(100000) for n in xrange(10)]
+        t1 = time.time()
+        res = list(merge_scores([fstream(t,fields=fields) for t in tracks],lambda x:sum(x)*.1)) # sweep
+        t2 = time.time()
+        self.assertListEqual(list(merge_scores([fstream(t,fields=fields) for t in tracks])),res)
+        t3 = time.time()
+        print "\nmerge_scores of 10 tracks of 100k features: %.1fs before, %.1fs with numpy" % (t2-t1,t3-t2)
+        self.assertLess(t3-t2,t2-t1)
+
+    def test_score_by_feature(self):
+        import random
+        random.seed(12)
+        scores = []
+        x = 0
+        for k in xrange(1000000):
+            length = random.randint(1,20)
+            scores.append((x,x+length,random.random()))
+            x += length
+        features = sorted((y,y+random.randint(5000,100000),'g') for y in random.sample(xrange(x-100000),1000))
+        times = []
+        for method in ['mean',lambda x:sum(x)]: # the scores of custom functions are expanded base by base
+            t1 = time.time()
+            res = list(score_by_feature(fstream(scores,fields=['start','end','score']),
+                                        fstream(features,fields=['start','end','name']),method=method))
+            times.append(time.time()-t1)
+            if method == 'mean': means = [x[3] for x in res]
+        assert_almost_equal(means,[x[3]/(x[1]-x[0]) for x in res])
+        print "\nscore_by_feature of 1000 features of 5-100kb on 1M scores: %.1fs for the mean, " \
+              "%.1fs base by base" % tuple(times)
+        self.assertLess(times[0],times[1])
+
+    def test_window_smoothing(self):
+        import random
+        random.seed(14)
+        rows = [('chr1',x,x+1,float(random.randint(1,20))) for x in xrange(300000)]
+        times = []
+        for chunk_size in [None,100000]:
+            t1 = time.time()
+            res = list(window_smoothing(fstream(rows,fields=['chr','start','end','score']),
+                                        100000,1000,chunk_size=chunk_size))
+            times.append(time.time()-t1)
+        print "\nwindow_smoothing of 300k scores by windows of 100kb: %.1fs by events, " \
+              "%.1fs by chunks" % tuple(times)
+        self.assertLess(times[1],times[0])
+
+    def test_unroll(self):
+        import random
+        random.seed(16)
+        rows = []
+        x = 0
+        while x < 5000000:
+            length = random.randint(1,100)
+            rows.append((x,x+length,random.random()))
+            x += length+random.randint(0,100)
+        t1 = time.time()
+        expected = numpy.array([y[0] for y in unroll(fstream(rows,fields=['start','end','score']),(0,x))])
+        t2 = time.time()
+        res = unroll(fstream(rows,fields=['start','end','score']),(0,x),as_array=True)
+        t3 = time.time()
+        self.assertTrue((res == expected).all())
+        print "\nunroll of 5Mb with %i scores: %.1fs as tuples, %.1fs as an array" % (len(rows),t2-t1,t3-t2)
+        self.assertLess(t3-t2,t2-t1)
+
+    def test_correlation(self):
+        import random, resource
+        random.seed(18)
+        def _random(length):
+            rows = []
+            x = 0
+            while x < length:
+                size = random.randint(50,500)
+                rows.append((x,x+size,random.random()))
+                x += size+random.randint(0,500)
+            return rows
+        def _peak(length,chunk_size):
+            tracks = [fstream([x for x in t if x[1] <= length],fields=['start','end','score']) for t in rows]
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            correlation(tracks,(0,length),(-1000,1000),chunk_size=chunk_size)
+            return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss)/1024.
+        rows = [_random(50000000) for n in xrange(2)]
+        chunked = _peak(50000000,2**20) # first, the peak resident memory can only grow
+        whole = _peak(5000000,None)
+        print "\ncorrelation peak memory: %.0fMb on 50Mb by chunks, %.0fMb on 5Mb at once" % (chunked,whole)
+        self.assertLess(chunked,whole)
+
+    def test_combine(self):
+        import random
+        random.seed(20)
+        def _random(n):
+            rows = []
+            x = 0
+            for k in xrange(n):
+                length = random.randint(1,2000)
+                rows.append(('chr1',x,x+length,random.random()))
+                x += length+random.randint(0,2000)
+            return rows
+        tracks = [_random(20000) for n in xrange(20)]
+        times = []
+        for fn in [union,intersection,lambda x:exclude(x,[0]),lambda x:require(x,[0])]:
+            t1 = time.time()
+            for x in combine([fstream(t,fields=['chr','start','end','score']) for t in tracks],fn): pass
+            times.append(time.time()-t1)
+        print "\ncombine of 20 tracks of 20k features: %.1fs union, %.1fs intersection, " \
+              "%.1fs exclude, %.1fs require" % tuple(times)
@@ -2,7 +2,8 @@
 import os, shutil, time
 
 # Internal modules #
-from bbcflib.track import track, convert, FeatureStream, check
+from bbcflib.track import track, convert, FeatureStream, check, stats
+from bbcflib.track import ArrayFeatureStream, array_stream
 from bbcflib.track.text import BedTrack, BedGraphTrack, WigTrack, SgaTrack, GffTrack
 from bbcflib.track.bin import BigWigTrack, BamTrack
 from bbcflib.track.sql import SqlTrack
@@ -20,6 +21,14 @@ __test__ = True
 # Path to testing files
 path = "test_data/track/"
 
+def _read_sql(args):
+    """Reads all rows of a sql file in a worker process."""
+    sql,kw = args
+    t = track(sql,**kw)
+    rows = list(t.read())
+    t.close()
+    return rows
+
 
 class Test_Track(unittest.TestCase):
     def setUp(self):
@@ -55,6 +64,32 @@ class Test_Track(unittest.TestCase):
         s = t.read(); s.next()
         self.assertIsInstance(s, FeatureStream)
 
+    def test_batches(self):
+        import sqlite3
+        rows = [('chr1',k,k+5) for k in xrange(25)]
+        fields = ['chr','start','end']
+        self.assertListEqual([len(b) for b in FeatureStream(rows,fields).batches(10)], [10,10,5])
+        # Blocks of the producer, cut to the size
+        s = FeatureStream(iter([rows[:12],[],rows[12:]]),fields,blocks=True)
+        self.assertListEqual([len(b) for b in s.batches(10)], [10,2,10,3])
+        s = FeatureStream(iter([rows[:12],rows[12:]]),fields,blocks=True)
+        self.assertListEqual(list(s), rows)
+        # Rows, then batches of the rest
+        s = FeatureStream(iter([rows[:12],rows[12:]]),fields,blocks=True)
+        self.assertListEqual([s.next() for k in xrange(3)], rows[:3])
+        self.assertListEqual(sum(s.batches(4),[]), rows[3:])
+        s = FeatureStream(iter([rows[:12],rows[12:]]),fields,blocks=True)
+        self.assertListEqual(s.batches().next(), rows[:12])
+        self.assertListEqual(list(s), rows[12:])
+        # Cursor
+        db = sqlite3.connect(':memory:')
+        db.execute("CREATE TABLE t (chr TEXT, start INTEGER, end INTEGER)")
+        db.executemany("INSERT INTO t VALUES (?,?,?)", rows)
+        s = FeatureStream(db.execute("SELECT * FROM t ORDER BY start"))
+        self.assertListEqual(s.fields, fields)
+        self.assertListEqual(sum(s.batches(7),[]), rows)
+        db.close()
+
     def test_check(self):
         self.assertTrue(check(self.bed))
 
@@ -146,13 +181,11 @@ class Test_Formats(unittest.TestCase):
         self.assertListEqual(t.fields, ['chr','start','end','score'])
 
     def test_bigwig(self):
-        try:
-            bw = os.path.join(path,'test.bw')
-            t = convert(self.bed, bw)
-            self.assertIsInstance(t, BigWigTrack)
-            s = t.read(); s.next()
-            self.assertListEqual(t.fields, self.fields)
-        except OSError: pass
+        bw = os.path.join(path,'test.bw')
+        t = convert(self.bed, bw)
+        self.assertIsInstance(t, BigWigTrack)
+        s = t.read(); s.next()
+        self.assertListEqual(t.fields, ['chr','start','end','score'])
 
     @unittest.skip('Converting to bam is not implemented yet.')
     def test_bam(self):
@@ -182,12 +215,74 @@ class Test_Formats(unittest.TestCase):
         s = t.read(); s.next()
         self.assertListEqual(t.fields, ['chr','start','end','name','strand','score'])
 
+    def test_parallel(self):
+        chrmeta = {'chrII':{'length':607135}, 'chrIII':{'length':178216}, 'chrIV':{'length':1402556}}
+        indexed = os.path.exists(self.bed+'.bbcfidx')
+        for ext in ['.bedGraph','.sql']:
+            out1 = os.path.join(path,'test'+ext)
+            out4 = os.path.join(path,'test_parallel'+ext)
+            convert(self.bed, out1, chrmeta=chrmeta)
+            convert(self.bed, out4, chrmeta=chrmeta, processes=4)
+            self.assertListEqual(list(track(out4).read()), list(track(out1).read()))
+            if ext == '.bedGraph':
+                self.assertEqual(open(out4).read(), open(out1).read())
+            os.remove(out4)
+        # chrIII is not in chrmeta: read sequentially, like with one process
+        del chrmeta['chrIII']
+        out1 = os.path.join(path,'test.bedGraph')
+        out4 = os.path.join(path,'test_parallel.bedGraph')
+        for out,processes in [(out1,1),(out4,4)]:
+            if os.path.exists(out): os.remove(out)
+            convert(self.bed, out, chrmeta=chrmeta, processes=processes)
+        self.assertEqual(open(out4).read(), open(out1).read())
+        self.assertIn('chrIII', open(out4).read())
+        os.remove(out4)
+        for processes in [1,4]: # no table for chrIII
+            out = os.path.join(path,'test_parallel.sql')
+            self.assertRaises(Exception, convert, self.bed, out, chrmeta=chrmeta, processes=processes)
+            os.remove(out)
+        if not indexed: os.remove(self.bed+'.bbcfidx') # built for the workers
+
     def tearDown(self):
         for ext in ['','.bed','.bw','.wig','.bedGraph','.bam','.sql','.sga','.gff']:
             test_file = os.path.join(path,'test'+ext)
             if os.path.exists(test_file): os.remove(test_file)
 
 
+class Test_Write(unittest.TestCase):
+    """Rows are formatted and written by batches: compare with files from the row by row writer."""
+    def setUp(self):
+        self.bed = os.path.join(path,"yeast_genes.bed")
+
+    def test_golden(self):
+        for ext in ['bedGraph','wig','gff']:
+            with open(os.path.join(path,'yeast_genes_golden.'+ext)) as f:
+                golden = f.read()
+            out = os.path.join(path,'test_write.'+ext)
+            for buffer_rows in [1,7,10000]:
+                src = track(self.bed)
+                t = track(out, chrmeta=src.chrmeta, fields=src.fields)
+                t.write(src.read(), buffer_rows=buffer_rows)
+                t.close()
+                with open(out) as f:
+                    self.assertEqual(f.read(),golden)
+                os.remove(out)
+
+    def test_types(self):
+        out = os.path.join(path,'test_write.bed')
+        rows = [('chrI','10',20.7,'n1','3',1),('chrI',5,6,'n%2',float('nan'),'-'),('chrI',5,6,'n3',1e7,-1)]
+        t = track(out, fields=['chr','start','end','name','score','strand'])
+        t.write(FeatureStream(rows,fields=t.fields))
+        with open(out) as f:
+            self.assertEqual(f.read(),"chrI\t10\t20\tn1\t3\t+\nchrI\t5\t6\tn%2\tnan\t-\n"
+                                      "chrI\t5\t6\tn3\t1e+07\t-\n")
+
+    def tearDown(self):
+        for ext in ['bedGraph','wig','gff','bed']:
+            test_file = os.path.join(path,'test_write.'+ext)
+            if os.path.exists(test_file): os.remove(test_file)
+
+
 class Test_Index(unittest.TestCase):
     def setUp(self):
         self.assembly = 'sacCer2'
@@ -226,10 +321,716 @@ class Test_Index(unittest.TestCase):
         convert(self.bed, sga)
         t = self._test_index(sga)
 
+    def test_index_file(self):
+        bed = os.path.join(path,'test_index.bed')
+        with open(bed,'wb') as g:
+            for chrom in ['chr%s'%c for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']:
+                g.writelines(["%s\t%i\t%i\n"%(chrom,10*k,10*k+5) for k in xrange(20000)])
+        t1 = time.time()
+        noindex = list(track(bed).read('chrZ'))
+        t2 = time.time()
+        list(track(bed).read('chrA', skip=True)) # full read, saves the index
+        self.assertTrue(os.path.exists(bed+'.bbcfidx'))
+        t = track(bed)
+        t3 = time.time()
+        withindex = list(t.read('chrZ'))
+        t4 = time.time()
+        self.assertListEqual(noindex,withindex)
+        self.assertEqual(len(t.index),26)
+        self.assertLess(t4-t3,t2-t1)
+        # Stale index is ignored and rebuilt
+        with open(bed,'ab') as g:
+            g.write("chrZZ\t0\t5\n")
+        t = track(bed)
+        self.assertEqual(list(t.read('chrZZ')),[('chrZZ',0,5)])
+        self.assertEqual(t.index,{})
+        list(t.read('chrZZ', skip=True))
+        t = track(bed)
+        list(t.read('chrZZ'))
+        self.assertEqual(len(t.index),27)
+
     def tearDown(self):
-        for ext in ['.wig','.sga']:
+        for ext in ['.wig','.sga','_index.bed']:
             test_file = os.path.join(path,'test'+ext)
             if os.path.exists(test_file): os.remove(test_file)
+            if os.path.exists(test_file+'.bbcfidx'): os.remove(test_file+'.bbcfidx')
+        if os.path.exists(self.bed+'.bbcfidx'): os.remove(self.bed+'.bbcfidx')
+
+
+class Test_Bgzf(unittest.TestCase):
+    def setUp(self):
+        self.bgzf = os.path.join(path,'test_bgzf.bed.gz')
+        self.bed = os.path.join(path,'test_bgzf.bed')
+        self.fields = ['chr','start','end','name']
+        rows = []
+        for chrom in ['chr1','chr2','chr3']:
+            rows.extend([(chrom,100*k,100*k+250,'n%i'%k) for k in xrange(30000)])
+        for filename in [self.bed,self.bgzf]:
+            t = track(filename, fields=self.fields)
+            t.write(FeatureStream(rows,fields=self.fields), bgzf=filename.endswith('.gz'))
+            t.close()
+
+    def test_bgzf(self):
+        from bbcflib.track.text import is_bgzf
+        import gzip
+        self.assertTrue(is_bgzf(self.bgzf))
+        self.assertFalse(is_bgzf(self.bed))
+        self.assertEqual(gzip.open(self.bgzf).read(), open(self.bed).read())
+        self.assertTrue(os.path.exists(self.bgzf+'.bbcfbin'))
+
+    def test_region(self):
+        selections = [{'chr':'chr2','start':(0,1500000),'end':(1400000,10**9)},
+                      'chr3',
+                      [{'chr':'chr1','start':(1000,5000)},{'chr':'chr1','end':(3000,6000)}]]
+        for sel in selections:
+            t1 = time.time()
+            full = list(track(self.bed).read(sel))
+            t2 = time.time()
+            t = track(self.bgzf)
+            region = list(t.read(sel))
+            t3 = time.time()
+            self.assertListEqual(full,region)
+            self.assertIsNotNone(t.bin_index)
+        self.assertLess(t3-t2,t2-t1)
+        # Index rebuilt from the file if missing
+        os.remove(self.bgzf+'.bbcfbin')
+        self.assertListEqual(list(track(self.bgzf).read(selections[0])),
+                             list(track(self.bed).read(selections[0])))
+        self.assertTrue(os.path.exists(self.bgzf+'.bbcfbin'))
+
+    def test_append(self):
+        # A second write appends after the EOF marker of the first one, which is removed;
+        # files concatenated with their EOF markers, as by `cat`, are read up to the end
+        import gzip
+        self.tearDown()
+        rows = [('chr%i'%n,100*k,100*k+250,'n%i'%k) for n in [1,2] for k in xrange(5)]
+        t = track(self.bgzf, fields=self.fields)
+        t.write(FeatureStream(rows[:5],fields=self.fields), bgzf=True)
+        t.write(FeatureStream(rows[5:],fields=self.fields), bgzf=True)
+        t.close()
+        self.assertEqual(len(gzip.open(self.bgzf).readlines()), 10)
+        self.assertFalse(os.path.exists(self.bgzf+'.bbcfbin'))
+        for n in xrange(2): # the index is rebuilt from the whole file
+            self.assertListEqual(list(track(self.bgzf).read({'chr':'chr2','start':(0,1000)})), rows[5:])
+            self.assertListEqual(list(track(self.bgzf).read('chr2')), rows[5:])
+        self.assertTrue(os.path.exists(self.bgzf+'.bbcfbin'))
+        self.tearDown()
+        for n,filename in enumerate([self.bgzf,self.bed]):
+            t = track(filename, format='bed', fields=self.fields)
+            t.write(FeatureStream(rows[5*n:5*n+5],fields=self.fields), bgzf=True)
+            t.close()
+        with open(self.bgzf,'ab') as f: f.write(open(self.bed,'rb').read())
+        self.assertListEqual(list(track(self.bgzf).read()), rows)
+
+    def test_unsorted(self):
+        # An unsorted file is recorded as such, and is not read again to try to index it
+        import bbcflib.track.text
+        rows = [('chr2',100*k,100*k+250,'n%i'%k) for k in xrange(1000)]
+        rows += [('chr1',100*k,100*k+250,'n%i'%k) for k in xrange(1000)]
+        rows += [('chr2',0,50,'last')]
+        self.tearDown()
+        for filename in [self.bed,self.bgzf]:
+            t = track(filename, fields=self.fields)
+            t.write(FeatureStream(rows,fields=self.fields), bgzf=filename.endswith('.gz'))
+            t.close()
+        sel = {'chr':'chr2','start':(0,1000)}
+        expected = list(track(self.bed).read(sel))
+        self.assertIn('last', [x[3] for x in expected])
+        self.assertTrue(open(self.bgzf+'.bbcfbin').readline().rstrip('\n').endswith('\tunsorted'))
+        os.remove(self.bgzf+'.bbcfbin')
+        t = track(self.bgzf)
+        self.assertListEqual(list(t.read(sel)), expected)
+        self.assertIs(t.bin_index, False)
+        self.assertTrue(open(self.bgzf+'.bbcfbin').readline().rstrip('\n').endswith('\tunsorted'))
+        add = bbcflib.track.text._BinIndex.add
+        def fail(*args): raise AssertionError("index rebuilt")
+        bbcflib.track.text._BinIndex.add = fail
+        try:
+            for n in xrange(2):
+                self.assertListEqual(list(t.read(sel)), expected)
+            self.assertListEqual(list(track(self.bgzf).read(sel)), expected)
+        finally:
+            bbcflib.track.text._BinIndex.add = add
+
+    def tearDown(self):
+        for test_file in [self.bed,self.bgzf]:
+            for ext in ['','.bbcfidx','.bbcfbin']:
+                if os.path.exists(test_file+ext): os.remove(test_file+ext)
+
+
+class Test_BigWig(unittest.TestCase):
+    """The same data as bigWig (bedGraph, variableStep and fixedStep sections) and as bedGraph."""
+    def setUp(self):
+        self.bw = track(os.path.join(path,'test_bigwig.bw'))
+        self.bedgraph = track(os.path.join(path,'test_bigwig.bedGraph'), chrmeta=self.bw.chrmeta)
+
+    def test_chrmeta(self):
+        self.assertDictEqual(self.bw.chrmeta, {'chr1':{'length':200000}, 'chr2':{'length':150000},
+                                               'chr3':{'length':100000}, 'chrUn_gap':{'length':5000}})
+
+    def test_read(self):
+        selections = [None, 'chr2', ['chr3','chr1'],
+                      [{'chr':'chr2','start':(1000,3000)},{'chr':'chr2','start':(2000,9000)},
+                       {'chr':'chr3','end':(600,1200)}]]
+        for sel in selections:
+            self.assertListEqual(list(self.bw.read(sel)), list(self.bedgraph.read(sel)))
+        # Single region: clipped to the region bounds
+        region = list(self.bw.read({'chr':'chr1','start':(1000,5000)}))
+        self.assertEqual(region[0], ('chr1',1005,1025,0.35))
+        self.assertEqual(region[-1], ('chr1',4988,5000,2.5))
+        self.assertListEqual(list(self.bw.read('chr2',fields=['start','score']))[:2],
+                             [(100,0.0),(160,3.0)])
+
+    def test_summary(self):
+        # Reference values from bigWigSummary
+        zoom = self.bw.summary('chr1',0,60000,nbins=4)
+        exact = self.bw.summary('chr1',0,60000,nbins=4,exact=True)
+        for x,y in zip(zoom[:3],[1.51710,1.50791,1.52749]): self.assertAlmostEqual(x,y,places=4)
+        for x,y in zip(exact[:3],[1.51790,1.50622,1.53040]): self.assertAlmostEqual(x,y,places=4)
+        self.assertIsNone(zoom[3])
+        self.assertListEqual(self.bw.summary('chr2',nbins=3,stat='max'), [16.0,None,None])
+        self.assertAlmostEqual(self.bw.summary('chr3',1000,2000,stat='coverage')[0], 0.66)
+
+    def test_write(self):
+        out = os.path.join(path,'test_write.bw')
+        t = track(out, chrmeta=self.bw.chrmeta)
+        t.write(self.bedgraph.read('chr1'))
+        t.write(self.bedgraph.read('chr2',fields=['start','end','score']), chrom='chr2')
+        t.write(self.bedgraph.read(['chr3','chrUn_gap']))
+        t.close()
+        t = track(out)
+        self.assertDictEqual(t.chrmeta, self.bw.chrmeta)
+        self.assertListEqual(list(t.read()), list(self.bedgraph.read()))
+        exact = t.summary('chr1',0,60000,nbins=4,exact=True)
+        for x,y in zip(exact[:3],[1.51790,1.50622,1.53040]): self.assertAlmostEqual(x,y,places=4)
+        for x,y in zip(t.summary('chr2',0,150000,nbins=3), self.bw.summary('chr2',0,150000,nbins=3)):
+            self.assertAlmostEqual(x,y,places=1)
+        # Not grouped by chromosome
+        t = track(out, chrmeta=self.bw.chrmeta)
+        with self.assertRaises(ValueError):
+            t.write(FeatureStream([('chr1',0,10,1.),('chr2',0,10,1.),('chr1',20,30,1.)],
+                                  fields=['chr','start','end','score']))
+        t.close()
+        os.remove(out)
+
+
+class Test_Stats(unittest.TestCase):
+    """Statistics from a single read of the track, compared to a direct computation."""
+    def setUp(self):
+        self.files = [os.path.join(path,'yeast_genes.bed'), os.path.join(path,'test_bigwig.bedGraph'),
+                      os.path.join(path,'test_bigwig.bw')] # chromosomes in parallel
+
+    def _expected(self, filename):
+        from bbcflib.gfminer.common import fusion
+        rows = list(track(filename).read(fields=['chr','start','end','score']))
+        total_cov = sum(x[2]-x[1] for x in fusion(track(filename).read(fields=['chr','start','end'])))
+        def _moments(vals):
+            mean = sum(vals)/float(len(vals))
+            return (sum(vals),min(vals),max(vals),mean,(sum((v-mean)**2 for v in vals)/len(vals))**0.5)
+        return (len(rows),total_cov,_moments([x[2]-x[1] for x in rows]),_moments([x[3] for x in rows]))
+
+    def test_stats(self):
+        for filename in self.files:
+            nfeat,total_cov,lstat,stat = self._expected(filename)
+            for processes in [1,3]:
+                out = stats(filename, out={}, processes=processes)
+                self.assertEqual(out['feat_stats'][0], nfeat)
+                self.assertEqual(out['feat_stats'][3], total_cov)
+                for x,y in zip(out['feat_stats'][2],lstat): self.assertAlmostEqual(x,y)
+                for x,y in zip(out['score_stats'][1],stat): self.assertAlmostEqual(x,y)
+
+    def test_stats_kwargs(self):
+        # Workers open the file with the same arguments, and a chromosome missing
+        # from chrmeta is read sequentially instead of being lost
+        rows = [x for x in track(self.files[0]).read(fields=['chr','start','end','score'])]
+        filename = os.path.join(path,'test_stats.txt')
+        with open(filename,'w') as f:
+            f.write("".join("%s,%i,%i,%s\n" % x for x in rows))
+        chrmeta = {'chrII':{'length':607135}, 'chrIII':{'length':178216}, 'chrIV':{'length':1402556}}
+        try:
+            for chrmeta in [chrmeta, dict((c,v) for c,v in chrmeta.iteritems() if c != 'chrIII')]:
+                res = []
+                for processes in [1,2]:
+                    out = stats(filename, out={}, processes=processes, format='txt', separator=',',
+                                fields=['chr','start','end','score'], chrmeta=chrmeta)
+                    res.append((out['feat_stats'][0],out['feat_stats'][2],out['score_stats'][1]))
+                self.assertEqual(res[0][0], len(rows))
+                self.assertEqual(res[1][0], res[0][0])
+                for x,y in zip(res[1][1]+res[1][2],res[0][1]+res[0][2]): self.assertAlmostEqual(x,y)
+        finally:
+            for ext in ['','.bbcfidx']:
+                if os.path.exists(filename+ext): os.remove(filename+ext)
+
+
+class Test_Sql(unittest.TestCase):
+    """Region queries through the R*Tree tables give the same rows as a filter on all rows."""
+    def setUp(self):
+        import random, bbcflib.track.sql
+        random.seed(1)
+        self.rtree_min_rows = bbcflib.track.sql._rtree_min_rows
+        bbcflib.track.sql._rtree_min_rows = 1000 # only chr1 has an R*Tree
+        self.sql = os.path.join(path,'test_rtree.sql')
+        self.fields = ['chr','start','end','name','score']
+        self.chrmeta = {'chr1':{'length':10**6},'chr2':{'length':10**5}}
+        self.rows = []
+        for chrom,n in [('chr1',3000),('chr2',300)]:
+            starts = sorted(random.randint(-100,self.chrmeta[chrom]['length']) for k in xrange(n))
+            self.rows.extend([(chrom,x,x+random.randint(0,3000),'n%i'%k,1.) for k,x in enumerate(starts)])
+
+    def _check_regions(self, t, rows):
+        regions = [('chr1',0,10**6),('chr1',5000,5001),('chr1',999000,1002000),('chr2',40000,42000)]
+        for chrom,start,end in regions:
+            expected = [x for x in rows if x[0]==chrom and x[2]>start and x[1]<end]
+            stream = FeatureStream([(chrom,start,end)],fields=['chr','start','end'])
+            self.assertListEqual(sorted(t.read(stream)), sorted(expected))
+            expected = [x for x in rows if x[0]==chrom and start<=x[1]<=end]
+            self.assertListEqual(sorted(t.read({'chr':chrom,'start':(start,end)})), sorted(expected))
+
+    def test_rtree(self):
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows[:2000],fields=self.fields))
+        t.write(FeatureStream(self.rows[2000:],fields=self.fields))
+        self.assertEqual(t._rtree('chr1'), 'chr1_rtree')
+        self._check_regions(t, self.rows)
+        t.close()
+        # Clipping rebuilds the index
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream([('chr2',99000,100500,'last',1.)],fields=self.fields), clip=True)
+        clipped = [(c,max(0,x),min(y,self.chrmeta[c]['length']),n,v) for c,x,y,n,v in self.rows]
+        clipped.append(('chr2',99000,100000,'last',1.))
+        self.assertEqual(t._rtree('chr1'), 'chr1_rtree')
+        self.assertIsNone(t._rtree('chr2'))
+        self._check_regions(t, [x for x in clipped if x[2] > x[1]])
+        t.close()
+
+    def test_rtree_inverted(self):
+        # Rows with start > end are indexed as (end,start) but selected on their own bounds
+        rows = [(c,y,x,n,v) if k%3 == 0 else (c,x,y,n,v) for k,(c,x,y,n,v) in enumerate(self.rows)]
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(rows,fields=self.fields))
+        self.assertEqual(t._rtree('chr1'), 'chr1_rtree')
+        for start,end in [(5000,9000),(0,10**6),(999000,1002000)]:
+            for sel in [{'start':(start,end)},{'end':(start,end)},{'start':(start,end),'end':(start,end+3000)}]:
+                expected = [x for x in rows if x[0]=='chr1'
+                            and all(lo<=x[self.fields.index(k)]<=hi for k,(lo,hi) in sel.iteritems())]
+                sel['chr'] = 'chr1'
+                self.assertListEqual(sorted(t.read(sel)), sorted(expected))
+        t.close()
+
+    def test_batch(self):
+        import bbcflib.track.sql
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        features = [('chr1',5000*k,5000*k+3000) for k in xrange(40)]
+        features[10:10] = [('chr2',2000,9000),('chr1',1000,20000),('chr1',1000,20000)]
+        expected = []
+        for chrom,start,end in features: # feature after feature, sorted by start,end
+            expected.extend(sorted([x[1:3] for x in self.rows if x[0]==chrom and x[2]>start and x[1]<end]))
+        batch_size = bbcflib.track.sql._batch_size
+        try:
+            for bbcflib.track.sql._batch_size in [7,batch_size]:
+                stream = FeatureStream(features,fields=['chr','start','end'])
+                self.assertListEqual(list(t.read(stream,fields=['start','end'])), expected)
+        finally:
+            bbcflib.track.sql._batch_size = batch_size
+        t.close()
+
+    def test_bulk(self):
+        bulk = os.path.join(path,'test_bulk.sql')
+        try:
+            for sql,kw in [(self.sql,{}),(bulk,{'bulk':True})]:
+                t = track(sql, chrmeta=self.chrmeta, fields=self.fields, **kw)
+                t.write(FeatureStream(self.rows[:2000],fields=self.fields))
+                t.write(FeatureStream(self.rows[2000:],fields=self.fields), clip=True)
+                t.close()
+            t1 = track(self.sql)
+            t2 = track(bulk)
+            for table in ['chr1','chr2','chr1_rtree']:
+                t1.cursor.execute("SELECT * FROM '%s'" % table)
+                t2.cursor.execute("SELECT * FROM '%s'" % table)
+                self.assertListEqual(t2.cursor.fetchall(), t1.cursor.fetchall())
+            query = "SELECT name FROM sqlite_master WHERE type='index' ORDER BY name"
+            self.assertListEqual(t2.cursor.execute(query).fetchall(), t1.cursor.execute(query).fetchall())
+            self.assertEqual(t2._rtree('chr1'), 'chr1_rtree')
+            t1.close()
+            t2.close()
+        finally:
+            if os.path.exists(bulk): os.remove(bulk)
+
+    def test_readonly(self):
+        import bbcflib.track.sql, threading, multiprocessing, sqlite3
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        t.close()
+        t1 = track(self.sql, readonly=True)
+        t2 = track(self.sql)
+        self.assertIs(t1.connection, t2.connection)
+        self.assertRaises(IOError, t1.write, FeatureStream(self.rows[:1],fields=self.fields))
+        if bbcflib.track.sql._uri_filenames():
+            self.assertRaises(sqlite3.OperationalError, t2.cursor.execute,
+                              "INSERT INTO 'chr1' (start,end) VALUES (10,20)")
+        # Threads read through the shared connection
+        results = []
+        def _read():
+            t = track(self.sql)
+            results.append(list(t.read(FeatureStream(self.rows,fields=self.fields))))
+            t.close()
+        threads = [threading.Thread(target=_read) for n in xrange(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        expected = list(t1.read(FeatureStream(self.rows,fields=self.fields)))
+        self.assertEqual(len(results), 4)
+        for rows in results: self.assertListEqual(rows, expected)
+        # Processes read while this one does
+        pool = multiprocessing.Pool(4)
+        try:
+            t0 = time.time()
+            results = pool.map_async(_read_sql, [(self.sql,{}),(self.sql,{'immutable':True})]*4)
+            for n in xrange(4): self.assertEqual(len(list(t1.read())), len(self.rows))
+            results = results.get(timeout=60)
+            self.assertLess(time.time()-t0, 60)
+        finally:
+            pool.close()
+            pool.join()
+        for rows in results: self.assertListEqual(rows, sorted(self.rows))
+        # The first write switches to a read-write connection
+        t2.write(FeatureStream([('chr2',10,20,'added',1.)],fields=self.fields))
+        self.assertIsNot(t1.connection, t2.connection)
+        self.assertIn(('chr2',10,20,'added',1.), list(t2.read('chr2')))
+        t1.close()
+        t2.close()
+        self.assertListEqual([k for k in bbcflib.track.sql._connections if k[1] == os.path.abspath(self.sql)], [])
+
+    def test_read_after_close(self):
+        # Streams read from the shared connection can be consumed after `close`
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        t.close()
+        expected = sorted(x for x in self.rows if x[0] == 'chr1')
+        with track(self.sql) as t:
+            s = t.read('chr1')
+        self.assertListEqual(list(s), expected)
+        t = track(self.sql)
+        s1 = t.read(FeatureStream([('chr1',0,10**6)],fields=['chr','start','end']))
+        s2 = t.read('chr1')
+        s2.next()
+        t.close()
+        self.assertListEqual(list(s1), expected)
+        self.assertListEqual(list(s2), expected[1:])
+
+    def test_summary(self):
+        import sqlite3
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        t.close()
+        t = track(self.sql)
+        self.assertEqual(t._summary['chr2']['count'], 300)
+        self.assertListEqual(t.fields, ['start','end','name','score'])
+        ranges = [t.get_range(sel,fields) for sel in [None,'chr2',{'chr':'chr1'}]
+                  for fields in [None,'score',['start','name']]]
+        summary = t._summary
+        t._summary = None
+        self.assertListEqual([t.get_range(sel,fields) for sel in [None,'chr2',{'chr':'chr1'}]
+                              for fields in [None,'score',['start','name']]], ranges)
+        self.assertListEqual(t.get_range(), [min(x[1] for x in self.rows),max(x[2] for x in self.rows)])
+        t.close()
+        # Modified by another program: the summary is ignored
+        connection = sqlite3.connect(self.sql)
+        connection.execute("INSERT INTO 'chr2' (start,end,name,score) VALUES (10,1000000,'added',1.)")
+        connection.commit()
+        connection.close()
+        t = track(self.sql)
+        self.assertIsNone(t._summary)
+        self.assertEqual(t.get_range('chr2')[1], 10**6)
+        t.write(FeatureStream([('chr1',10,20,'added',1.)],fields=self.fields))
+        t.close()
+        t = track(self.sql)
+        self.assertEqual(t._summary['chr2']['max']['end'], 10**6)
+        self.assertEqual(t._summary['chr1']['count'], 3001)
+        self.assertEqual(t._summary['chr1']['fields'], summary['chr1']['fields'])
+        t.close()
+
+    def test_no_rtree(self):
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        t.cursor.execute("INSERT INTO 'chr1' (start,end,name,score) VALUES (10,20,'added',1.)")
+        t.connection.commit()
+        t.close()
+        # Rows added by other tools are not in the index: it is not used
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        self.assertIsNone(t._rtree('chr1'))
+        self._check_regions(t, self.rows+[('chr1',10,20,'added',1.)])
+        t.close()
+
+    def test_arrays(self):
+        import bbcflib.track.sql
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(self.rows,fields=self.fields))
+        t.close()
+        t = track(self.sql)
+        batch_size = bbcflib.track.sql._batch_size
+        try:
+            for bbcflib.track.sql._batch_size in [7,batch_size]:
+                for selection in [None,{'chr':'chr1','start':(5000,50000)}]:
+                    stream = t.read(selection,as_arrays=True)
+                    self.assertIsInstance(stream,ArrayFeatureStream)
+                    self.assertListEqual(list(stream), list(t.read(selection)))
+                stream = t.read(selection,fields=['start','name'],as_arrays=True)
+                chunk = stream.chunks.next()
+                self.assertEqual(chunk['start'].dtype.kind, 'i')
+                self.assertEqual(chunk['name'].dtype.kind, 'O')
+                batches = list(t.read(selection).batches(5))
+                self.assertLessEqual(max(map(len,batches)), 5)
+                self.assertListEqual(sum(batches,[]), list(t.read(selection)))
+            features = FeatureStream([('chr2',2000,9000)],fields=['chr','start','end'])
+            expected = list(t.read(FeatureStream([('chr2',2000,9000)],fields=['chr','start','end'])))
+            self.assertListEqual(list(t.read(features,as_arrays=True)), expected)
+        finally:
+            bbcflib.track.sql._batch_size = batch_size
+        t.close()
+
+    def test_numpy_values(self):
+        # numpy scalars after the first row of a batch, e.g. from an ArrayFeatureStream
+        import numpy
+        rows = [('chr1',10,20,'a',1.)]+[('chr1',numpy.int32(x),numpy.int64(x+5),'b',numpy.float32(.5))
+                                          for x in xrange(30,50)]
+        t = track(self.sql, chrmeta=self.chrmeta, fields=self.fields)
+        t.write(FeatureStream(rows,fields=self.fields))
+        t.close()
+        t = track(self.sql)
+        res = list(t.read('chr1'))
+        self.assertListEqual(res, [(x[0],int(x[1]),int(x[2]),x[3],float(x[4])) for x in rows])
+        self.assertListEqual([map(type,x) for x in res], [[unicode,int,int,unicode,float]]*len(rows))
+        t.close()
+
+    def tearDown(self):
+        import bbcflib.track.sql
+        bbcflib.track.sql._rtree_min_rows = self.rtree_min_rows
+        if os.path.exists(self.sql): os.remove(self.sql)
+
+
+class Test_Parser(unittest.TestCase):
+    """Bed, bedGraph and sga files are parsed by chunks: compare with the line by line parser."""
+    def setUp(self):
+        self.bed = os.path.join(path,'test_parser.bed')
+        with open(self.bed,'wb') as g:
+            g.write("track name=test\n#comment\nchr1\t1\t5\tn1\t0.5\t+\n@x\ntig1\t2\t3\t n2 \t1\t-\r\n"
+                    "chr2\t4\t5\tn3\t2\t.\n#\nchr2\t7\t9\tn4\t2\t+\n\nchr3\t1\t2\tn5\t1\t+\n")
+        self.sga = os.path.join(path,'test_parser.sga')
+        convert(os.path.join(path,"yeast_genes.bed"), self.sga)
+
+    def _compare(self, t, selection=None):
+        chunks = list(t.read(selection))
+        sel = None if selection is None else [{'chr': [selection]}]
+        rows = list(t._read(t.fields,range(len(t.fields)),sel,False))
+        t.close()
+        self.assertListEqual(chunks,rows)
+        return chunks
+
+    def test_chunks(self):
+        import bbcflib.track.text as text
+        for size in [2**20,16]: # also with lines cut across chunks
+            text._chunk_size = size
+            try:
+                self.assertEqual(len(self._compare(track(self.bed))), 4)
+                self.assertEqual(len(self._compare(track(self.bed),'chr2')), 2)
+                self.assertEqual(len(self._compare(track(self.sga))), 4933)
+                self.assertEqual(len(self._compare(track(self.sga),'chrIV')), 0)
+            finally:
+                text._chunk_size = 2**20
+        self.assertListEqual(sum(track(self.sga).read().batches(),[]), list(track(self.sga).read()))
+        with open(self.bed,'wb') as g: g.write("chr1\t1\t5\nchr2\t1\tx\n")
+        self.assertRaises(ValueError, list, track(self.bed).read())
+        self.assertEqual(list(track(self.bed).read('chr1')), [('chr1',1,5)])
+
+    def test_arrays(self):
+        for t,selection in [(track(self.bed),None),(track(self.sga),'chrV'),(track(self.sga),'chrIV')]:
+            rows = list(t.read(selection))
+            stream = t.read(selection,as_arrays=True)
+            self.assertIsInstance(stream,ArrayFeatureStream)
+            self.assertListEqual(list(stream), rows)
+            stream = t.read(selection,fields=['start','name'],as_arrays=True)
+            for chunk in stream.chunks:
+                self.assertEqual(chunk['start'].dtype.kind, 'i')
+                self.assertEqual(chunk['name'].dtype.kind, 'O')
+        # Line by line parser, and back from chunks of any size
+        t = track(self.bed)
+        stream = t.read({'chr':'chr2','start':(0,8)},as_arrays=True)
+        self.assertListEqual([x[:3] for x in stream], [('chr2',4,5),('chr2',7,9)])
+        rows = list(track(self.sga).read())
+        self.assertListEqual(list(array_stream(track(self.sga).read(),size=100)), rows)
+        # Chunks of an ArrayFeatureStream are cut to the size given
+        stream = array_stream(track(self.sga).read(as_arrays=True),size=100)
+        chunks = list(stream.chunks)
+        self.assertTrue(all(len(c['start']) <= 100 for c in chunks))
+        self.assertListEqual(list(ArrayFeatureStream(chunks,stream.fields)), rows)
+        stream = track(self.sga).read(as_arrays=True)
+        self.assertIs(array_stream(stream), stream)
+
+    def tearDown(self):
+        for test_file in [self.bed,self.sga]:
+            if os.path.exists(test_file): os.remove(test_file)
+
+
+@unittest.skipUnless(os.environ.get('BBCF_BENCHMARK'), "Set BBCF_BENCHMARK=1 to run benchmarks.")
+class Test_Benchmark(unittest.TestCase):
+    def setUp(self):
+        self.bedgraph = os.path.join(path,'test_benchmark.bedGraph')
+        self.nrows = 5000000
+        with open(self.bedgraph,'wb') as g:
+            for chrom in ['chr1','chr2','chr3','chr4','chr5']:
+                g.writelines("%s\t%i\t%i\t%.2f\n" % (chrom,10*k,10*k+10,k%97/4.)
+                             for k in xrange(self.nrows//5))
+
+    def test_parser(self):
+        t = track(self.bedgraph)
+        t1 = time.time()
+        n1 = sum(1 for x in t._read(t.fields,range(4),None,False))
+        t2 = time.time()
+        n2 = sum(1 for x in t.read())
+        t3 = time.time()
+        self.assertEqual(n1,self.nrows)
+        self.assertEqual(n2,self.nrows)
+        print "\nbedGraph parsing: %i rows/s line by line, %i rows/s by chunks" \
+              % (n1/(t2-t1),n2/(t3-t2))
+        self.assertLess(t3-t2,t2-t1)
+
+    def tearDown(self):
+        if os.path.exists(self.bedgraph): os.remove(self.bedgraph)
+
+
+@unittest.skipUnless(os.environ.get('BBCF_BENCHMARK'), "Set BBCF_BENCHMARK=1 to run benchmarks.")
+class Test_SqlBenchmark(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import random
+        random.seed(1)
+        cls.sql = os.path.join(path,'test_benchmark.sql')
+        cls.nrows = 10000000
+        fields = ['chr','start','end','score']
+        t = track(cls.sql, chrmeta={'chr1':{'length':2*10**9}}, fields=fields)
+        t.write(FeatureStream((('chr1',20*k,20*k+random.randint(1,1000),1.) for k in xrange(cls.nrows)),
+                              fields=fields), chrom='chr1')
+        t.close()
+        cls.regions = [(x,x+random.randint(1,10000)) for x in
+                       (random.randint(0,20*cls.nrows) for k in xrange(10000))]
+
+    def test_regions(self):
+        t = track(self.sql)
+        t1 = time.time()
+        n1 = sum(1 for r in self.regions
+                 for x in t.read(FeatureStream([('chr1',)+r],fields=['chr','start','end'])))
+        t2 = time.time()
+        t._rtrees = {} # (start,end) index only, on 100 regions
+        n2 = sum(1 for r in self.regions[:100]
+                 for x in t.read(FeatureStream([('chr1',)+r],fields=['chr','start','end'])))
+        t3 = time.time()
+        print "\nsql region queries: %.0f/s with the R*Tree, %.1f/s without" \
+              % (len(self.regions)/(t2-t1),100/(t3-t2))
+        self.assertLess((t2-t1)/len(self.regions),(t3-t2)/100)
+
+    def test_batch(self):
+        import random
+        random.seed(2)
+        features = sorted(random.randint(0,20*self.nrows) for k in xrange(100000))
+        features = [('chr1',x,x+random.randint(1,2000)) for x in features]
+        t = track(self.sql)
+        t1 = time.time()
+        n1 = sum(1 for x in t.read(FeatureStream(features,fields=['chr','start','end'])))
+        t2 = time.time()
+        n2 = sum(1 for f in features
+                 for x in t.read(FeatureStream([f],fields=['chr','start','end'])))
+        t3 = time.time()
+        self.assertEqual(n1,n2)
+        print "\nsql selection of 100k features: %.1fs in batches, %.1fs one by one" % (t2-t1,t3-t2)
+        self.assertLess(t2-t1,t3-t2)
+
+    def test_bulk(self):
+        import random
+        random.seed(3)
+        fields = ['chr','start','end','name','score']
+        chrmeta = dict(('chr%i'%n,{'length':2*10**8}) for n in xrange(1,5))
+        rows = [(chrom,50*k,50*k+random.randint(1,1000),'n%i'%k,random.random())
+                for chrom in sorted(chrmeta) for k in xrange(500000)]
+        sql = [os.path.join(path,'test_bulk%i.sql'%n) for n in xrange(2)]
+        times = []
+        try:
+            for output,bulk in zip(sql,[False,True]):
+                t1 = time.time()
+                t = track(output, chrmeta=chrmeta, fields=fields, bulk=bulk)
+                t.write(FeatureStream(rows,fields=fields))
+                t.close()
+                times.append(time.time()-t1)
+            t1 = track(sql[0])
+            t2 = track(sql[1])
+            for chrom in chrmeta:
+                t1.cursor.execute("SELECT * FROM '%s'" % chrom)
+                t2.cursor.execute("SELECT * FROM '%s'" % chrom)
+                self.assertListEqual(t2.cursor.fetchall(), t1.cursor.fetchall())
+            t1.close()
+            t2.close()
+        finally:
+            for output in sql:
+                if os.path.exists(output): os.remove(output)
+        print "\nsql load of %i rows: %.1fs, %.1fs in bulk" % (len(rows),times[0],times[1])
+        self.assertLess(times[1],times[0])
+
+    def test_batches(self):
+        selection = {'chr':'chr1','start':(0,4*10**7)} # 2M rows
+        t = track(self.sql)
+        t1 = time.time()
+        n1 = sum(1 for x in t.read(selection))
+        t2 = time.time()
+        n2 = sum(len(b) for b in t.read(selection).batches())
+        t3 = time.time()
+        self.assertEqual(n1,n2)
+        sql = os.path.join(path,'test_batches.sql')
+        try:
+            t4 = time.time()
+            output = track(sql, chrmeta=t.chrmeta, fields=t.fields)
+            output.write(t.read(selection))
+            output.close()
+            t5 = time.time()
+        finally:
+            t.close()
+            if os.path.exists(sql): os.remove(sql)
+        # sqlite itself dominates the reads, the batches spare the Python loop over rows
+        print "\nsql read: %i rows/s by rows, %i rows/s by batches; write: %i rows/s" \
+              % (n1/(t2-t1),n2/(t3-t2),n1/(t5-t4))
+
+    def test_summary(self):
+        import sqlite3
+        sql = os.path.join(path,'test_contigs.sql')
+        fields = ['chr','start','end','score']
+        chrmeta = dict(('contig%i'%n,{'length':10**5}) for n in xrange(5000))
+        t = track(sql, chrmeta=chrmeta, fields=fields, bulk=True)
+        t.write(FeatureStream(((c,k*100,k*100+50,1.) for c in sorted(chrmeta) for k in xrange(100)),
+                              fields=fields))
+        t.close()
+        try:
+            times = []
+            for n in xrange(2):
+                t1 = time.time()
+                t = track(sql)
+                t2 = time.time()
+                r = t.get_range()
+                t3 = time.time()
+                t.close()
+                times.extend([t3-t1,t2-t1,t3-t2])
+                self.assertListEqual(r, [0,9950])
+                # the same file with an outdated summary
+                connection = sqlite3.connect(sql)
+                connection.execute("PRAGMA user_version=0")
+                connection.close()
+        finally:
+            os.remove(sql)
+        print "\nopen + get_range on 5000 contigs: %.3fs (%.3fs + %.3fs) with the summary table, " \
+              "%.3fs (%.3fs + %.3fs) without" % tuple(times)
+        self.assertLess(times[0],times[3])
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.sql): os.remove(cls.sql)
 
 
 class Test_Bam(unittest.TestCase):
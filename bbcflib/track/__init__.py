@@ -2,7 +2,7 @@
 Documentation `here <http://bbcf.epfl.ch/bbcflib/tutorial_track.html>`_.
 """
 
-__all__ = ['Track','track','FeatureStream','convert',
+__all__ = ['Track','track','FeatureStream','ArrayFeatureStream','array_stream','convert',
            'strand_to_int','int_to_strand','format_float','format_int',
            'ucsc_to_ensembl','ensembl_to_ucsc']
 
@@ -66,7 +66,98 @@ def track( path, format=None, **kwargs):
     return getattr(sys.modules[_track_map[format][0]],
                    _track_map[format][1])(path,**kwargs)
 
-def convert( source, target, chrmeta=None, info=None, mode='write', clip=False ):
+def _parallel_chroms(t):
+    """Chromosomes of track *t* to read one per worker process, in the order of the file if known,
+    or None if *t* must be read sequentially: rows of chromosomes missing from *t.chrmeta*
+    would be lost. Text files are scanned once to index their chromosomes if necessary."""
+    from bbcflib.track.text import TextTrack
+    from bbcflib.track.sql import SqlTrack
+    chroms = sorted(t.chrmeta or [])
+    if len(chroms) < 2: return None
+    if isinstance(t,TextTrack):
+        if not t._load_index():
+            for x in t.read(selection=chroms[0], skip=True): pass
+        if not(t._index_loaded and set(t.index) <= set(chroms)): return None
+        chroms.sort(key=lambda c: t.index.get(c,[sys.maxint])[0])
+        return chroms
+    elif isinstance(t,SqlTrack): # reads the tables of *t.chrmeta* only
+        return chroms
+    elif str(t.format).lower() == 'bigwig':
+        from bbcflib.track.bin import BigWigFile
+        bw = BigWigFile(t.path)
+        bw.close()
+        if set(bw.chroms) <= set(chroms): return chroms
+    return None
+
+def _worker_kwargs(t, kwargs):
+    """Keyword arguments to open track *t* again in a worker process: the caller's *kwargs*,
+    completed by the attributes of *t*. None if they cannot be sent to another process."""
+    import cPickle
+    kw = dict(kwargs, format=t.format, chrmeta=t.chrmeta)
+    kw.setdefault('fields',t.fields)
+    for attr in ['separator','header','bgzf','intypes','outtypes']:
+        if hasattr(t,attr): kw.setdefault(attr,getattr(t,attr))
+    try: cPickle.dumps(kw,-1)
+    except (cPickle.PicklingError,TypeError): return None
+    return kw
+
+def _convert_chrom(args):
+    """Worker of `convert` for one chromosome: writes the part *part* of the target,
+    without the indexes, which are built once the parts are joined."""
+    source,source_kw,part,target_format,fields,clip,chrom = args
+    tsrc = track(source, **source_kw)
+    ttrg = track(part, format=target_format, chrmeta={chrom: tsrc.chrmeta[chrom]}, fields=fields,
+                 bulk=True, indexed=False)
+    try:
+        ttrg.write( tsrc.read(selection=chrom), mode='overwrite', clip=clip, chrom=chrom )
+    finally:
+        ttrg.close()
+        tsrc.close()
+    return part
+
+def _convert_parallel(tsrc, ttrg, mode, clip, processes, source_kw):
+    """Converts *tsrc* to *ttrg* chromosome by chromosome in *processes* worker processes.
+    Returns False if the target format does not allow to join the parts, or if the
+    source must be read sequentially (see `_parallel_chroms`)."""
+    from bbcflib.track.text import TextTrack
+    from bbcflib.track.sql import SqlTrack
+    if not isinstance(ttrg,(TextTrack,SqlTrack)): return False
+    chroms = _parallel_chroms(tsrc)
+    source_kw = _worker_kwargs(tsrc,source_kw)
+    if chroms is None or source_kw is None: return False
+    import multiprocessing, tempfile, shutil
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(ttrg.path)))
+    try:
+        args = [(tsrc.path,source_kw,os.path.join(tmpdir,"part%i"%n),
+                 ttrg.format,ttrg.fields,clip,chrom) for n,chrom in enumerate(chroms)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_convert_chrom, args)
+        finally:
+            pool.close()
+            pool.join()
+        if isinstance(ttrg,SqlTrack):
+            ttrg.open()
+            columns = ",".join('"%s"'%f for f in ttrg.fields if f != 'chr')
+            for chrom,part in zip(chroms,parts):
+                ttrg.cursor.execute("ATTACH DATABASE '%s' AS part" % part)
+                ttrg.cursor.execute("INSERT INTO main.'%s' (%s) SELECT %s FROM part.'%s'"
+                                    % (chrom,columns,columns,chrom))
+                ttrg.connection.commit()
+                ttrg.cursor.execute("DETACH DATABASE part")
+            ttrg._modify(chroms) # the R*Tree and indexes are built on close
+        else:
+            ttrg.open(mode)
+            for part in parts:
+                if not os.path.exists(part): continue
+                with open(part,'rb') as f:
+                    shutil.copyfileobj(f,ttrg.filehandle)
+            ttrg.written = True
+    finally:
+        shutil.rmtree(tmpdir)
+    return True
+
+def convert( source, target, chrmeta=None, info=None, mode='write', clip=False, processes=1 ):
     """
     Converts a file from one format to another. Format can be explicitly specified::
 
@@ -83,19 +174,25 @@ def convert( source, target, chrmeta=None, info=None, mode='write', clip=False )
     :param chrmeta: (dict) to specify manually 'chrmeta' for both input and output tracks. [None]
     :param info: (dict) info that will be available as an attribute of the output track. [None]
     :param mode: (str) writing mode: either 'write', 'append' or 'overwrite'. ['write']
+    :param processes: (int) number of worker processes converting one chromosome each, if the
+        chromosomes are known (chrmeta), cover all those of the source, and the target is a text or sql file. Parts are joined
+        in the order of the source file if known, else sorted by chromosome name. [1]
     """
     if isinstance(source, tuple):
-        tsrc = track(source[0], format=source[1], chrmeta=chrmeta)
+        source_kw = {'format': source[1], 'chrmeta': chrmeta}
+        tsrc = track(source[0], **source_kw)
     else:
-        tsrc = track(source, chrmeta=chrmeta)
+        source_kw = {'chrmeta': chrmeta}
+        tsrc = track(source, **source_kw)
     _f = tsrc.fields
     if not('chr' in _f): _f = ['chr']+_f
     if isinstance(target, tuple):
-        ttrg = track(target[0], format=target[1], chrmeta=tsrc.chrmeta, fields=_f, info=info)
+        ttrg = track(target[0], format=target[1], chrmeta=tsrc.chrmeta, fields=_f, info=info, bulk=True)
     else:
-        ttrg = track(target, chrmeta=tsrc.chrmeta, fields=_f, info=info)
+        ttrg = track(target, chrmeta=tsrc.chrmeta, fields=_f, info=info, bulk=True)
     try:
-        ttrg.write( tsrc.read(), mode=mode, clip=clip )
+        if not(processes > 1 and _convert_parallel(tsrc, ttrg, mode, clip, processes, source_kw)):
+            ttrg.write( tsrc.read(), mode=mode, clip=clip )
     finally:
         ttrg.close()
         tsrc.close()
@@ -210,16 +307,95 @@ def check(source, out=sys.stdout,
         last_end = end
         lastrow = row
 
-def stats(source, out=sys.stdout, plot=True, wlimit=80, **kwargs):
+def _stats_pass(stream):
+    """
+    Reads *stream* once and returns `(nfeat,ldistr,lmoments,distr,moments,total_cov)`:
+    the distributions of feature lengths and of scores (None if there is no 'score' field),
+    their running `(count,mean,M2)` (Welford), and the total length of the union
+    of the features (a running union of the features, sorted by start).
+    """
+    distr = {} # distribution of scores
+    ldistr = {} # distribution of feat lengths
+    lmom = [0,0.0,0.0]
+    mom = [0,0.0,0.0]
+    st_idx = stream.fields.index('start')
+    en_idx = stream.fields.index('end')
+    score_idx = stream.fields.index('score') if 'score' in stream.fields else None
+    chr_idx = stream.fields.index('chr') if 'chr' in stream.fields else None
+    total_cov = 0
+    cur_chr = cur_start = cur_end = None
+    for x in stream:
+        start = x[st_idx]
+        end = x[en_idx]
+        w = end-start
+        ldistr[w] = ldistr.get(w,0.0) + 1
+        lmom[0] += 1
+        delta = w-lmom[1]
+        lmom[1] += delta/lmom[0]
+        lmom[2] += delta*(w-lmom[1])
+        if score_idx is not None:
+            v = x[score_idx]
+            distr[v] = distr.get(v,0.0) + 1
+            mom[0] += 1
+            delta = v-mom[1]
+            mom[1] += delta/mom[0]
+            mom[2] += delta*(v-mom[1])
+        c = x[chr_idx] if chr_idx is not None else None
+        if cur_end is not None and c == cur_chr and start < cur_end:
+            if end > cur_end: cur_end = end
+        else:
+            if cur_end is not None: total_cov += cur_end-cur_start
+            cur_chr,cur_start,cur_end = c,start,end
+    if cur_end is not None: total_cov += cur_end-cur_start
+    if score_idx is None: distr = mom = None
+    return lmom[0],ldistr,lmom,distr,mom,total_cov
+
+def _stats_chrom(args):
+    """Worker of `stats` for one chromosome: *args* is `(path,track kwargs,chrom)`."""
+    path,kwargs,chrom = args
+    t = track(path,**kwargs)
+    try:
+        return _stats_pass(t.read(selection=chrom))
+    finally:
+        t.close()
+
+def _merge_stats(parts):
+    """Combines the results of `_stats_pass` on disjoint sets of chromosomes."""
+    def _merge_distr(a,b):
+        for k,v in b.iteritems(): a[k] = a.get(k,0.0) + v
+    def _merge_moments(a,b):
+        n = a[0]+b[0]
+        if n == 0: return
+        delta = b[1]-a[1]
+        a[2] += b[2]+delta*delta*a[0]*b[0]/n
+        a[1] += delta*b[0]/n
+        a[0] = n
+    nfeat,ldistr,lmom,distr,mom,total_cov = parts[0]
+    for part in parts[1:]:
+        nfeat += part[0]
+        _merge_distr(ldistr,part[1])
+        _merge_moments(lmom,part[2])
+        if distr is not None:
+            _merge_distr(distr,part[3])
+            _merge_moments(mom,part[4])
+        total_cov += part[5]
+    return nfeat,ldistr,lmom,distr,mom,total_cov
+
+def stats(source, out=sys.stdout, plot=True, wlimit=80, processes=1, **kwargs):
     """Prints stats about the track. Draws a plot of the scores distribution (if any)
     directly to the console.
 
     It does not load the whole file in memory, but the distribution of its scores,
     which are expected to be limited in variety for count data (normalized or not).
+    The track is read only once, and must be sorted by chromosome and start for the
+    total coverage to be correct.
 
     :param source: (str) name of the file. Can also be a Track instance.
     :param out: writable/file object (default: stdout), or a dict (will be updated).
     :param wlimit: max width of the distribution plot - console screen -, in number of chars. [80]
+    :param processes: (int) number of worker processes reading the chromosomes in parallel,
+        if the track chromosomes are known (chrmeta), cover all those of the file,
+        and no *selection* is given. [1]
     :param **kwargs: ``track`` keyword arguments.
     """
     def median(vals,distr,nfeat):
@@ -233,13 +409,13 @@ def stats(source, out=sys.stdout, plot=True, wlimit=80, **kwargs):
             lastv = v
         return smedian
 
-    def stats_from_distr(distr,nfeat):
+    def stats_from_distr(distr,moments,nfeat):
         if nfeat==0: return (None,)*6
         vals = sorted(distr.keys())
         total = float(sum(k*distr[k] for k in vals))
         smin = vals[0]; smax = vals[-1]
-        smean = total/nfeat
-        stdev = (sum((x-smean)**2 for x in vals)/nfeat)**(0.5)
+        smean = moments[1]
+        stdev = (moments[2]/nfeat)**(0.5)
         smedian = median(vals,distr,nfeat)
         return total,smin,smax,smean,stdev,smedian
 
@@ -271,58 +447,33 @@ def stats(source, out=sys.stdout, plot=True, wlimit=80, **kwargs):
             nblocks = int(bscores[b] * wlimit/max_bscore +0.5)
             out.write(legends[b] + "|" + "#"*nblocks + " (%d)\n"%bscores[b])
 
-    def score_stats(s):
-        distr = {} # distribution of scores
-        ldistr = {} # distribution of feat lengths
-        score_idx = s.fields.index('score')
-        st_idx= s.fields.index('start')
-        en_idx = s.fields.index('end')
-        nfeat = 0
-        for x in s:
-            nfeat += 1
-            v = x[score_idx]
-            distr[v] = distr.get(v,0.0) + 1
-            w = x[en_idx]-x[st_idx]
-            ldistr[w] = ldistr.get(w,0.0) + 1
-        return (nfeat,distr,ldistr,
-                stats_from_distr(distr,nfeat), stats_from_distr(ldistr,nfeat), )
-
-    def feat_stats(s):
-        ldistr = {} # distribution of feat lengths
-        st_idx= s.fields.index('start')
-        en_idx = s.fields.index('end')
-        for nfeat,x in enumerate(s):
-            w = x[en_idx]-x[st_idx]
-            ldistr[w] = ldistr.get(w,0.0) + 1
-        return nfeat,ldistr,stats_from_distr(ldistr,nfeat)
-
-    def total_coverage(t):
-        from bbcflib.gfminer.common import fusion
-        total_cov = 0
-        kw = dict(kwargs)
-        s = t.read(**kw)
-        fs = fusion(s)
-        st_idx = fs.fields.index('start')
-        en_idx = fs.fields.index('end')
-        total_cov += sum(x[en_idx]-x[st_idx] for x in fs)
-        return total_cov
-
     if isinstance(source, basestring):
         t = track(source, **kwargs)
     else:
         t = source
-    total_cov = total_coverage(t)
-    s = t.read(**kwargs)
-    is_score = 'score' in s.fields
+    chroms = worker_kw = None
+    if processes > 1 and not('selection' in kwargs):
+        chroms = _parallel_chroms(t)
+        worker_kw = _worker_kwargs(t,kwargs)
+    if chroms and worker_kw is not None:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_stats_chrom, [(t.path,worker_kw,c) for c in chroms])
+        finally:
+            pool.close()
+            pool.join()
+        nfeat,ldistr,lmom,distr,mom,total_cov = _merge_stats(parts)
+    else:
+        nfeat,ldistr,lmom,distr,mom,total_cov = _stats_pass(t.read(**kwargs))
+    is_score = distr is not None
+    lstat = stats_from_distr(ldistr,lmom,nfeat)
+    if isinstance(out,dict):
+        out['feat_stats'] = (nfeat,ldistr,lstat,total_cov)
     if is_score:
-        nfeat,distr,ldistr,stat,lstat = score_stats(s)
+        stat = stats_from_distr(distr,mom,nfeat)
         if isinstance(out,dict):
-            out['feat_stats'] = (nfeat,ldistr,lstat,total_cov)
             out['score_stats'] = (distr,stat)
-    else:
-        nfeat,ldistr,lstat = feat_stats(s)
-        if isinstance(out,dict):
-            out['feat_stats'] = (nfeat,ldistr,lstat,total_cov)
     if isinstance(out,dict):
         return out
     if nfeat == 0:
@@ -436,6 +587,37 @@ class Track(object):
         """Iterates over the list of features."""
         return iter(self.read())
 
+    def _select_values(self,row,selection):
+        """
+        Check whether all elements in a *row* pass through the *selection* filter.
+
+        :row: (list) splitted row from file - elements correspond to fields items.
+        :param selection: dict of the form {field_name: value} or {field_name: (min,max)}.
+        :rtype: boolean
+        """
+        tests = []
+        for k,v in selection.iteritems():
+            if k == 'length':
+                fi1 = self.fields.index('start')
+                fi2 = self.fields.index('end')
+            else:
+                fi = self.fields.index(k)
+            if isinstance(v,(list,tuple)):
+                if k == 'chr':
+                    tests.append(str(row[fi]) in v)
+                elif k == 'length':
+                    tests.append(int(row[fi2])-int(row[fi1]) >= int(v[0]))
+                    tests.append(int(row[fi2])-int(row[fi1]) <= int(v[1]))
+                else:
+                    tests.append(float(row[fi]) >= float(v[0]))
+                    tests.append(float(row[fi]) <= float(v[1]))
+            else:
+                if k == 'length':
+                    tests.append(int(row[fi2])-int(row[fi1]) == int(v))
+                else:
+                    tests.append(str(row[fi]) == str(v))
+        return all(tests)
+
     def open(self):
         pass
 
@@ -524,15 +706,27 @@ class FeatureStream(object):
 
         Iterating over the stream is iterating over its data.
 
+    .. method:: batches(size=None)
+
+        Iterates over the stream by lists of rows (see below).
+
+    With *blocks* True, *data* is an iterator over lists of rows, as produced by readers
+    that get their rows by blocks (e.g. `cursor.fetchmany`): `batches` then hands them
+    over without iterating over each row in Python. The stream is still iterable by rows.
     """
 
-    def __init__(self, data, fields=None):
+    def __init__(self, data, fields=None, blocks=False):
         if isinstance(data,(list,tuple)):
             data = iter(data)
         if not fields:
             if hasattr(data, 'description'):
                 fields = [x[0] for x in data.description]
             else: raise ValueError("Must specify a 'fields' attribute for %s." % self.__str__())
+        self._blocks = None
+        if blocks:
+            import itertools
+            self._blocks = data
+            data = itertools.chain.from_iterable(self._row_blocks(data))
         self.data = data
         self.fields = fields
 
@@ -542,4 +736,129 @@ class FeatureStream(object):
     def next(self):
         return self.data.next()
 
+    def _row_blocks(self, blocks):
+        # Blocks taken by the rows iterator: the following ones must be too.
+        for block in blocks:
+            self._blocks = None
+            yield block
+
+    def batches(self, size=None):
+        """
+        Yields the features by lists of at most *size* rows (tuples), directly from the
+        blocks of the producer if there are any, otherwise from `cursor.fetchmany`
+        or by slices of the iterator. Iterating over the rows and over the batches of a
+        same stream consumes the same data: use one or the other.
+
+        :param size: (int) maximum number of rows per list. [10000]
+        :rtype: iterator over lists of tuples
+        """
+        size = size or _batch_rows
+        if self._blocks is not None:
+            for block in self._blocks:
+                for batch in _cut(block,size): yield batch
+        elif hasattr(self.data,'fetchmany'):
+            while 1:
+                batch = self.data.fetchmany(size)
+                if not batch: break
+                yield batch
+        else:
+            from itertools import islice
+            while 1:
+                batch = list(islice(self.data,size))
+                if not batch: break
+                yield batch
+
+_batch_rows = 10000 # default number of rows of FeatureStream.batches
+
+def _cut(block, size):
+    """Splits the list *block* in lists of at most *size* rows."""
+    if len(block) <= size:
+        if block: yield block
+        return
+    for n in xrange(0,len(block),size):
+        yield block[n:n+size]
+
+_array_chunk_size = 2**16 # rows per chunk of an ArrayFeatureStream built from rows
+
+def _column_array(values):
+    """Numpy array of a column of *values*: numbers get a numeric type, other values
+    (e.g. strings) are kept as Python objects."""
+    import numpy
+    if len(values) and isinstance(values[0],(int,long,float)):
+        column = numpy.asarray(values)
+        if column.dtype.kind in 'biuf' and column.ndim == 1:
+            return column
+    column = numpy.empty(len(values),dtype=object)
+    column[:] = values
+    return column
+
+class ArrayFeatureStream(FeatureStream):
+    """
+    A FeatureStream carrying its features by chunks of rows, each chunk being a dict
+    ``{field: column}`` of numpy arrays of the same length (numeric types for numbers,
+    objects otherwise), so that operations can process a whole chunk at once.
+    Iterating over it still yields tuples, as for a FeatureStream.
+
+    Example::
+
+        >>> import numpy
+        >>> stream = ArrayFeatureStream([{'chr': numpy.array(['chr1','chr1'],dtype=object),
+        ...                               'start': numpy.array([1,3]), 'end': numpy.array([2,4])}],
+        ...                             fields=['chr','start','end'])
+        >>> list(stream)
+        [('chr1', 1, 2), ('chr1', 3, 4)]
+
+    .. attribute:: chunks
+
+        An iterator over the chunks (dicts of numpy arrays). Iterating over the stream also
+        consumes it: use either the chunks or the tuples.
+    """
+    def __init__(self, chunks, fields):
+        if isinstance(chunks,(list,tuple)):
+            chunks = iter(chunks)
+        self.chunks = chunks
+        self.fields = fields
+        self.data = self._rows()
+        self._blocks = None
+
+    def _rows(self):
+        from itertools import izip
+        for chunk in self.chunks:
+            for row in izip(*[chunk[f].tolist() for f in self.fields]): yield row
+
+    def batches(self, size=None):
+        """Yields the rows of each chunk by lists of at most *size* tuples. [10000]"""
+        size = size or _batch_rows
+        for chunk in self.chunks:
+            for batch in _cut(zip(*[chunk[f].tolist() for f in self.fields]),size): yield batch
+
+def _array_chunks(stream, size):
+    for batch in stream.batches(size):
+        yield dict((f,_column_array(col)) for f,col in zip(stream.fields,zip(*batch)))
+
+def _cut_chunks(chunks, fields, size):
+    """Chunks of at most *size* rows: larger ones are cut into views of their arrays."""
+    for chunk in chunks:
+        n = len(chunk[fields[0]])
+        if n <= size:
+            yield chunk
+            continue
+        for k in xrange(0,n,size):
+            yield dict((f,a[k:k+size]) for f,a in chunk.iteritems())
+
+def array_stream(stream, size=None):
+    """
+    Returns *stream* as an ArrayFeatureStream, itself if it is already one and no *size*
+    is given.
+
+    :param stream: FeatureStream object.
+    :param size: (int) maximum number of rows per chunk; the chunks of an ArrayFeatureStream
+        larger than *size* are cut. [65536]
+    :rtype: ArrayFeatureStream
+    """
+    if isinstance(stream,ArrayFeatureStream):
+        if size is None or not stream.fields: return stream
+        return ArrayFeatureStream(_cut_chunks(stream.chunks,stream.fields,size),fields=stream.fields)
+    return ArrayFeatureStream(_array_chunks(stream,size or _array_chunk_size),fields=stream.fields)
+
 ################################################################################
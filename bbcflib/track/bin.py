@@ -1,6 +1,7 @@
 from bbcflib.track import *
 from bbcflib.common import program_exists
-import subprocess, tempfile, os
+import subprocess, os, sys, struct, zlib, math
+from bisect import bisect_right
 
 
 class BinTrack(Track):
@@ -39,7 +40,482 @@ class BinTrack(Track):
         return reg
 
 
-############################# BigWig via UCSC tools ##############################
+################################ BigWig format ##################################
+
+_bigwig_magic = 0x888FFC26
+_bptree_magic = 0x78CA8C91
+_rtree_magic = 0x2468ACE0
+
+class BigWigFile(object):
+    """
+    Native reader for `bigWig <http://genome.ucsc.edu/goldenPath/help/bigWig.html>`_ files.
+    Parses the header, the chromosome B+ tree and the R-tree indexes of the data and of
+    the zoom levels, so that a query only decompresses the blocks overlapping it.
+
+    :param path: (str) file name.
+
+    .. attribute:: chroms
+
+       Dictionary `{chr: (chromosome id, length)}`.
+
+    .. attribute:: zoom_levels
+
+       List of `(reduction, data offset, index offset)` sorted by increasing reduction level
+       (number of bases summarized by a zoom record).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.filehandle = open(path,'rb')
+        head = self.filehandle.read(64)
+        if len(head) < 64:
+            raise ValueError("Not a bigWig file: %s." % path)
+        for endian in '<>':
+            if struct.unpack(endian+'I',head[:4])[0] == _bigwig_magic: break
+        else:
+            raise ValueError("Not a bigWig file: %s." % path)
+        self._endian = endian
+        (self.version, nzooms, chrom_tree, self._data_offset, self._index_offset,
+         fields, defined_fields, autosql, summary, self._uncompress) \
+            = struct.unpack(endian+'HHQQQHHQQI',head[4:56])
+        self.zoom_levels = []
+        zooms = self.filehandle.read(24*nzooms)
+        for n in xrange(nzooms):
+            reduction,reserved,data,index = struct.unpack(endian+'IIQQ',zooms[24*n:24*(n+1)])
+            self.zoom_levels.append((reduction,data,index))
+        self.zoom_levels.sort()
+        self.chroms = self._read_chrom_tree(chrom_tree)
+        self._chrom_names = dict((v[0],k) for k,v in self.chroms.iteritems())
+
+    def close(self):
+        self.filehandle.close()
+
+    def _read(self, offset, size):
+        self.filehandle.seek(offset)
+        return self.filehandle.read(size)
+
+    def _read_chrom_tree(self, offset):
+        magic,block_size,key_size,val_size,item_count,reserved \
+            = struct.unpack(self._endian+'IIIIQQ',self._read(offset,32))
+        if magic != _bptree_magic:
+            raise ValueError("Bad chromosome index in bigWig file %s." % self.path)
+        chroms = {}
+        nodes = [offset+32]
+        while nodes:
+            is_leaf,reserved,count = struct.unpack(self._endian+'BBH',self._read(nodes.pop(),4))
+            item_size = key_size+(val_size if is_leaf else 8)
+            items = self.filehandle.read(count*item_size)
+            for n in xrange(count):
+                item = items[n*item_size:(n+1)*item_size]
+                if is_leaf:
+                    chrom_id,length = struct.unpack(self._endian+'II',item[key_size:key_size+8])
+                    chroms[item[:key_size].rstrip('\x00')] = (chrom_id,length)
+                else:
+                    nodes.append(struct.unpack(self._endian+'Q',item[key_size:])[0])
+        return chroms
+
+    def _blocks(self, index_offset, chrom_id, start, end):
+        """Sorted list of `(offset,size)` of the data blocks overlapping *start*-*end*
+        in chromosome *chrom_id*, from the R-tree at *index_offset*."""
+        head = struct.unpack(self._endian+'IIQIIIIQII',self._read(index_offset,48))
+        if head[0] != _rtree_magic:
+            raise ValueError("Bad data index in bigWig file %s." % self.path)
+        qstart = (chrom_id,start)
+        qend = (chrom_id,end)
+        blocks = []
+        nodes = [index_offset+48]
+        while nodes:
+            is_leaf,reserved,count = struct.unpack(self._endian+'BBH',self._read(nodes.pop(),4))
+            if is_leaf:
+                items = struct.unpack(self._endian+'IIIIQQ'*count,self.filehandle.read(32*count))
+                step = 6
+            else:
+                items = struct.unpack(self._endian+'IIIIQ'*count,self.filehandle.read(24*count))
+                step = 5
+            for n in xrange(0,len(items),step):
+                if (items[n+2],items[n+3]) > qstart and (items[n],items[n+1]) < qend:
+                    if is_leaf: blocks.append((items[n+4],items[n+5]))
+                    else: nodes.append(items[n+4])
+        return sorted(blocks)
+
+    def _block_data(self, offset, size):
+        data = self._read(offset,size)
+        if self._uncompress: data = zlib.decompress(data)
+        return data
+
+    def intervals(self, chrom, start=0, end=None):
+        """
+        Yields the `(start,end,score)` data items of chromosome *chrom* overlapping
+        `[start,end)`, in file order. Scores are single precision floats.
+        """
+        if chrom not in self.chroms: return
+        chrom_id,length = self.chroms[chrom]
+        if end is None: end = length
+        e = self._endian
+        for offset,size in self._blocks(self._index_offset,chrom_id,start,end):
+            data = self._block_data(offset,size)
+            cid,sstart,send,step,span,stype,reserved,count = struct.unpack(e+'IIIIIBBH',data[:24])
+            if cid != chrom_id: continue
+            if stype == 1: # bedGraph
+                items = struct.unpack(e+'IIf'*count,data[24:24+12*count])
+                starts,ends,scores = items[0::3],items[1::3],items[2::3]
+            elif stype == 2: # variableStep
+                items = struct.unpack(e+'If'*count,data[24:24+8*count])
+                starts,scores = items[0::2],items[1::2]
+                ends = [x+span for x in starts]
+            elif stype == 3: # fixedStep
+                scores = struct.unpack(e+'f'*count,data[24:24+4*count])
+                starts = xrange(sstart,sstart+step*count,step)
+                ends = [x+span for x in starts]
+            else:
+                raise ValueError("Unknown section type %i in bigWig file %s." % (stype,self.path))
+            for item in zip(starts,ends,scores):
+                if item[1] > start and item[0] < end: yield item
+
+    def _zoom_records(self, level, chrom_id, start, end):
+        """Yields `(start,end,valid_count,min,max,sum,sum_squares)` zoom records of
+        *level* overlapping `[start,end)` in chromosome *chrom_id*."""
+        e = self._endian
+        for offset,size in self._blocks(level[2],chrom_id,start,end):
+            data = self._block_data(offset,size)
+            items = struct.unpack(e+'IIIIffff'*(len(data)//32),data[:32*(len(data)//32)])
+            for n in xrange(0,len(items),8):
+                if items[n] == chrom_id and items[n+2] > start and items[n+1] < end:
+                    yield items[n+1:n+8]
+
+    def summary(self, chrom, start=0, end=None, nbins=1, stat='mean', exact=False):
+        """
+        Statistics of the scores in *nbins* equal bins dividing `[start,end)` in *chrom*,
+        computed as *bigWigSummary* does: from the zoom level with the largest reduction
+        not greater than half the size of a bin, or from the data itself if there is none
+        or if *exact* is True. Bins without data get None.
+
+        :param stat: (str) one of 'mean','min','max','std','coverage' (fraction of bases with data).
+        :rtype: list of floats.
+        """
+        if chrom not in self.chroms: return [None]*nbins
+        chrom_id,length = self.chroms[chrom]
+        if end is None: end = length
+        bounds = [start+(end-start)*n//nbins for n in xrange(nbins+1)]
+        count = [0.0]*nbins
+        smin = [None]*nbins
+        smax = [None]*nbins
+        ssum = [0.0]*nbins
+        ssq = [0.0]*nbins
+        level = None
+        if not exact:
+            reduction = (end-start)//nbins//2
+            for z in self.zoom_levels:
+                if z[0] <= reduction: level = z
+        if level is None:
+            records = ((s,e,e-s,v,v,v*(e-s),v*v*(e-s)) for s,e,v in self.intervals(chrom,start,end))
+        else:
+            records = self._zoom_records(level,chrom_id,start,end)
+        for s,e,n,vmin,vmax,vsum,vsq in records:
+            b = max(0,bisect_right(bounds,s)-1)
+            while b < nbins and bounds[b] < e:
+                overlap = min(e,bounds[b+1])-max(s,bounds[b])
+                if overlap > 0:
+                    factor = float(overlap)/(e-s)
+                    count[b] += n*factor
+                    ssum[b] += vsum*factor
+                    ssq[b] += vsq*factor
+                    if smin[b] is None or vmin < smin[b]: smin[b] = vmin
+                    if smax[b] is None or vmax > smax[b]: smax[b] = vmax
+                b += 1
+        result = []
+        for b in xrange(nbins):
+            n = count[b]
+            if n <= 0:
+                result.append(None)
+            elif stat == 'mean':
+                result.append(ssum[b]/n)
+            elif stat == 'min':
+                result.append(smin[b])
+            elif stat == 'max':
+                result.append(smax[b])
+            elif stat == 'coverage':
+                result.append(n/(bounds[b+1]-bounds[b]))
+            elif stat == 'std':
+                var = ssq[b]-ssum[b]*ssum[b]/n
+                if n > 1: var /= n-1
+                result.append(math.sqrt(max(var,0)))
+            else:
+                raise ValueError("Unknown summary statistic: %s." % stat)
+        return result
+
+_bigwig_items_per_slot = 1024
+_bigwig_block_size = 256
+_bigwig_max_zooms = 10
+
+def _tree_levels(nitems, block_size):
+    """Number of nodes of each level of a tree with *nitems* leaf items, from the root down."""
+    levels = [max(1,-(-nitems // block_size))]
+    while levels[0] > 1:
+        levels.insert(0,-(-levels[0] // block_size))
+    return levels
+
+class _BigWigWriter(object):
+    """
+    Writes a bigWig file as rows arrive: data items are packed into compressed blocks of
+    *_bigwig_items_per_slot* items, zoom records are accumulated for every zoom level
+    at the same time (each level summarizing the records of the previous one) and
+    written by blocks as well. The chromosome tree, the R-tree indexes and the header
+    are written by `close`.
+
+    Rows must be grouped by chromosome and sorted by start within each chromosome.
+
+    :param path: (str) file name.
+    :param chrmeta: (dict) chromosome lengths. Chromosomes absent from *chrmeta*
+        get the largest end coordinate written as length.
+    """
+    def __init__(self, path, chrmeta=None):
+        self.path = path
+        self.chrmeta = chrmeta or {}
+        self.filehandle = open(path,'wb')
+        self.filehandle.write('\x00'*(64+24*_bigwig_max_zooms+40))
+        self._data_offset = self.filehandle.tell()
+        self.filehandle.write('\x00'*8)
+        self.chrom_ids = {}
+        self._chrom_ends = []
+        self._chrom = None
+        self._chrom_size = sys.maxint
+        self._last_start = -1
+        self._items = []
+        self._data_blocks = []
+        self._uncompress = 0
+        self._pending = [] # items waiting for the zoom levels to be decided
+        self.reductions = None
+        self._zooms = []
+        self._total = [0,None,None,0.0,0.0]
+
+    def _write_block(self, data):
+        self._uncompress = max(self._uncompress,len(data))
+        data = zlib.compress(data)
+        offset = self.filehandle.tell()
+        self.filehandle.write(data)
+        return (offset,len(data))
+
+    def _flush_items(self):
+        if not self._items: return
+        cid = self.chrom_ids[self._chrom]
+        n = len(self._items)
+        end = max(item[1] for item in self._items)
+        flat = [x for item in self._items for x in item]
+        data = struct.pack('<IIIIIBBH',cid,self._items[0][0],end,0,0,1,0,n) \
+            + struct.pack('<'+'IIf'*n,*flat)
+        self._data_blocks.append((cid,self._items[0][0],cid,end)+self._write_block(data))
+        self._items = []
+
+    def add(self, chrom, start, end, score):
+        """Adds one data item, *start* and *end* being 0-based, end excluded."""
+        if chrom != self._chrom:
+            if chrom in self.chrom_ids:
+                raise ValueError("BigWig data must be grouped by chromosome: %s found twice." % chrom)
+            self._flush_items()
+            self.chrom_ids[chrom] = len(self.chrom_ids)
+            self._chrom_ends.append(0)
+            self._chrom = chrom
+            self._chrom_size = self.chrmeta.get(chrom,{}).get('length') or sys.maxint
+            self._last_start = -1
+        if start < self._last_start:
+            raise ValueError("BigWig data must be sorted: %s:%i after %s:%i." \
+                                 % (chrom,start,chrom,self._last_start))
+        if end > self._chrom_size:
+            raise ValueError("Feature %s:%i-%i exceeds chromosome length %i." \
+                                 % (chrom,start,end,self._chrom_size))
+        if end <= start: return
+        self._last_start = start
+        cid = self.chrom_ids[chrom]
+        if end > self._chrom_ends[cid]: self._chrom_ends[cid] = end
+        self._items.append((start,end,score))
+        if len(self._items) >= _bigwig_items_per_slot: self._flush_items()
+        if self.reductions is None:
+            self._pending.append((cid,start,end,score,self._chrom_size))
+            if len(self._pending) >= _bigwig_items_per_slot: self._init_zooms()
+        else:
+            self._add_zoom(cid,start,end,score,self._chrom_size)
+
+    ######## Zoom levels ########
+    def _init_zooms(self):
+        """Chooses the zoom levels from the mean item size, as bedGraphToBigWig does:
+        the first one summarizes about 10 items per record, the next ones 4 times more each."""
+        self.reductions = []
+        if self._pending:
+            mean_size = sum(x[2]-x[1] for x in self._pending)/float(len(self._pending))
+            longest = max([v.get('length',0) for v in self.chrmeta.values()]
+                          +[x[2] for x in self._pending])
+            reduction = max(10,int(10*mean_size))
+            while len(self.reductions) < _bigwig_max_zooms and reduction <= longest:
+                self.reductions.append(reduction)
+                reduction *= 4
+            if not self.reductions: self.reductions.append(reduction)
+        # for each level: current record, block of records, [count of records, data offset], R-tree leaves
+        self._zooms = [[None,[],[0,None],[]] for r in self.reductions]
+        pending = self._pending
+        self._pending = []
+        for item in pending: self._add_zoom(*item)
+
+    def _add_zoom(self, cid, start, end, score, size):
+        reduction = self.reductions[0]
+        zoom = self._zooms[0]
+        while start < end:
+            rec = zoom[0]
+            if rec is None or rec[0] != cid or start >= rec[2]:
+                if rec is not None: self._emit_record(0,rec)
+                rec = zoom[0] = [cid,start,min(start+reduction,size),0,score,score,0.0,0.0]
+            overlap = min(end,rec[2])-start
+            rec[3] += overlap
+            if score < rec[4]: rec[4] = score
+            if score > rec[5]: rec[5] = score
+            rec[6] += score*overlap
+            rec[7] += score*score*overlap
+            start += overlap
+
+    def _emit_record(self, level, rec):
+        """Adds a finished zoom record of *level* to its block, and to the record of the next level."""
+        zoom = self._zooms[level]
+        if zoom[1] and zoom[1][0][0] != rec[0]: self._flush_zoom(level)
+        zoom[1].append(rec)
+        if len(zoom[1]) >= _bigwig_items_per_slot: self._flush_zoom(level)
+        if level == 0:
+            total = self._total
+            total[0] += rec[3]
+            if total[1] is None or rec[4] < total[1]: total[1] = rec[4]
+            if total[2] is None or rec[5] > total[2]: total[2] = rec[5]
+            total[3] += rec[6]
+            total[4] += rec[7]
+        level += 1
+        if level >= len(self._zooms): return
+        upper = self._zooms[level][0]
+        if upper is None or upper[0] != rec[0] or rec[2] > upper[1]+self.reductions[level]:
+            if upper is not None: self._emit_record(level,upper)
+            self._zooms[level][0] = list(rec)
+        else:
+            upper[2] = rec[2]
+            upper[3] += rec[3]
+            if rec[4] < upper[4]: upper[4] = rec[4]
+            if rec[5] > upper[5]: upper[5] = rec[5]
+            upper[6] += rec[6]
+            upper[7] += rec[7]
+
+    def _flush_zoom(self, level):
+        zoom = self._zooms[level]
+        records = zoom[1]
+        if not records: return
+        if zoom[2][1] is None: # record count, filled by `close`
+            zoom[2][1] = self.filehandle.tell()
+            self.filehandle.write('\x00'*4)
+        zoom[2][0] += len(records)
+        data = ''.join(struct.pack('<IIIIffff',*r) for r in records)
+        zoom[3].append((records[0][0],records[0][1],records[-1][0],records[-1][2])+self._write_block(data))
+        zoom[1] = []
+
+    ######## Indexes ########
+    def _write_rtree(self, leaves):
+        """Writes the R-tree of the blocks *leaves* `(chr,start,chr,end,offset,size)`, returns its offset."""
+        f = self.filehandle
+        index_offset = f.tell()
+        block_size = _bigwig_block_size
+        if leaves:
+            bounds = (leaves[0][0],leaves[0][1])+max((x[2],x[3]) for x in leaves)
+        else:
+            bounds = (0,0,0,0)
+        f.write(struct.pack('<IIQIIIIQII',_rtree_magic,block_size,len(leaves),
+                            bounds[0],bounds[1],bounds[2],bounds[3],
+                            self._data_end,_bigwig_items_per_slot,0))
+        levels = _tree_levels(len(leaves),block_size)
+        # bounds of every node at every level, from the leaves up
+        nodes = [leaves]
+        for n in range(len(levels)-1):
+            below = nodes[0]
+            nodes.insert(0,[(below[k][0],below[k][1])+max((x[2],x[3]) for x in below[k:k+block_size])
+                            for k in xrange(0,len(below),block_size)])
+        offset = f.tell()
+        for depth,nnodes in enumerate(levels):
+            is_leaf = depth == len(levels)-1
+            item_size = 32 if is_leaf else 24
+            node_size = 4+item_size*block_size
+            child_offset = offset+nnodes*node_size
+            child_size = 4+(32 if depth+1 == len(levels)-1 else 24)*block_size
+            items = nodes[depth]
+            for k in xrange(nnodes):
+                chunk = items[k*block_size:(k+1)*block_size]
+                f.write(struct.pack('<BBH',int(is_leaf),0,len(chunk)))
+                for n,x in enumerate(chunk):
+                    if is_leaf:
+                        f.write(struct.pack('<IIIIQQ',*x))
+                    else:
+                        child = k*block_size+n
+                        f.write(struct.pack('<IIIIQ',x[0],x[1],x[2],x[3],child_offset+child*child_size))
+                f.write('\x00'*(item_size*(block_size-len(chunk))))
+            offset = child_offset
+        return index_offset
+
+    def _write_chrom_tree(self):
+        """Writes the B+ tree of chromosome names, ids and lengths, returns its offset."""
+        f = self.filehandle
+        chroms = dict((c,(cid,self.chrmeta.get(c,{}).get('length') or self._chrom_ends[cid]))
+                      for c,cid in self.chrom_ids.iteritems())
+        for c in sorted(self.chrmeta):
+            if c not in chroms: chroms[c] = (len(chroms),self.chrmeta[c].get('length',0))
+        items = sorted(chroms.iteritems())
+        key_size = max([len(c) for c in chroms]+[1])
+        block_size = max(1,min(_bigwig_block_size,len(items)))
+        tree_offset = f.tell()
+        f.write(struct.pack('<IIIIQQ',_bptree_magic,block_size,key_size,8,len(items),0))
+        levels = _tree_levels(len(items),block_size)
+        node_size = 4+block_size*(key_size+8)
+        offset = f.tell()
+        for depth,nnodes in enumerate(levels):
+            is_leaf = depth == len(levels)-1
+            # number of leaf items below each item of a node at this depth
+            span = block_size**(len(levels)-1-depth)
+            child_offset = offset+nnodes*node_size
+            for k in xrange(nnodes):
+                first = k*block_size
+                keys = items[first*span:(first+block_size)*span:span]
+                f.write(struct.pack('<BBH',int(is_leaf),0,len(keys)))
+                for n,(c,v) in enumerate(keys):
+                    f.write(c.ljust(key_size,'\x00'))
+                    if is_leaf: f.write(struct.pack('<II',*v))
+                    else: f.write(struct.pack('<Q',child_offset+(first+n)*node_size))
+                f.write('\x00'*((key_size+8)*(block_size-len(keys))))
+            offset = child_offset
+        return tree_offset
+
+    def close(self):
+        if self.filehandle.closed: return
+        self._flush_items()
+        if self.reductions is None: self._init_zooms()
+        for level in range(len(self._zooms)):
+            if self._zooms[level][0] is not None:
+                self._emit_record(level,self._zooms[level][0])
+                self._zooms[level][0] = None
+            self._flush_zoom(level)
+        f = self.filehandle
+        self._data_end = f.tell()
+        chrom_tree = self._write_chrom_tree()
+        full_index = self._write_rtree(self._data_blocks)
+        zoom_headers = []
+        for reduction,zoom in zip(self.reductions,self._zooms):
+            if zoom[2][1] is None: continue
+            zoom_headers.append(struct.pack('<IIQQ',reduction,0,zoom[2][1],self._write_rtree(zoom[3])))
+            f.seek(zoom[2][1])
+            f.write(struct.pack('<I',zoom[2][0]))
+            f.seek(0,2)
+        f.write(struct.pack('<I',_bigwig_magic))
+        f.seek(0)
+        summary_offset = 64+24*_bigwig_max_zooms
+        f.write(struct.pack('<IHHQQQHHQQIQ',_bigwig_magic,4,len(zoom_headers),chrom_tree,
+                            self._data_offset,full_index,0,0,0,summary_offset,self._uncompress,0))
+        f.write(''.join(zoom_headers))
+        f.seek(summary_offset)
+        total = self._total
+        f.write(struct.pack('<Qdddd',total[0],total[1] or 0.0,total[2] or 0.0,total[3],total[4]))
+        f.write(struct.pack('<Q',len(self._data_blocks)))
+        f.close()
+
+############################## BigWig track ##################################
 
 class BigWigTrack(BinTrack):
     """
@@ -49,73 +525,165 @@ class BigWigTrack(BinTrack):
 
         ['chr','start','end','score']
 
-    will use *bedGraphToBigWig* (write) and *bigWigToBedGraph* (read) and use
-    the BedGraphTrack class.
+    Reading and writing are native (see `BigWigFile`): reading only decompresses the data
+    blocks overlapping the selection, and rows are compressed as they are written, together with
+    the zoom levels, the indexes being completed when the track is closed.
     """
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'bigWig'
         kwargs['fields'] = ['chr','start','end','score']
         BinTrack.__init__(self,path,**kwargs)
-        self.bedgraph = None
-        self.chrfile = None
+        self.writer = None
 
     def open(self):
-        if self.bedgraph is None:
-            tmp = tempfile.NamedTemporaryFile(dir='./')
-            self.bedgraph = os.path.abspath(tmp.name)
-            tmp.close()
+        if self.writer is None:
+            self.writer = _BigWigWriter(self.path,self.chrmeta)
 
     def close(self):
-        if self.chrfile and self.bedgraph:
-            try:
-                self._run_tool('bedGraphToBigWig', [self.bedgraph, self.chrfile, self.path])
-            except OSError as ose:
-                os.remove(self.chrfile)
-                os.remove(self.bedgraph)
-                raise OSError(ose)
-        if self.chrfile is not None:
-            os.remove(self.chrfile)
-            self.chrfile = None
-        if self.bedgraph is not None:
-            if os.path.exists(self.bedgraph):
-                os.remove(self.bedgraph)
-            self.bedgraph = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def _get_chrmeta(self,chrmeta=None):
+        """Chromosome names and lengths default to the ones stored in the file."""
+        _chrmeta = BinTrack._get_chrmeta(self,chrmeta)
+        if _chrmeta or not(os.path.exists(self.path) and os.path.getsize(self.path)):
+            return _chrmeta
+        try:
+            bw = BigWigFile(self.path)
+        except (IOError,ValueError,struct.error):
+            return _chrmeta
+        bw.close()
+        return dict((c,{'length': v[1]}) for c,v in bw.chroms.iteritems())
 
     def read(self, selection=None, fields=None, **kw):
         """
+        Rows are the data items as output by *bigWigToBedGraph*, scores rounded to 6 significant
+        digits. Chromosomes come in the order of the file index. If *selection* is a single
+        chromosome or dict, rows are clipped to its 'start'-'end' range.
+
         :param selection: list of dict of the type
             `[{'chr':'chr1','start':(12,24)},{'chr':'chr3','end':(25,45)},...]`,
-            where tuples represent ranges.
+            where tuples represent ranges, or a FeatureStream.
         :param fields: (list of str) list of field names.
         """
-        self.open()
         if not(fields): fields = self.fields
         fields = [f for f in self.fields if f in fields]
-        reg = self._make_selection(selection)
-        options = []
-        if reg[0]: options += ["-chrom="+reg[0]]
-        if reg[1]: options += ["-start="+reg[1]]
-        if reg[2]: options += ["-end="+reg[2]]
-        self._run_tool('bigWigToBedGraph', options+[self.path, self.bedgraph])
-        t = track(self.bedgraph,format='bedGraph',chrmeta=self.chrmeta,info=self.info)
-        return t.read(selection=selection,fields=fields,**kw)
-
-    def write(self, source, **kw):
-        if self.chrfile is None:
-            self.chrfile = tempfile.NamedTemporaryFile(dir='./',delete=False)
-            for c,v in self.chrmeta.iteritems():
-                self.chrfile.write("%s %i\n"%(c,v['length']))
-            self.chrfile.close()
-            self.chrfile = os.path.abspath(self.chrfile.name)
-        self.open()
-        kw['mode'] = 'append'
+        srcl = [self.fields.index(f) for f in fields]
+        clip = self._make_selection(selection)
+        if not isinstance(selection,(dict,basestring)): clip = [None,None,None]
+        if isinstance(selection,FeatureStream):
+            chr_idx = selection.fields.index('chr')
+            start_idx = selection.fields.index('start')
+            end_idx = selection.fields.index('end')
+            selection = [{'chr': feat[chr_idx],
+                          'start': (-1,feat[end_idx]),
+                          'end': (feat[start_idx],sys.maxint)} for feat in selection]
+        if isinstance(selection,basestring):
+            selection = [selection]
+        if isinstance(selection,(list,tuple)) and selection and isinstance(selection[0],basestring):
+            selection = {'chr': [str(x) for x in selection]}
+        if isinstance(selection,dict):
+            selection = [selection]
+        bw = BigWigFile(self.path)
+        regions = {}
+        for chrom in bw.chroms:
+            windows = []
+            for sel in selection or [{}]:
+                c = sel.get('chr',chrom)
+                if chrom != c and not(isinstance(c,(list,tuple)) and chrom in c): continue
+                windows.append(self._window(sel))
+            if windows: regions[chrom] = windows
+        clip_start = int(clip[1] or 0)
+        clip_end = int(clip[2] or sys.maxint)
+
+        def _bwrecord():
+            for chrom in sorted(regions):
+                merged = []
+                for start,end in sorted(regions[chrom]):
+                    if merged and start <= merged[-1][1]:
+                        merged[-1][1] = max(end,merged[-1][1])
+                    elif end > start:
+                        merged.append([start,end])
+                last_end = -1
+                for start,end in merged:
+                    for s,e,v in bw.intervals(chrom,start,min(end,bw.chroms[chrom][1])):
+                        if s < last_end: continue # already seen in the previous window
+                        row = (chrom,max(s,clip_start),min(e,clip_end),float('%g' % v))
+                        if row[1] >= row[2]: continue
+                        if selection and not any(self._select_values(row,sel) for sel in selection):
+                            continue
+                        yield tuple([row[n] for n in srcl])
+                    last_end = end
+            bw.close()
+        return FeatureStream(_bwrecord(),fields)
+
+    def _window(self, sel):
+        """Range `[start,end)` containing all items that can pass the selection *sel*."""
+        start = 0
+        end = sys.maxint
+        if 'start' in sel:
+            v = sel['start']
+            if isinstance(v,(list,tuple)):
+                start = max(start,int(v[0]))
+                end = min(end,int(v[1])+1)
+            else:
+                start = max(start,int(v))
+                end = min(end,int(v)+1)
+        if 'end' in sel:
+            v = sel['end']
+            if isinstance(v,(list,tuple)):
+                start = max(start,int(v[0])-1)
+                end = min(end,int(v[1]))
+            else:
+                start = max(start,int(v)-1)
+                end = min(end,int(v))
+        return (max(start,0),max(end,0))
+
+    def summary(self, chrom, start=0, end=None, nbins=1, stat='mean', exact=False):
+        """
+        Summary statistics of the scores in *nbins* bins of `[start,end)` in *chrom*,
+        using the zoom levels of the file (see `BigWigFile.summary`).
+        """
+        bw = BigWigFile(self.path)
         try:
-            with track(self.bedgraph,format='bedgraph',chrmeta=self.chrmeta) as f:
-                f.write(source,**kw)
-        except:
-            os.remove(self.chrfile)
-            os.remove(self.bedgraph)
-            raise
+            return bw.summary(chrom,start,end,nbins=nbins,stat=stat,exact=exact)
+        finally:
+            bw.close()
+
+    def write(self, source, fields=None, chrom=None, **kw):
+        """
+        Add data to the track. Successive calls add rows to the same file until the track is closed;
+        rows must be grouped by chromosome and sorted by start.
+
+        :param source: (FeatureStream) data to be added to the track.
+        :param fields: list of field names, if *source* has no 'fields' attribute.
+        :param chrom: (str) a chromosome name, if *source* has no 'chr' field.
+        :param clip: (bool) clip features to the chromosome bounds given by chrmeta. [False]
+        """
+        if hasattr(source, 'fields'):
+            srcfields = source.fields
+        elif fields is None:
+            srcfields = self.fields
+        else:
+            srcfields = fields
+        if chrom is not None and self.chrmeta and not(chrom in self.chrmeta):
+            raise ValueError("Chromosome %s not found in %s." %(chrom,self.chrmeta))
+        chridx = srcfields.index('chr') if chrom is None else None
+        sidx = srcfields.index('start')
+        eidx = srcfields.index('end')
+        scidx = srcfields.index('score') if 'score' in srcfields else None
+        clip = kw.get('clip')
+        self.open()
+        add = self.writer.add
+        for row in source:
+            c = chrom if chridx is None else str(row[chridx])
+            start = int(row[sidx])
+            end = int(row[eidx])
+            if clip:
+                start = max(0,start)
+                end = min(end,self.chrmeta.get(c,{}).get('length',sys.maxint))
+            add(c,start,end,0.0 if scidx is None else float(row[scidx]))
 
 ################################ Bam via pysam ################################
 
@@ -1,5 +1,6 @@
 from bbcflib.track import *
-import sqlite3
+import sqlite3, itertools, threading, urllib, os, struct
+from operator import itemgetter
 
 _sql_types = {'start':        'integer',
               'end':          'integer',
@@ -10,6 +11,76 @@ _sql_types = {'start':        'integer',
               'block_count':  'integer',
               'frame':        'integer'}
 
+def _rtree_module():
+    """SQLite module for the region index tables: 'rtree_i32' (integer coordinates) if available,
+    else 'rtree', or None if SQLite was compiled without R*Tree support."""
+    global _rtree
+    if _rtree is False:
+        _rtree = None
+        connection = sqlite3.connect(':memory:')
+        for module in ['rtree_i32','rtree']:
+            try:
+                connection.execute("CREATE VIRTUAL TABLE test USING %s(id,start,end)" % module)
+                _rtree = module
+                break
+            except sqlite3.OperationalError:
+                pass
+        connection.close()
+    return _rtree
+_rtree = False
+
+def _uri_filenames():
+    """True if SQLite opens 'file:' URIs (compiled with SQLITE_USE_URI)."""
+    global _uri
+    if _uri is None:
+        connection = sqlite3.connect(':memory:')
+        _uri = ('USE_URI',) in connection.execute("PRAGMA compile_options").fetchall()
+        connection.close()
+    return _uri
+_uri = None
+
+_connections = {} # shared read-only connections: {(pid,path,inode,immutable): [connection,number of users]}
+_connections_lock = threading.Lock()
+
+def _connect_readonly(path, immutable=False):
+    """Read-only connection to the file *path*, shared by all the threads of the process which
+    read it, and its key in `_connections`. If *immutable* is True, SQLite assumes that the file
+    does not change and takes no lock."""
+    key = (os.getpid(),os.path.abspath(path),os.stat(path).st_ino,bool(immutable))
+    with _connections_lock:
+        if key in _connections:
+            _connections[key][1] += 1
+            return _connections[key][0],key
+        if _uri_filenames():
+            uri = "file:%s?mode=ro%s" % (urllib.quote(key[1]),"&immutable=1" if immutable else "")
+            connection = sqlite3.connect(uri, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(path, check_same_thread=False)
+        _connections[key] = [connection,1]
+        return connection,key
+
+def _release_readonly(key):
+    """Stops sharing the connection of `_connect_readonly` with this *key* once it has no more
+    users. It is not closed: streams returned by `read` keep it alive until they are consumed,
+    and it is closed when no longer referenced."""
+    with _connections_lock:
+        if not key in _connections: return
+        _connections[key][1] -= 1
+        if _connections[key][1] == 0:
+            _connections.pop(key)
+
+_regions_tables = itertools.count(1) # temporary tables of shared connections
+
+_rtree_min_rows = 10000 # smaller chromosome tables are read through their (start,end) index only
+_batch_size = 10000 # regions of a FeatureStream selection queried at once, rows inserted at once
+_bulk_pragmas = [('synchronous','OFF'),('journal_mode','MEMORY'),('cache_size',-256000)] # 256MB
+_native_types = (int,long,float,basestring,type(None))
+
+def _to_native(x):
+    """Python scalar for a numpy scalar *x*, string for any other value."""
+    if hasattr(x,'item') and not hasattr(x,'__len__'): return x.item()
+    return str(x)
+
 class SqlTrack(Track):
     """
     Track class for sqlite3 files (extension ".sql" or ".db").
@@ -17,7 +88,22 @@ class SqlTrack(Track):
 
     .. attribute:: readonly
 
-        If True, tables will not be updated to reflect, e.g. the chrmeta or info attributes.
+        If True, tables will not be updated to reflect, e.g. the chrmeta or info attributes,
+        and the file is opened read-only ('immutable' if the *immutable* argument is True: no
+        lock is taken, the file must not change while it is open). Otherwise an existing file
+        is also opened read-only until it is first modified (`open` or `write`).
+        Read-only connections are shared by the threads which read the same file.
+
+    .. attribute:: bulk
+
+        If True, `write` loads the data in a single transaction without journal nor disk
+        synchronization, and the indexes are created on `close`: the file is only
+        consistent once closed.
+
+    .. attribute:: indexed
+
+        If False, no index, R*Tree nor 'chrSummary' is written, e.g. for parts of a file
+        that are joined afterwards. [True]
 
     .. attribute:: connection
 
@@ -31,15 +117,40 @@ class SqlTrack(Track):
 
        The field types as defined in the sqlite3 tables.
 
+    Each chromosome table 'chr' of at least `_rtree_min_rows` rows comes with an R*Tree table
+    'chr_rtree' holding the 'start' and 'end' of its rows, filled on `write`, so that region queries
+    do not scan the rows ending before the region. Smaller tables, and files without it (or with
+    rows added since) are read with the (start,end) index only.
+
+    The table 'chrSummary' holds the number of rows, the fields and their min and max values for
+    each chromosome. It is written on `close` after `write`, and loaded when the track is created,
+    so that the fields and the whole chromosome ranges (`get_range`) are known without querying
+    each table. It is ignored if the file was modified since (by another program).
     """
     def __init__(self,path,**kwargs):
         self.readonly = kwargs.get('readonly',False)
-        self.connection = sqlite3.connect(path)
+        self.bulk = kwargs.get('bulk',False)
+        self.indexed = kwargs.get('indexed',True)
+        self._loading = None
+        self.immutable = kwargs.get('immutable',False)
+        self._rtrees = None
+        self._summary = None
+        self._modified = False
+        self._shared = None # key of the shared read-only connection, None if read-write
+        if os.path.exists(path):
+            self.connection,self._shared = _connect_readonly(path,self.immutable)
+        else:
+            self.connection = sqlite3.connect(path)
 #        self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
         kwargs['format'] = 'sql'
-        Track.__init__(self,path,**kwargs)
-        self.fields = self._get_fields(fields=self.fields)
+        try:
+            Track.__init__(self,path,**kwargs)
+            self._summary = self._load_summary()
+            self.fields = self._get_fields(fields=self.fields)
+        except:
+            self.close()
+            raise
         self.types = dict((k,v) for k,v in _sql_types.iteritems() if k in self.fields)
         if isinstance(kwargs.get('types'),dict): self.types.update(kwargs["types"])
 
@@ -47,14 +158,30 @@ class SqlTrack(Track):
         self._prepare_db()
 
     def close(self):
-        self.connection.commit()
+        if self._loading: self._end_bulk_load()
+        if self._modified and self.indexed: self._write_summary()
         self.cursor.close()
+        if self._shared:
+            _release_readonly(self._shared)
+            self._shared = False
+        elif self._shared is None:
+            self.connection.commit()
+
+    def _connect_readwrite(self):
+        """Replaces the shared read-only connection by a read-write one."""
+        if not self._shared: return
+        self.cursor.close()
+        _release_readonly(self._shared)
+        self._shared = None
+        self.connection = sqlite3.connect(self.path)
+        self.cursor = self.connection.cursor()
 
     @property
     def tables(self):
         """Returns the complete list of SQL tables."""
-        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        return [x[0].encode('ascii') for x in self.cursor.fetchall()]
+        # not through *self.cursor*, closed by `close` while streams may still read the file
+        cursor = self.connection.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return [x[0].encode('ascii') for x in cursor.fetchall()]
 
 ###### attributes #######
     def _fix_attributes(self,info=None):
@@ -116,15 +243,30 @@ class SqlTrack(Track):
             fields = self.fields
         try:
             fields_qry = ','.join(['"%s" %s'%(f,self.types.get(f,'text')) for f in fields if f != 'chr'])
+            tables = set(self.tables)
             for chrom in self.chrmeta:
+                if not chrom in tables: self._modify([chrom])
                 sql_command = "CREATE TABLE IF NOT EXISTS '%s' (%s)"%(chrom,fields_qry)
                 self.cursor.execute(sql_command)
                 self.cursor.execute("SELECT * FROM '%s' LIMIT 1" % chrom)
                 table_fields = [x[0] for x in self.cursor.description]
                 for field in fields:
                     if field == 'chr' or field in table_fields: continue
+                    self._modify([chrom])
                     sql_command = "ALTER TABLE '%s' ADD '%s' %s"%(chrom,field,self.types.get(field,'text'))
                     self.cursor.execute(sql_command)
+        except sqlite3.OperationalError as err:
+            raise Exception("Sql error: %s\n on file %s, with\n%s"%(err,self.path,sql_command))
+        if self.bulk: return True
+        return self._fix_indexes(fields)
+
+    def _fix_indexes(self,fields=None):
+        if not self.indexed: return True
+        if fields is None:
+            fields = self.fields
+        try:
+            for chrom in self.chrmeta:
+                if 'start' in fields and 'end' in fields:
                     sql_command = "CREATE INDEX IF NOT EXISTS '%s' ON '%s' (start,end)"%(chrom+"_range_idx",chrom)
                     self.cursor.execute(sql_command)
                 if 'score' in fields:
@@ -138,13 +280,36 @@ class SqlTrack(Track):
         return True
 
     def _prepare_db(self):
-        status = not(self.readonly) and \
-                 self._fix_attributes() and \
+        if self._loading: return True
+        if self.readonly or self.immutable: return False
+        self._connect_readwrite()
+        if self.bulk: self._begin_bulk_load()
+        status = self._fix_attributes() and \
                  self._fix_chrmeta() and \
                  self._fix_datatables()
         self.connection.commit()
         return status
 
+###### bulk load #######
+    def _begin_bulk_load(self):
+        """Sets the `_bulk_pragmas` until `close`, keeping their former values in `_loading`."""
+        self._loading = {}
+        self._clip_on_close = False
+        for pragma,value in _bulk_pragmas:
+            self._loading[pragma] = self.cursor.execute("PRAGMA %s" % pragma).fetchone()[0]
+            self.cursor.execute("PRAGMA %s=%s" % (pragma,value))
+
+    def _end_bulk_load(self):
+        """Commits the load, clips the features if requested, then creates the indexes."""
+        self.connection.commit()
+        if self._clip_on_close: self._clip()
+        else: self._update_rtree()
+        self._fix_indexes()
+        self.connection.commit()
+        for pragma,value in self._loading.iteritems():
+            self.cursor.execute("PRAGMA %s=%s" % (pragma,value))
+        self._loading = None
+
     def _get_info(self,info=None):
         if info: return info
         if 'attributes' in self.tables:
@@ -154,8 +319,12 @@ class SqlTrack(Track):
 
     def _get_fields(self,fields=None):
         if fields: return fields
+        if self._summary:
+            for chrom in self.chrmeta.keys():
+                if chrom in self._summary: return list(self._summary[chrom]['fields'])
+        tables = set(self.tables)
         for chrom in self.chrmeta.keys():
-            if chrom in self.tables:
+            if chrom in tables:
                 self.cursor.execute("SELECT * FROM '%s' LIMIT 1" % chrom)
                 return [x[0].encode('ascii') for x in self.cursor.description]
         return ['chr','start','end']
@@ -176,6 +345,137 @@ class SqlTrack(Track):
                 reason = "\nNeed to specify an assembly."
             raise Exception("Sql error: %s\n on file %s, with\n%s%s" % (err,self.path,sql_command,reason))
 
+###### chromosome summary #######
+    def _change_counter(self):
+        """File change counter of the SQLite header, incremented by each transaction
+        (not kept up to date in WAL mode)."""
+        with open(self.path,'rb') as f:
+            f.seek(24)
+            return struct.unpack('>I',f.read(4))[0] & 0x7fffffff
+
+    def _load_summary(self):
+        """Returns the content of the 'chrSummary' table as a dict
+        ``{chr: {'count': n, 'rtree': bool, 'fields': [...], 'min': {...}, 'max': {...}}}``
+        or None if the table is missing, or older than the last change of the file
+        (its version is the file change counter, stored as 'user_version')."""
+        try:
+            version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0 or version != self._change_counter(): return None
+            if self.cursor.execute("PRAGMA journal_mode").fetchone()[0] == 'wal': return None
+            self.cursor.execute("SELECT chr,field,min,max,count,rtree FROM 'chrSummary' ORDER BY rowid")
+        except (sqlite3.OperationalError,IOError,struct.error):
+            return None
+        summary = {}
+        for chrom,field,fmin,fmax,count,rtree in self.cursor:
+            chrom = chrom.encode('ascii')
+            if not chrom in summary:
+                summary[chrom] = {'count': count, 'rtree': bool(rtree), 'fields': [], 'min': {}, 'max': {}}
+            field = field.encode('ascii')
+            summary[chrom]['fields'].append(field)
+            summary[chrom]['min'][field] = fmin
+            summary[chrom]['max'][field] = fmax
+        return summary
+
+    def _modify(self, chroms=None):
+        """Marks the tables of *chroms* (default: all) as modified: their summary is written again on `close`."""
+        self._modified = True
+        if chroms is None: self._summary = None
+        elif self._summary:
+            for chrom in chroms: self._summary.pop(chrom,None)
+
+    def _write_summary(self):
+        """Updates the 'chrSummary' table with the chromosomes missing from `_summary`."""
+        summary = self._summary or {}
+        self._rtrees = None
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS 'chrSummary' "
+                            "(chr TEXT, field TEXT, min, max, count INTEGER, rtree INTEGER)")
+        if not self._summary: self.cursor.execute("DELETE FROM 'chrSummary'")
+        tables = set(self.tables)
+        for chrom in sorted(self.chrmeta):
+            if chrom in summary or not chrom in tables: continue
+            self.cursor.execute("SELECT * FROM '%s' LIMIT 1" % chrom)
+            fields = [x[0].encode('ascii') for x in self.cursor.description]
+            stats = ",".join('min("%s"),max("%s")'%(f,f) for f in fields)
+            x = self.cursor.execute("SELECT count(*),%s FROM '%s'" % (stats,chrom)).fetchone()
+            rtree = self._rtree(chrom) is not None
+            summary[chrom] = {'count': x[0], 'rtree': rtree, 'fields': fields,
+                              'min': dict(zip(fields,x[1::2])), 'max': dict(zip(fields,x[2::2]))}
+            self.cursor.execute("DELETE FROM 'chrSummary' WHERE chr=?", (chrom,))
+            self.cursor.executemany("INSERT INTO 'chrSummary' (chr,field,min,max,count,rtree) VALUES (?,?,?,?,?,?)",
+                                    [(chrom,f,x[1+2*n],x[2+2*n],x[0],rtree) for n,f in enumerate(fields)])
+        self.connection.commit()
+        # setting the version is the next transaction
+        self.cursor.execute("PRAGMA user_version=%i" % ((self._change_counter()+1) & 0x7fffffff))
+        self._summary = summary
+        self._modified = False
+
+###### region index #######
+    def _update_rtree(self, chroms=None, rebuild=False):
+        """Adds the rows of *chroms* (default: all) written since the last call to their R*Tree
+        table (rows are appended with increasing rowids), or fills it again from scratch if
+        *rebuild* is True. The largest rowid indexed is read from the '_rowid' table of the R*Tree.
+        The R*Tree of a chromosome is created once it has `_rtree_min_rows` rows: each of them
+        slows down the loading of the database schema."""
+        self._rtrees = None
+        if chroms is None: chroms = self.chrmeta.keys()
+        if not(self.indexed and 'start' in self.fields and 'end' in self.fields and _rtree_module()): return
+        tables = set(self.tables)
+        for chrom in chroms:
+            rtree = chrom+"_rtree"
+            if not chrom in tables: continue
+            if not rtree in tables:
+                nrows = self.cursor.execute("SELECT max(rowid) FROM '%s'" % chrom).fetchone()[0]
+                if nrows < _rtree_min_rows: continue
+                sql_command = "CREATE VIRTUAL TABLE '%s' USING %s(id,start,end)" % (rtree,_rtree_module())
+                self.cursor.execute(sql_command)
+            elif rebuild:
+                sql_command = "DELETE FROM '%s'" % rtree
+                self.cursor.execute(sql_command)
+            # a feature with start > end is indexed as (end,start): the query checks the exact bounds
+            sql_command = "INSERT INTO '%s' (id,start,end) SELECT rowid,min(start,end),max(start,end) " \
+                          "FROM '%s' WHERE rowid > (SELECT coalesce(max(rowid),0) FROM '%s_rowid')" \
+                          % (rtree,chrom,rtree)
+            self.cursor.execute(sql_command)
+        self.connection.commit()
+
+    def _rtree(self, chrom):
+        """Name of the R*Tree table of *chrom* if it indexes all its rows, else None."""
+        if self._rtrees is None:
+            self._rtrees = {}
+            summary = self._summary or {}
+            tables = set(self.tables)
+            for c in self.chrmeta:
+                if c in summary:
+                    if summary[c]['rtree']: self._rtrees[c] = c+"_rtree"
+                    continue
+                if not(c+"_rtree" in tables and c in tables): continue
+                try:
+                    cursor = self.connection.execute("SELECT (SELECT max(rowid) FROM '%s'),"
+                                                     "(SELECT max(rowid) FROM '%s_rowid')" % (c,c+"_rtree"))
+                except sqlite3.OperationalError: # no R*Tree support in this SQLite
+                    continue
+                nrows,nindexed = cursor.fetchone()
+                if nrows == nindexed: self._rtrees[c] = c+"_rtree"
+        return self._rtrees.get(chrom)
+
+    def _region_query(self, chrom, where):
+        """Restricts the SQL condition *where* on *chrom* to the rows found in its R*Tree
+        for the conditions on 'start' and 'end' it contains. The R*Tree holds the smallest and
+        largest of 'start' and 'end' of each row, so that an upper bound on either of them
+        only bounds the smallest, and a lower bound only the largest; *where* checks the rest."""
+        rtree = self._rtree(chrom)
+        if rtree is None: return where
+        upper = {'<': '<', '<=': '<=', '=': '<='}
+        lower = {'>': '>', '>=': '>=', '=': '>='}
+        bounds = []
+        for c in where.split(" AND "):
+            c = c.split(" ")
+            if len(c) != 3 or not c[0] in ("start","end"): continue
+            if c[1] in upper: bounds.append("start %s %s" % (upper[c[1]],c[2]))
+            if c[1] in lower: bounds.append("end %s %s" % (lower[c[1]],c[2]))
+        if not bounds: return where
+        return "rowid IN (SELECT id FROM '%s' WHERE %s) AND %s" % (rtree," AND ".join(bounds),where)
+
 ################################ Read ##########################################
     def _check_selection(self,selection):
         if selection is None:
@@ -214,45 +514,94 @@ class SqlTrack(Track):
                 query.append(str(k)+" = "+str_val)
         return " AND ".join(query)
 
+    def _read_regions(self, fields, selection, order, add_chr):
+        """Rows overlapping each feature of the FeatureStream *selection*, feature after feature:
+        the features of a chromosome are inserted by batches in a temporary table, and joined
+        with the chromosome table through its R*Tree in a single query. Without R*Tree, there is
+        one query per feature. Yields blocks of rows, as `_read`."""
+        cursor = self.connection.cursor()
+        chr_idx = selection.fields.index('chr')
+        start_idx = selection.fields.index('start')
+        end_idx = selection.fields.index('end')
+        regions = "_regions%i" % next(_regions_tables)
+        cursor.execute("CREATE TEMP TABLE '%s' (id INTEGER PRIMARY KEY, start INTEGER, end INTEGER)" % regions)
+        if fields == "*": qfields = "d.*"
+        else: qfields = ",".join("d."+f for f in fields.split(","))
+        qorder = ",".join("d."+f.strip() for f in order.split(","))
+
+        def _query(chrom, batch):
+            rtree = self._rtree(chrom)
+            if rtree:
+                cursor.execute("DELETE FROM '%s'" % regions)
+                cursor.executemany("INSERT INTO '%s' (id,start,end) VALUES (?,?,?)" % regions,
+                                   ((n,x[start_idx],x[end_idx]) for n,x in enumerate(batch)))
+                sql_commands = ["SELECT %s%s FROM '%s' r" % (add_chr and "'"+chrom+"' as chr," or "",
+                                                             qfields,regions)
+                                + " CROSS JOIN '%s' t ON t.end > r.start AND t.start < r.end" % rtree
+                                + " CROSS JOIN '%s' d ON d.rowid = t.id" % chrom
+                                + " WHERE d.end > r.start AND d.start < r.end ORDER BY r.id,%s" % qorder]
+            else:
+                sql_commands = ("SELECT %s%s FROM '%s' WHERE end > %s AND start < %s ORDER BY %s"
+                                % (add_chr and "'"+chrom+"' as chr," or "",fields,chrom,
+                                   x[start_idx],x[end_idx],order) for x in batch)
+            for sql_command in sql_commands:
+                try:
+                    cursor.execute(sql_command)
+                    for rows in iter(lambda: cursor.fetchmany(_batch_size),[]): yield rows
+                except sqlite3.OperationalError as err:
+                    raise Exception("Sql error: %s\n on file %s, with\n%s" % (err,self.path,sql_command))
+
+        batch = []
+        for sel in selection:
+            if batch and (sel[chr_idx] != batch[0][chr_idx] or len(batch) >= _batch_size):
+                for x in _query(batch[0][chr_idx],batch): yield x
+                batch = []
+            batch.append(sel)
+        if batch:
+            for x in _query(batch[0][chr_idx],batch): yield x
+        try:
+            cursor.execute("DROP TABLE '%s'" % regions)
+        except sqlite3.OperationalError: # other reads pending on a shared connection
+            cursor.execute("DELETE FROM '%s'" % regions)
+        cursor.close()
+
     def _read(self, fields, selection, order, add_chr):
+        """Yields the selected rows by blocks of at most `_batch_size`, from `cursor.fetchmany`."""
+        if isinstance(selection,FeatureStream):
+            for rows in self._read_regions(fields, selection, order, add_chr): yield rows
+            return
         cursor = self.connection.cursor()
         chr_idx = 0
-        if isinstance(selection,FeatureStream):
-            chr_idx = selection.fields.index('chr')
-            start_idx = selection.fields.index('start')
-            end_idx = selection.fields.index('end')
         for sel in selection:
             chrom = sel[chr_idx]
             if add_chr: qfields = "'"+chrom+"' as chr,"+fields
             else: qfields = fields
             sql_command = "SELECT %s FROM '%s'" % (qfields, chrom)
-            if isinstance(selection,FeatureStream):
-                sql_command += " WHERE end>%s AND start<%s" % (sel[start_idx],sel[end_idx])
-            elif sel[1]:
-                sql_command += " WHERE %s" % self._make_selection(sel[1])
+            if sel[1]:
+                sql_command += " WHERE %s" % self._region_query(chrom,self._make_selection(sel[1]))
             sql_command += " ORDER BY %s" % order
             try:
                 cursor.execute(sql_command)
-                for x in cursor: yield x
+                for rows in iter(lambda: cursor.fetchmany(_batch_size),[]): yield rows
             except sqlite3.OperationalError as err:
                 raise Exception("Sql error: %s\n on file %s, with\n%s" % (err,self.path,sql_command))
         cursor.close()
 
-
     def get_range(self, selection=None, fields=None):
         """
         Returns the range of values for the given selection.
         If `fields` is None, returns min and max positions, otherwise min and max
-        field values.
+        field values. Whole chromosomes are read from the summary table if it is up to date.
         """
         selection = self._check_selection(selection)
         if fields is None:
-                _f = ["min(start)","max(end)"]
+            _s = [('min','start'),('max','end')]
         else:
             if isinstance(fields,basestring): fields = [fields]
-            _f = []
+            _s = []
             for f in fields:
-                if f in self.fields: _f.extend(["min(%s)"%f,"max(%s)"%f])
+                if f in self.fields: _s.extend([('min',f),('max',f)])
+        _f = ["%s(%s)" % x for x in _s]
         if len(_f) == 0:
             raise ValueError("Fields %s not in track: %s" % (fields,self.fields))
         cursor = self.connection.cursor()
@@ -262,15 +611,22 @@ class SqlTrack(Track):
             start_idx = selection.fields.index('start')
             end_idx = selection.fields.index('end')
         rback = [None]*len(_f)
+        summary = self._summary or {}
         for sel in selection:
             chrom = sel[chr_idx]
             sql_command = "SELECT %s FROM '%s'" % (','.join(_f), chrom)
             if isinstance(selection,FeatureStream):
-                sql_command += " WHERE end>%s AND start<%s" % (sel[start_idx],sel[end_idx])
+                where = "end > %s AND start < %s" % (sel[start_idx],sel[end_idx])
+                sql_command += " WHERE %s" % self._region_query(chrom,where)
             elif sel[1]:
-                sql_command += " WHERE %s" % self._make_selection(sel[1])
+                sql_command += " WHERE %s" % self._region_query(chrom,self._make_selection(sel[1]))
+            elif chrom in summary and all(f in summary[chrom]['fields'] for s,f in _s):
+                sql_command = None
             try:
-                x = cursor.execute(sql_command).fetchone()
+                if sql_command is None:
+                    x = [summary[chrom][s][f] for s,f in _s]
+                else:
+                    x = cursor.execute(sql_command).fetchone()
                 for n in range(len(_f)):
                     if rback[n] is None: rback[n] = x[n]
                     elif n%2 and rback[n] < x[n]: rback[n] = x[n]
@@ -281,7 +637,7 @@ class SqlTrack(Track):
         return rback
 
 
-    def read(self, selection=None, fields=None, order='start,end', **kw):
+    def read(self, selection=None, fields=None, order='start,end', as_arrays=False, **kw):
         """
         :param selection: list of dict of the type
             `[{'chr':'chr1','start':(12,24)},{'chr':'chr3','end':(25,45)},...]`,
@@ -289,6 +645,8 @@ class SqlTrack(Track):
         :param fields: (list of str) list of field names (columns) to read.
         :param order: (str, comma-separated) fields with respect to which the result must
             be sorted. ['start,end']
+        :param as_arrays: (bool) return an ArrayFeatureStream, filled from the blocks of rows
+            fetched at once. [False]
         """
         selection = self._check_selection(selection)
         if fields:
@@ -300,10 +658,13 @@ class SqlTrack(Track):
             query_fields = "*"
             _fields = ['chr']+[f for f in self.fields if f != 'chr']
             add_chr = True
-        return FeatureStream(self._read(query_fields,selection,order,add_chr), _fields)
+        stream = FeatureStream(self._read(query_fields,selection,order,add_chr), _fields, blocks=True)
+        if as_arrays: return array_stream(stream)
+        return stream
 
 ################################ Write ##########################################
     def _clip(self):
+        self._modify()
         for chrom,val in self.chrmeta.iteritems():
             sql_command = "UPDATE '%s' SET start=0 WHERE start<0" %(chrom)
             self.cursor.execute(sql_command)
@@ -312,6 +673,15 @@ class SqlTrack(Track):
             sql_command = "DELETE FROM '%s' WHERE end<=start" %(chrom)
             self.cursor.execute(sql_command)
         self.connection.commit()
+        self._update_rtree(rebuild=True)
+
+    def _insert(self, sql_command, rows):
+        """Executes the INSERT *sql_command* on the list of tuples *rows*.
+        Values of types unknown to sqlite3 are converted to Python scalars if they
+        are numpy scalars (e.g. numpy.int32), and inserted as strings otherwise."""
+        if not all(isinstance(x,_native_types) for row in rows for x in row):
+            rows = [[x if isinstance(x,_native_types) else _to_native(x) for x in row] for row in rows]
+        self.cursor.executemany(sql_command,rows)
 
     def write(self, source, fields=None, chrom=None, **kw):
         if not(self._prepare_db()):
@@ -328,6 +698,8 @@ class SqlTrack(Track):
             fields = self.fields
         else:
             fields = [f for f in fields if f in self.fields]
+        if not isinstance(source,FeatureStream):
+            source = FeatureStream(source,srcfields)
 
         try:
             chr_idx = 0
@@ -336,25 +708,35 @@ class SqlTrack(Track):
             fields_left = [srcfields.index(f) for f in fields if f != 'chr' and f in srcfields]
             fields_list = ','.join([srcfields[n] for n in fields_left])
             pholders = ','.join(['?' for f in fields_left])
-            def _sub(x): return [str(x[f]) for f in fields_left]
+            if len(fields_left) > 1: _sub = itemgetter(*fields_left)
+            else: _sub = lambda x: (x[fields_left[0]],)
             def _sqlc(x,y,z): return "INSERT INTO '%s' (%s) VALUES (%s)" %(x,y,z)
             if chrom is None:
                 if not 'chr' in srcfields:
                     raise Exception("Need a chromosome name in the source fields or in the arguments.")
-                for row in source:
-                    sql_command = _sqlc(row[chr_idx],fields_list,pholders)
-                    self.cursor.execute(sql_command, _sub(row))
+                _chr = itemgetter(chr_idx)
+                commands = {}
+                for batch in source.batches(_batch_size):
+                    for _chrom,rows in itertools.groupby(batch,_chr):
+                        sql_command = commands.get(_chrom)
+                        if sql_command is None:
+                            self._modify([_chrom])
+                            sql_command = commands[_chrom] = _sqlc(_chrom,fields_list,pholders)
+                        self._insert(sql_command,map(_sub,rows))
             else:
+                self._modify([chrom])
                 sql_command = _sqlc(chrom,fields_list,pholders)
-                if 'chr' in srcfields:
-                    self.cursor.executemany(sql_command,
-                                            (_sub(row) for row in source
-                                             if str(row[chr_idx])==chrom))
-                else:
-                    self.cursor.executemany(sql_command,
-                                            (_sub(row) for row in source))
+                for batch in source.batches(_batch_size):
+                    if 'chr' in srcfields:
+                        batch = [row for row in batch if str(row[chr_idx])==chrom]
+                        if not batch: continue
+                    self._insert(sql_command,map(_sub,batch))
+            if self._loading:
+                self._clip_on_close |= bool(kw.get('clip'))
+                return
             self.connection.commit()
             if kw.get('clip'): self._clip()
+            else: self._update_rtree([chrom] if chrom else None)
         except (sqlite3.OperationalError, sqlite3.ProgrammingError) as err:
             raise Exception("Sql error: %s\n on file %s, with\n%s"%(err,self.path,sql_command))
 
@@ -1,5 +1,8 @@
 from bbcflib.track import *
-import re, gzip, os, sys
+from bbcflib.track import _column_array
+import re, gzip, os, sys, struct, zlib
+from itertools import izip, compress
+from operator import methodcaller, itemgetter
 try:
     import urllib.request as urllib2
 except ImportError:
@@ -19,6 +22,203 @@ _out_types = {'start':  format_int,
               'score':  format_float,
               'strand': int_to_strand}
 
+_out_specs = {format_int:   '%i',  # same result as the functions in `_out_types`
+              format_float: '%.4g',
+              str:          '%s'}
+
+_chunk_size = 2**20 # bytes parsed at once by `TextTrack._read_chunks`
+_special_heads = frozenset(['','#','@','t','b',' ','\t','\r','\x0b','\x0c']) # first characters of
+                                    # lines that `_read` may skip or stop at
+
+################################ BGZF ##########################################
+
+_bgzf_eof = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00" \
+            "\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+_bgzf_block_size = 0xff00 # max uncompressed bytes per block, as in htslib
+_bin_size = 2**14         # width of the region index windows, as in tabix
+
+def is_bgzf(path):
+    """Return True if *path* is a BGZF (blocked gzip, as produced by *bgzip*) file."""
+    try:
+        with open(path,'rb') as f:
+            head = f.read(16)
+    except IOError:
+        return False
+    return len(head) == 16 and head[:4] == "\x1f\x8b\x08\x04" and head[12:14] == "BC"
+
+class BgzfFile(object):
+    """
+    Pure Python reader/writer for BGZF files: a series of gzip blocks of at most 64kb,
+    readable by *gzip*/*zcat* and compatible with *bgzip*/*tabix*.
+    Positions returned by `tell()` and accepted by `seek()` are *virtual offsets*:
+    `(compressed block offset << 16) | offset in the uncompressed block`.
+    Only the blocks containing the data that is actually read are decompressed.
+
+    :param path: (str) file name.
+    :param mode: (str) one of 'rb', 'wb' or 'ab'.
+    """
+    def __init__(self, path, mode='rb'):
+        self.name = path
+        self.mode = mode
+        if 'a' in mode and os.path.exists(path):
+            # the EOF marker of the previous writer would end the file before the new blocks
+            with open(path,'r+b') as f:
+                f.seek(0,2)
+                size = f.tell()
+                if size >= len(_bgzf_eof):
+                    f.seek(size-len(_bgzf_eof))
+                    if f.read() == _bgzf_eof: f.truncate(size-len(_bgzf_eof))
+        self._raw = open(path, mode)
+        self._buffer = ''
+        self._pos = 0
+        self._block = 0
+        self._next_block = 0
+        if 'a' in mode: self._raw.seek(0,2)
+
+    @property
+    def closed(self):
+        return self._raw.closed
+
+    def _load_block(self, coffset):
+        self._raw.seek(coffset)
+        head = self._raw.read(12)
+        self._block = coffset
+        self._pos = 0
+        if not head:
+            self._buffer = ''
+            self._next_block = coffset
+            return
+        if len(head) < 12 or head[:4] != "\x1f\x8b\x08\x04":
+            raise IOError("Not a BGZF file: %s." % self.name)
+        xlen = struct.unpack('<H',head[10:12])[0]
+        extra = self._raw.read(xlen)
+        bsize = None
+        n = 0
+        while n < xlen:
+            slen = struct.unpack('<H',extra[n+2:n+4])[0]
+            if extra[n:n+2] == "BC": bsize = struct.unpack('<H',extra[n+4:n+6])[0]
+            n += 4+slen
+        if bsize is None:
+            raise IOError("Not a BGZF file: %s." % self.name)
+        cdata = self._raw.read(bsize-xlen-19)
+        crc, isize = struct.unpack('<iI',self._raw.read(8))
+        self._buffer = zlib.decompress(cdata,-15)
+        self._next_block = coffset+bsize+1
+        if len(self._buffer) != isize or zlib.crc32(self._buffer) != crc:
+            raise IOError("Corrupted BGZF block at offset %i in %s." % (coffset,self.name))
+
+    def tell(self):
+        if 'r' not in self.mode:
+            return (self._raw.tell() << 16) | len(self._buffer)
+        if self._pos >= len(self._buffer) and self._buffer:
+            return self._next_block << 16
+        return (self._block << 16) | self._pos
+
+    def seek(self, voffset, whence=0):
+        self._load_block(voffset >> 16)
+        self._pos = voffset & 0xffff
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._buffer):
+                self._load_block(self._next_block)
+                if self._next_block == self._block: break # end of the file
+                continue # an empty block, e.g. an EOF marker followed by appended blocks
+            chunk = self._buffer[self._pos:] if size < 0 else self._buffer[self._pos:self._pos+size]
+            self._pos += len(chunk)
+            if size > 0: size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def readline(self):
+        chunks = []
+        while 1:
+            if self._pos >= len(self._buffer):
+                self._load_block(self._next_block)
+                if self._next_block == self._block: break
+                continue
+            i = self._buffer.find("\n",self._pos)
+            if i < 0:
+                chunks.append(self._buffer[self._pos:])
+                self._pos = len(self._buffer)
+            else:
+                chunks.append(self._buffer[self._pos:i+1])
+                self._pos = i+1
+                break
+        return ''.join(chunks)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def _write_block(self, data):
+        c = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = c.compress(data)+c.flush()
+        head = struct.pack('<4BI2BH2BHH', 31,139,8,4, 0, 0,255, 6, 66,67, 2, len(cdata)+25)
+        self._raw.write(head+cdata+struct.pack('<iI', zlib.crc32(data), len(data)))
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _bgzf_block_size:
+            self._write_block(self._buffer[:_bgzf_block_size])
+            self._buffer = self._buffer[_bgzf_block_size:]
+
+    def flush(self):
+        if 'r' in self.mode: return
+        if self._buffer: self._write_block(self._buffer)
+        self._buffer = ''
+        self._raw.flush()
+
+    def close(self):
+        if self.closed: return
+        if 'r' not in self.mode:
+            self.flush()
+            self._raw.write(_bgzf_eof)
+        self._raw.close()
+
+class _BinIndex(object):
+    """
+    Region index of a BGZF text file sorted by chromosome and start: for every
+    chromosome, the virtual offset of the first line overlapping each window of
+    *_bin_size* bp (the tabix 'linear index').
+    """
+    def __init__(self):
+        self.windows = {}
+        self.sorted = True
+        self._last = (None,-1)
+
+    def add(self, chrom, start, end, voffset):
+        if chrom != self._last[0]:
+            if chrom in self.windows: self.sorted = False
+            self.windows[chrom] = []
+        elif start < self._last[1]:
+            self.sorted = False
+        self._last = (chrom,start)
+        w = self.windows[chrom]
+        last_w = max(start,end-1) // _bin_size
+        if len(w) <= last_w: w.extend([None]*(last_w+1-len(w)))
+        for k in xrange(start // _bin_size, last_w+1):
+            if w[k] is None: w[k] = voffset
+
+    def offset(self, chrom, end_min):
+        """Virtual offset from which lines of *chrom* ending after *end_min* can be found,
+        or None if there are none."""
+        w = self.windows.get(chrom)
+        if not w: return None
+        for v in w[max(0,end_min-1) // _bin_size:]:
+            if v is not None: return v
+        return None
+
+    def dump(self, f):
+        for chrom,w in sorted(self.windows.iteritems(), key=lambda x: min(v for v in x[1] if v is not None)):
+            f.write("%s\t%s\n" % (chrom,",".join('' if v is None else str(v) for v in w)))
+
+    def load(self, f):
+        for row in f:
+            chrom,w = row.rstrip('\n').split('\t')
+            self.windows[chrom] = [int(v) if v else None for v in w.split(',')]
+        return self
+
 ################################ GENERIC TEXT ####################################
 
 class TextTrack(Track):
@@ -56,15 +256,33 @@ class TextTrack(Track):
        If it has, the default writing mode chages from 'write' to 'append'
        (used after writing a header, for instance).
 
+    .. attribute:: index
+
+       Dictionary of the type `{chr: [start,end]}` with the byte offsets of each chromosome
+       block in the file, filled when reading with `skip=True`. Once complete, it is saved
+       next to the file (*path*.bbcfidx) together with the file size and modification time,
+       and reloaded by later instances as long as the file is unchanged.
+
+    .. attribute:: bgzf
+
+       Whether the file is (or must be written) in BGZF format, i.e. compressed by blocks
+       as with *bgzip*. BGZF files sorted by chromosome and start get a region index
+       (*path*.bbcfbin) so that reading a selection only decompresses the relevant blocks.
+       Detected automatically for existing ".gz" files.
+
     When reading a file, all lines beginning with "browser", "track" or "#" are skipped.
     The *info* attribute will be filled with "key=value" pairs found on a "track" line at the top of the file.
     The *open* method takes the argument *mode* which can be 'read' (default), 'write', 'append' or 'overwrite'.
     Path can also be a url, or a gzipped file.
     """
+    _region_index = True # lines are indexable by 'chr','start','end' (see `_read_regions`)
+    _chunk_parser = False # lines are plain rows of fields, parsed by chunks (see `_read_chunks`)
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = kwargs.get("format",'txt')
         self.separator = kwargs.get('separator',"\t")
         self.header = kwargs.get('header',None)
+        self.bgzf = kwargs.get('bgzf',False)
         Track.__init__(self,path,**kwargs)
         if os.path.exists(self.path) and os.path.getsize(self.path):
             self.separator = self._check_sep()
@@ -74,6 +292,10 @@ class TextTrack(Track):
         self.outtypes = dict((k,v) for k,v in _out_types.iteritems() if k in self.fields)
         if isinstance(kwargs.get('outtypes'),dict): self.outtypes.update(kwargs["outtypes"])
         self.written = False
+        self._index_last = None
+        self._index_grouped = True
+        self._index_loaded = False
+        self.bin_index = None
 
     def _check_sep(self):
         """Checks if default separator works, otherwise tries ' ' and '\t'."""
@@ -174,44 +396,180 @@ class TextTrack(Track):
         else:
             return val
 
-    def _select_values(self,row,selection):
-        """
-        Check whether all elements in a *row* pass through the *selection* filter.
+    def _index_chr(self,start,end,splitrow):
+        self._index_block(splitrow[self.fields.index('chr')],start,end)
 
-        :row: (list) splitted row from file - elements correspond to fields items.
-        :param selection: dict of the form {field_name: value} or {field_name: (min,max)}.
-        :rtype: boolean
-        """
-        tests = []
-        for k,v in selection.iteritems():
-            if k == 'length':
-                fi1 = self.fields.index('start')
-                fi2 = self.fields.index('end')
-            else:
-                fi = self.fields.index(k)
-            if isinstance(v,(list,tuple)):
-                if k == 'chr':
-                    tests.append(str(row[fi]) in v)
-                elif k == 'length':
-                    tests.append(int(row[fi2])-int(row[fi1]) >= int(v[0]))
-                    tests.append(int(row[fi2])-int(row[fi1]) <= int(v[1]))
-                else:
-                    tests.append(float(row[fi]) >= float(v[0]))
-                    tests.append(float(row[fi]) <= float(v[1]))
-            else:
-                if k == 'length':
-                    tests.append(int(row[fi2])-int(row[fi1]) == int(v))
-                else:
-                    tests.append(str(row[fi]) == str(v))
-        return all(tests)
+    def _index_block(self,chr,start,end):
+        if self.index.get(chr):
+            if chr != self._index_last and start > self.index[chr][1]:
+                self._index_grouped = False # chromosome seen twice, index unusable
+            self.index[chr][1] = end
+        else:
+            self.index[chr] = [start,end]
+        self._index_last = chr
+
+    @property
+    def index_path(self):
+        """Name of the file where the chromosome index is saved."""
+        return self.path+".bbcfidx"
+
+    def _index_stamp(self):
+        """Size and modification time of *self.path*, to detect a stale index."""
+        st = os.stat(self.path)
+        return [str(st.st_size),repr(st.st_mtime)]
+
+    def _load_index(self):
+        """Load the chromosome index saved by a previous instance, if it is still valid.
+        Returns True if *self.index* was updated."""
+        if self._index_loaded: return True
+        if not(os.path.exists(self.path) and os.path.exists(self.index_path)):
+            return False
+        index = {}
+        try:
+            with open(self.index_path) as f:
+                head = f.readline().rstrip('\n').split('\t')
+                if head[0] != '#bbcfidx' or head[1:] != self._index_stamp():
+                    return False
+                for row in f:
+                    chr,start,end = row.rstrip('\n').split('\t')
+                    index[chr] = [int(start),int(end)]
+        except (IOError,ValueError,IndexError):
+            return False
+        self.index = index
+        self._index_loaded = True
+        return True
+
+    def _save_index(self):
+        """Write *self.index* to *self.index_path* after a complete read with `skip=True`,
+        unless chromosomes were found not to be grouped."""
+        if self._index_loaded or not(self._index_grouped and self.index): return
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.index_path,'w') as f:
+                f.write("\t".join(['#bbcfidx']+self._index_stamp())+"\n")
+                for chr,v in sorted(self.index.iteritems(), key=lambda x:x[1]):
+                    f.write("%s\t%i\t%i\n" % (chr,v[0],v[1]))
+            self._index_loaded = True
+        except IOError: # e.g. read-only directory: just keep it in memory
+            pass
 
-    def _index_chr(self,start,end,splitrow):
-        chr = splitrow[self.fields.index('chr')]
-        if self.index.get(chr): self.index[chr][1] = end
-        else:                   self.index[chr] = [start,end]
+    @property
+    def bin_index_path(self):
+        """Name of the file where the region index of a BGZF file is saved."""
+        return self.path+".bbcfbin"
+
+    def _load_bin_index(self):
+        """Load the region index of a BGZF file, building it with a full read if
+        there is no valid one yet. Returns False if the file cannot be indexed.
+        A file found not to be sorted is recorded as such (*self.bin_index* is False),
+        so that it is not read again to try to index it."""
+        if self.bin_index is not None: return self.bin_index is not False
+        if not(self.bgzf and self._region_index and os.path.exists(self.path)) \
+                or not all(f in self.fields for f in ['chr','start','end']):
+            return False
+        try:
+            with open(self.bin_index_path) as f:
+                head = f.readline().rstrip('\n').split('\t')
+                if head[0] == '#bbcfbin' and head[1:3] == self._index_stamp():
+                    if head[3:] == ['unsorted']:
+                        self.bin_index = False
+                        return False
+                    self.bin_index = _BinIndex().load(f)
+                    return True
+        except (IOError,ValueError):
+            pass
+        binidx = _BinIndex()
+        chri,starti,endi = [self.fields.index(f) for f in ['chr','start','end']]
+        self.open('read')
+        self._skip_header()
+        while 1:
+            voffset = self.filehandle.tell()
+            row = self.filehandle.readline()
+            if not row.strip(): break
+            if row[0] in ['#','@']: continue
+            if row[:5]=='track' or row[:7]=='browser': break
+            splitrow = [s.strip() for s in row.split(self.separator)]
+            if not any(splitrow): continue
+            binidx.add(splitrow[chri],int(splitrow[starti]),int(splitrow[endi]),voffset)
+        self.close()
+        return self._save_bin_index(binidx)
+
+    def _save_bin_index(self, binidx):
+        """Keep *binidx* and write it to *self.bin_index_path*, or only the fact that
+        the file is not sorted. Returns True if the file can be read by regions."""
+        self.bin_index = binidx if binidx.sorted else False
+        try:
+            with open(self.bin_index_path,'w') as f:
+                if binidx.sorted:
+                    f.write("\t".join(['#bbcfbin']+self._index_stamp())+"\n")
+                    binidx.dump(f)
+                else:
+                    f.write("\t".join(['#bbcfbin']+self._index_stamp()+['unsorted'])+"\n")
+        except IOError:
+            pass
+        return binidx.sorted
+
+    def _region_offsets(self, selection):
+        """From a list of selections, return a sorted list of `(voffset,chr,max_start)`
+        such that all lines matching a selection are found by reading *chr* from *voffset*
+        up to the first line starting after *max_start*. Returns None if a selection has no 'chr'."""
+        regions = []
+        for sel in selection:
+            chrom = sel.get('chr')
+            if not chrom: return None
+            if isinstance(chrom,basestring): chrom = [chrom]
+            max_start = sys.maxint
+            end_min = 0
+            for k,v in sel.iteritems():
+                if k == 'start':
+                    if isinstance(v,(list,tuple)):
+                        max_start = int(v[1])
+                        end_min = max(end_min,int(v[0]))
+                    else:
+                        max_start = int(v)
+                        end_min = max(end_min,int(v))
+                elif k == 'end':
+                    end_min = max(end_min,int(v[0] if isinstance(v,(list,tuple)) else v))
+            for c in chrom:
+                voffset = self.bin_index.offset(str(c),end_min)
+                if voffset is not None: regions.append((voffset,str(c),max_start))
+        return sorted(regions)
+
+    def _read_regions(self, fields, index_list, selection, regions):
+        """Same as `_read`, but only reads from the BGZF blocks listed in *regions*
+        (see `_region_offsets`)."""
+        self.open('read')
+        chri = self.fields.index('chr')
+        starti = self.fields.index('start')
+        row = ''
+        try:
+            for voffset,chrom,max_start in regions:
+                if self.filehandle.tell() < voffset or not row:
+                    self.filehandle.seek(voffset)
+                while 1:
+                    row = self.filehandle.readline()
+                    if not row.strip(): break
+                    if row[0] in ['#','@']: continue
+                    if row[:5]=='track' or row[:7]=='browser': break
+                    splitrow = [s.strip() for s in row.split(self.separator)]
+                    if not any(splitrow): continue
+                    if any(self._select_values(splitrow,s) for s in selection):
+                        yield tuple(self._check_type(splitrow[index_list[n]],f)
+                                    for n,f in enumerate(fields))
+                    if splitrow[chri] != chrom or int(splitrow[starti]) > max_start:
+                        break
+        except (ValueError,IndexError) as ve:
+            raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row,ve))
+        self.close()
 
     def _init_skip(self,selection):
-        chr_selected = [s.get('chr')[0] for s in selection if s.get('chr')]
+        chr_selected = []
+        for s in selection:
+            chrom = s.get('chr')
+            if not chrom: # any chromosome can match
+                return iter([[sys.maxint,sys.maxint]])
+            if isinstance(chrom,basestring): chr_selected.append(chrom)
+            else: chr_selected.extend(chrom)
         chr_toskip = sorted([self.index.get(c) for c in self.index if c not in chr_selected])
         chr_toskip = iter(chr_toskip+[[sys.maxint,sys.maxint]])
         return chr_toskip
@@ -235,7 +593,11 @@ class TextTrack(Track):
             isgzip = True
         if mode == 'read':
             if os.path.exists(self.path):
-                if isgzip:
+                if (isgzip or self.bgzf) and is_bgzf(self.path):
+                    self.bgzf = True
+                    self.filehandle = BgzfFile(self.path, 'rb')
+                elif isgzip:
+                    self.bgzf = False
                     self.filehandle = gzip.open(self.path, 'rb')
                 else:
                     self.filehandle = open(self.path, 'r')
@@ -252,7 +614,9 @@ class TextTrack(Track):
             if mode == 'write' and os.path.exists(self.path):
                 raise ValueError("File %s already exists, use 'overwrite' or 'append' modes."%self.path)
             else:
-                if isgzip:
+                if self.bgzf:
+                    self.filehandle = BgzfFile(self.path, 'ab' if mode == 'append' else 'wb')
+                elif isgzip:
                     if mode == 'append':
                         self.filehandle = gzip.open(self.path, 'ab')
                     else:
@@ -321,18 +685,196 @@ class TextTrack(Track):
                             for n,f in enumerate(fields))
         except (ValueError,IndexError) as ve:
             raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row,ve))
+        if skip and selection: self._save_index()
+
+    def _seek_data(self):
+        """Position *self.filehandle* on the first data line, for `_read_chunks`."""
+        self._skip_header()
 
-    def read(self, selection=None, fields=None, skip=False, **kw):
+    def _line_chunks(self, ranges):
+        """Yield `(offset,lines)`, where *lines* are complete lines (without end of line)
+        read from *self.filehandle* by blocks of *_chunk_size* bytes within each of the byte
+        *ranges* `[(start,end),...]`, and *offset* is the position of the first one.
+        A range `(None,None)` reads from the current position to the end of the file
+        (then offsets are None)."""
+        for start,end in ranges:
+            left = sys.maxint
+            if start is not None:
+                self.filehandle.seek(start)
+                if end is not None: left = end-start
+            offset = start
+            rest = ''
+            while 1:
+                data = self.filehandle.read(min(_chunk_size,left))
+                if not data:
+                    if rest: yield offset,[rest]
+                    break
+                left -= len(data)
+                data = rest+data
+                cut = data.rfind("\n")
+                if cut < 0:
+                    rest = data
+                    continue
+                rest = data[cut+1:]
+                yield offset,data[:cut].split("\n")
+                if offset is not None: offset += cut+1
+
+    def _filter_lines(self, lines):
+        """Remove from a chunk of *lines* the ones that `_read` skips, and cut it at the first
+        line where `_read` stops. Returns `(lines, stop, kept)`, *kept* being the indices
+        of the remaining lines in the chunk, or None if all are kept."""
+        if _special_heads.isdisjoint(row[:1] for row in lines):
+            return lines, False, None
+        rows = []
+        kept = []
+        for n,row in enumerate(lines):
+            if not row.strip(): return rows, True, kept
+            if row[0] in ['#','@']: continue
+            if row[:5]=='track' or row[:7]=='browser': return rows, True, kept
+            if not any(s.strip() for s in row.split(self.separator)): continue
+            rows.append(row)
+            kept.append(n)
+        return rows, False, kept
+
+    def _split_columns(self, lines):
+        """Split a chunk of *lines* into columns (of str). Returns `(columns, width)`, where *width*
+        is the number of fields per line, or None if it varies (then columns are truncated
+        to the shortest line). When possible, the whole chunk is split at once."""
+        sep = self.separator
+        if sep:
+            nsep = set(map(methodcaller('count',sep),lines))
+            if len(nsep) == 1:
+                width = nsep.pop()+1
+                allfields = sep.join(lines).split(sep)
+                return [allfields[n::width] for n in xrange(width)], width
+        rows = [row.split(sep) for row in lines]
+        widths = set(map(len,rows))
+        return zip(*rows), (widths.pop() if len(widths) == 1 else None)
+
+    def _typed_column(self, column, field):
+        conv = self.intypes.get(field)
+        if conv in (int,float): # they ignore surrounding whitespace
+            return map(conv,column)
+        column = map(str.strip,column)
+        if conv is None: return column
+        return map(conv,column)
+
+    def _columns(self, lines, fields, index_list, chrom=None, with_chr=False):
+        """Split a chunk of *lines* and type it column-wise. Returns `(columns, chrs)`:
+        the list of columns (lists of values) for *fields*, keeping only lines whose chromosome
+        is in *chrom* if it is not None (or None if no line is left), and, if *with_chr*
+        or *chrom*, the chromosome names of all *lines* (None for lines `_read` ignores)."""
+        chrs = None
+        try:
+            columns = self._split_columns(lines)[0]
+            if with_chr or chrom is not None:
+                chrs = map(str.strip,columns[self.fields.index('chr')])
+            if chrom is not None:
+                keep = [c in chrom for c in chrs]
+                if not any(keep): return None, chrs
+                if not all(keep):
+                    columns = [list(compress(col,keep)) if n in index_list else None
+                               for n,col in enumerate(columns)]
+            return [self._typed_column(columns[index_list[n]],f) for n,f in enumerate(fields)], chrs
+        except (ValueError,IndexError):
+            pass
+        # Go line by line to keep the exact behaviour (and error message) of `_read`
+        rows = []
+        chrs = []
+        for row in lines:
+            splitrow = [s.strip() for s in row.split(self.separator)]
+            try:
+                if with_chr or chrom is not None:
+                    chrs.append(splitrow[self.fields.index('chr')])
+                    if chrom is not None and chrs[-1] not in chrom: continue
+                rows.append(tuple(self._check_type(splitrow[index_list[n]],f)
+                                  for n,f in enumerate(fields)))
+            except (ValueError,IndexError) as ve:
+                raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row+"\n",ve))
+        return [list(col) for col in zip(*rows)] or None, chrs
+
+    def _index_lines(self, offset, lines, kept, chrs):
+        """Record in *self.index* the chromosome blocks of a chunk of *lines* starting at
+        byte *offset*, given the chromosome names *chrs* of its lines at indices *kept*
+        (all lines if *kept* is None)."""
+        if kept is None: kept = xrange(len(lines))
+        if chrs and chrs.count(chrs[0]) == len(chrs):
+            blocks = [[chrs[0],kept[0],kept[-1]]]
+        else:
+            blocks = []
+            for n,c in izip(kept,chrs):
+                if c is None: continue
+                if blocks and blocks[-1][0] == c: blocks[-1][2] = n
+                else: blocks.append([c,n,n])
+        if len(blocks) == 1:
+            chr,first,last = blocks[0]
+            self._index_block(chr, offset+sum(map(len,lines[:first]))+first,
+                              offset+sum(map(len,lines[:last+1]))+last+1)
+            return
+        pos = [offset]
+        for row in lines: pos.append(pos[-1]+len(row)+1)
+        for chr,first,last in blocks:
+            self._index_block(chr,pos[first],pos[last+1])
+
+    def _read_chunks(self, fields, index_list, selection, skip):
+        """Same as `_read`, for a selection on chromosomes only (or no selection),
+        but parses the file by large chunks, one column at a time (see `_column_chunks`),
+        and yields the rows of each chunk as a list."""
+        for columns in self._column_chunks(fields, index_list, selection, skip):
+            yield zip(*columns)
+
+    def _array_chunks(self, fields, index_list, selection, skip):
+        """Chunks of an ArrayFeatureStream, from `_column_chunks`."""
+        for columns in self._column_chunks(fields, index_list, selection, skip):
+            yield dict(izip(fields,map(_column_array,columns)))
+
+    def _column_chunks(self, fields, index_list, selection, skip):
+        """Yields the typed columns of *fields* of each chunk of the file.
+        With *skip*, only the blocks of the selected chromosomes are read if the chromosome
+        index is complete, otherwise the whole file is read and indexed."""
+        chrom = None
+        if selection:
+            chrom = set()
+            for s in selection:
+                if isinstance(s['chr'],(list,tuple)): chrom.update(s['chr'])
+                else: chrom.add(str(s['chr']))
+        self.open('read')
+        indexing = skip and selection and not self._index_loaded
+        if skip and selection and not indexing:
+            ranges = sorted(self.index[c] for c in chrom if c in self.index) or [(0,0)]
+        else:
+            self._seek_data()
+            ranges = [(None,None)]
+        if indexing:
+            self.index = {}
+            self._index_last = None
+            self._index_grouped = True
+            ranges = [(self.filehandle.tell(),None)]
+        for offset,chunk in self._line_chunks(ranges):
+            lines,stop,kept = self._filter_lines(chunk)
+            if lines:
+                columns,chrs = self._columns(lines,fields,index_list,chrom,indexing)
+                if indexing: self._index_lines(offset,chunk,kept,chrs)
+                if columns: yield columns
+            if stop: break
+        self.close()
+        if indexing: self._save_index()
+
+    def read(self, selection=None, fields=None, skip=None, as_arrays=False, **kw):
         """
         :param selection: list of dict of the type
             `[{'chr':'chr1','start':(12,24)},{'chr':'chr3','end':(25,45)},...]`,
             where tuples represent ranges, or a FeatureStream.
         :param fields: (list of str) list of field names (columns) to read.
+        :param as_arrays: (bool) return an ArrayFeatureStream, filled column by column
+            from the chunks parsed (see `_read_chunks`) when possible. [False]
         :param skip: (bool) assuming that lines are grouped by chromosome name,
             increases reading speed when looping over selections of several/all chromosomes.
             The first time lines corresponding to a chromosome are read, their position in the
             file is recorded (self.index). In the next iterations, only lines corresponding to
-            chromosomes either yet unread or present in *selection* will be read. [False]
+            chromosomes either yet unread or present in *selection* will be read.
+            Once the whole file has been read this way, the index is saved to disk (see *index*).
+            If None, it is used only if a valid index file already exists. [None]
         """
         if fields is None:
             fields = self.fields
@@ -358,7 +900,23 @@ class TextTrack(Track):
                              'start': (-1,feat[end_idx]),
                              'end': (feat[start_idx],sys.maxint)})
             selection = sel2
-        return FeatureStream(self._read(fields,ilist,selection,skip),fields)
+        if selection and skip is not False and self._load_bin_index():
+            regions = self._region_offsets(selection)
+            if regions is not None:
+                stream = FeatureStream(self._read_regions(fields,ilist,selection,regions),fields)
+                return array_stream(stream) if as_arrays else stream
+        if skip is None:
+            skip = bool(selection) and self._load_index()
+        elif skip and selection:
+            self._load_index()
+        if self._chunk_parser and fields \
+                and not(skip and selection and self.bgzf) \
+                and all(s.keys() == ['chr'] for s in selection or []):
+            if as_arrays:
+                return ArrayFeatureStream(self._array_chunks(fields,ilist,selection,skip),fields)
+            return FeatureStream(self._read_chunks(fields,ilist,selection,skip),fields,blocks=True)
+        stream = FeatureStream(self._read(fields,ilist,selection,skip),fields)
+        return array_stream(stream) if as_arrays else stream
 
     def _format_fields(self,vec,row,source_list,target_list):
         """
@@ -374,6 +932,36 @@ class TextTrack(Track):
             vec[j] = self.outtypes.get(self.fields[j],str)(row[source_list[i]])
         return self.separator.join(vec)
 
+    def _formatter(self,vec,source_list,target_list):
+        """
+        Returns a function formatting a row (tuple) the same way as `_format_fields`,
+        with the output type of each field looked up only once.
+        """
+        if type(self)._format_fields != TextTrack._format_fields:
+            return lambda row: self._format_fields(vec,row,source_list,target_list)
+        separator = self.separator
+        formats = sorted((j,source_list[i],self.outtypes.get(self.fields[j],str))
+                         for i,j in enumerate(target_list))
+        def _format(row):
+            for j,i,f in formats: vec[j] = f(row[i])
+            return separator.join(vec)
+        if not formats: return _format
+        # Whole row at once with a '%' template, or as above if a value does not fit it
+        template = [x.replace('%','%%') for x in vec]
+        for j,i,f in formats: template[j] = _out_specs.get(f,'%s')
+        template = separator.join(template)
+        if all(f in _out_specs for j,i,f in formats) and len(formats) > 1:
+            get_values = itemgetter(*[i for j,i,f in formats])
+        else:
+            convert = [(i,None if f in _out_specs else f) for j,i,f in formats]
+            get_values = lambda row: tuple([row[i] if f is None else f(row[i]) for i,f in convert])
+        def _format_template(row):
+            try:
+                return template % get_values(row)
+            except (TypeError,ValueError):
+                return _format(row)
+        return _format_template
+
     def write(self, source, fields=None, mode='write', chrom=None, **kw):
         """
         Add data to the track. Effectively writes in the related file.
@@ -382,9 +970,18 @@ class TextTrack(Track):
         :param fields: list of field names.
         :param mode: (str) file opening mode - one of 'write','overwrite','append'. ['write']
         :param chrom: (str) a chromosome name.
+        :param bgzf: (bool) write a BGZF file, and its region index if the output is sorted
+            and not appended to an existing file. [self.bgzf]
+        :param buffer_rows: (int) number of rows formatted before being written at once. [10000]
         """
         if self.written and mode=='write':
             mode='append'
+        if kw.get('bgzf') is not None:
+            self.bgzf = kw['bgzf']
+        self.index = {}
+        self._index_loaded = False
+        self._index_grouped = True
+        self.bin_index = None
         initial_separator = self.separator
         if self.separator is None:
             self.separator = "\t"
@@ -411,21 +1008,44 @@ class TextTrack(Track):
         self.open(mode)
         if 'chr' in srcfields: chridx = srcfields.index('chr')
         else: chridx = 0
-        if kw.get('clip'):
+        clip = kw.get('clip')
+        if clip:
             sidx = srcfields.index('start')
             eidx = srcfields.index('end')
+        buffer_rows = max(1,int(kw.get('buffer_rows',10000)))
+        binidx = None
+        if self.bgzf and self._region_index and 'chr' in self.fields \
+                and 'start' in srcfields and 'end' in srcfields \
+                and ('chr' in srcfields or chrom is not None):
+            binidx = _BinIndex()
+            bsidx = srcfields.index('start')
+            beidx = srcfields.index('end')
+            buffer_rows = 1 # the index needs the file position of every row
+        format_row = self._formatter(voidvec,srcl,trgl)
+        lines = []
         for row in source:
-            if kw.get('clip'):
+            if clip:
                 chrsize = self.chrmeta.get(chrom, self.chrmeta.get(row[chridx],{})).get('length',sys.maxint)
                 start = max(0,row[sidx])
                 end = min(row[eidx],chrsize)
                 if end <= start: continue
                 row = row[:sidx]+(start,)+row[(sidx+1):]
                 row = row[:eidx]+(end,)+row[(eidx+1):]
-            self.filehandle.write(self._format_fields(voidvec,row,srcl,trgl)+"\n")
+            if binidx is not None:
+                binidx.add(str(row[chridx]) if 'chr' in srcfields else chrom,
+                           int(row[bsidx]),int(row[beidx]),self.filehandle.tell())
+            lines.append(format_row(row))
+            if len(lines) >= buffer_rows:
+                self.filehandle.write("\n".join(lines)+"\n")
+                lines = []
+        if lines: self.filehandle.write("\n".join(lines)+"\n")
         self.written = True
         self.separator = initial_separator
         self.close()
+        if binidx is not None and mode != 'append':
+            self._save_bin_index(binidx)
+        elif mode == 'append' and os.path.exists(self.bin_index_path):
+            os.remove(self.bin_index_path) # only covers the rows before: rebuilt on the next read
 
     def make_header(self, *args, **kw):
         """
@@ -510,6 +1130,8 @@ class BedTrack(TextTrack):
 
     This list will be shortened depending on the number of items found in the first line of the file.
     """
+    _chunk_parser = True
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'bed'
         _allf = ['chr','start','end','name','score','strand',
@@ -547,6 +1169,8 @@ class BedGraphTrack(TextTrack):
         ['chr','start','end','score']
 
     """
+    _chunk_parser = True
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'bedGraph'
         kwargs['fields'] = ['chr','start','end','score']
@@ -566,6 +1190,11 @@ class SgaTrack(TextTrack):
 
     Scores are rounded to the upper integer when written (but are supposed to be integer originally).
     """
+    _region_index = False
+    _chunk_parser = True
+    _sga_fields = ['chr','name','end','strand','score']
+    _translate_strand = {'+':1, '-':-1, '0':0, 1:1, -1:-1, 0:0}
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'sga'
         kwargs['fields'] = ['chr','start','end','name','strand','score']
@@ -586,18 +1215,16 @@ class SgaTrack(TextTrack):
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
         fstart = fend = 0
-        translate_strand = {'+':1, '-':-1, '0':0, 1:1, -1:-1, 0:0}
-        sga_fields = ['chr','name','end','strand','score']
         while True:
             fstart = self.filehandle.tell()
             row = self.filehandle.readline()
             if not row.strip(): break
             if row[0]=="#": continue
-            splitrow = [self._check_type(s.strip(),sga_fields[n])
+            splitrow = [self._check_type(s.strip(),self._sga_fields[n])
                         for n,s in enumerate(row.split(self.separator))]
             if not any(splitrow): continue
             chrom,name,pos,strand,score = splitrow
-            strand = translate_strand[strand]
+            strand = self._translate_strand[strand]
             rowdata = (chrom,pos-1,pos,name,strand,score)
             if selection:
                 if skip:
@@ -607,6 +1234,56 @@ class SgaTrack(TextTrack):
                     continue
             fstart = fend
             yield tuple(rowdata[ind] for ind in index_list)
+        self.close()
+        if skip and selection: self._save_index()
+
+    def _seek_data(self):
+        pass
+
+    def _filter_lines(self, lines):
+        if _special_heads.difference('@tb').isdisjoint(row[:1] for row in lines):
+            return lines, False, None
+        rows = []
+        kept = []
+        for n,row in enumerate(lines):
+            if not row.strip(): return rows, True, kept
+            if row[0]=="#": continue
+            rows.append(row)
+            kept.append(n)
+        return rows, False, kept
+
+    def _columns(self, lines, fields, index_list, chrom=None, with_chr=False):
+        try:
+            columns,width = self._split_columns(lines)
+            if width != 5: raise ValueError
+            chrs,names,pos,strands,scores = [self._typed_column(col,self._sga_fields[n])
+                                             for n,col in enumerate(columns)]
+            if '' in chrs: raise ValueError # could be a line to skip
+            columns = [chrs,[p-1 for p in pos],pos,names,
+                       [self._translate_strand[x] for x in strands],scores]
+        except (ValueError,KeyError,TypeError):
+            columns = None
+        if columns is None: # line by line, exactly as `_read`
+            rows = []
+            chrs = []
+            for row in lines:
+                splitrow = [self._check_type(s.strip(),self._sga_fields[n])
+                            for n,s in enumerate(row.split(self.separator))]
+                if not any(splitrow):
+                    chrs.append(None)
+                    continue
+                chrom_,name,pos,strand,score = splitrow
+                chrs.append(chrom_)
+                rowdata = (chrom_,pos-1,pos,name,self._translate_strand[strand],score)
+                if chrom is None or str(chrom_) in chrom:
+                    rows.append(tuple(rowdata[ind] for ind in index_list))
+            return [list(col) for col in zip(*rows)] or None, chrs
+        if chrom is not None:
+            keep = [c in chrom for c in chrs]
+            if not any(keep): return None, chrs
+            if not all(keep):
+                columns = [list(compress(col,keep)) for col in columns]
+        return [columns[ind] for ind in index_list], chrs
 
     def _format_fields(self,vec,row,source_list,target_list):
         """'Bucher' conversion expecting the source to be a result of `bam2wig -q 1`.
@@ -635,6 +1312,8 @@ class WigTrack(TextTrack):
         ['chr','start','end','score']
 
     """
+    _region_index = False
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'wig'
         kwargs['fields'] = ['chr','start','end','score']
@@ -740,6 +1419,7 @@ class WigTrack(TextTrack):
         except ValueError as ve:
             raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row,ve))
         self.close()
+        if skip and selection: self._save_index()
         if fixedStep is None:
             raise IOError("Please specify 'fixedStep' or 'variableStep'.")
 
@@ -756,6 +1436,34 @@ class WigTrack(TextTrack):
         feat = self.separator.join([start,score])
         return head+feat
 
+    def _formatter(self,vec,source_list,target_list):
+        ichr,istart,iend,iscore = source_list[:4]
+        format_start = self.outtypes.get('start',str)
+        format_score = self.outtypes.get('score',str)
+        start_spec = _out_specs.get(format_start)
+        score_spec = _out_specs.get(format_score)
+        separator = self.separator
+        def _format(row):
+            chrom = row[ichr]
+            start = row[istart]+1
+            try:
+                start = start_spec % start if start_spec else format_start(start)
+            except (TypeError,ValueError):
+                start = format_start(start)
+            span = int(row[iend])-int(row[istart])
+            score = row[iscore]
+            try:
+                score = score_spec % score if score_spec else format_score(score)
+            except (TypeError,ValueError):
+                score = format_score(score)
+            head = ''
+            if span != vec[1] or chrom != vec[0]:
+                head = " ".join(["variableStep","chrom=%s"%chrom,"span=%i"%span])+"\n"
+                vec[1] = span
+                vec[0] = chrom
+            return head+start+separator+score
+        return _format
+
 ################################ GFF ##########################################
 
 class GffTrack(TextTrack):
@@ -815,6 +1523,8 @@ class SamTrack(TextTrack):
 
         track("myfile.sam", tags=['XA','MD','NM'])
     """
+    _region_index = False
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'sam'
         kwargs['fields'] = ['name','flag','chr','start','end','mapq','cigar','rnext','pnext','tlen','seq','qual'] \
@@ -849,6 +1559,7 @@ class SamTrack(TextTrack):
         except (ValueError,IndexError) as ve:
             raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row,ve))
         self.close()
+        if skip and selection: self._save_index()
 
     def _format_fields(self,vec,row,source_list,target_list):
         for i,j in enumerate(target_list):
@@ -859,6 +1570,8 @@ class SamTrack(TextTrack):
 ################################ Fps ##########################################
 
 class FpsTrack(TextTrack):
+    _region_index = False
+
     def __init__(self,path,**kwargs):
         kwargs['format'] = 'fps'
         kwargs['fields'] = ['chr','start','end','name','score','strand']
@@ -889,4 +1602,5 @@ class FpsTrack(TextTrack):
         except (ValueError,IndexError) as ve:
             raise ValueError("Bad line in file %s:\n %s%s\n" % (self.path,row,ve))
         self.close()
+        if skip and selection: self._save_index()
 